@@ -0,0 +1,351 @@
+#multiplies validated samples locally, without API calls, into variants of their USER QUERY:
+#  - device substitution: a device the query names is swapped for another device of the same DEVICE STRUCTURE that
+#    has an identical definition (same properties, commands, parameters and values; only name and id differ). its
+#    name is replaced in the query and in the assistant response, its id in the response, so the response stays right.
+#  - synonyms: one phrase of the query is swapped for a synonym (turn on -> switch on, ...). only phrases that keep
+#    their meaning in any query qualify; check_synonyms verifies that on example queries before every run.
+#  - typos: one word of the query gets a typo (swapped, dropped or doubled letter).
+#the samples are read through the catalog (files and stores alike) and grouped by DEVICE STRUCTURE, so every
+#structure is parsed and indexed once for all the samples that share it; the groups are augmented in parallel.
+#variants are deduplicated against every existing sample and against each other on the normalized user message,
+#and written next to the samples as sample_batch_augment<timestamp>_output_<custom id>.jsonl, so check, combine,
+#prune and retire treat them like any other samples. augmented samples are never augmented again.
+
+import hashlib, json, random, re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, List
+from util import get_data_directory
+from sample_catalog import SampleCatalog
+from sample_generation import sample_file_name
+from device_structure import Device, parse_device_structure, extract_device_structure, get_signature
+from coverage_planner import get_references
+from check_samples import check_sample_structure
+from pack_conversations import QUERY_MARKER
+
+
+AUGMENT_BATCH_PREFIX = "batch_augment"
+VARIANTS_PER_SAMPLE = 2
+SYNONYM_RATE = 0.7      # chance a variant also gets a synonym
+TYPO_RATE = 0.3         # chance a variant also gets a typo
+MAX_WORKERS = 4
+GROUPS_PER_TASK = 16    # structure groups handed to a worker at a time
+SEED = 1
+
+#phrases of user queries and what they may be replaced with; every phrase of a line can replace the others
+SYNONYMS = [
+    ["turn on", "switch on", "power on"],
+    ["turn off", "switch off", "shut off", "power off"],
+    ["set", "change", "adjust"],
+    ["brighten", "raise the brightness of"],
+    ["please", "kindly", "could you"],
+    ["what is", "what's", "tell me"],
+    ["check", "look up"],
+    ["close", "shut"],
+    ["lock", "secure"],
+    ["temperature", "temp"],
+]
+#phrases that may only be replaced one way: "dim the lights" is "lower the lights", "lower the blinds" is not "dim the blinds"
+ONE_WAY_SYNONYMS = {
+    "dim": ["lower"],
+}
+
+#phrases that only fit at the start of a sentence ("turn off the lights please" is not "... lights could you")
+SENTENCE_START = {"could you"}
+
+_synonyms = {phrase: [other for other in line if other != phrase] for line in SYNONYMS for phrase in line}
+_synonyms.update(ONE_WAY_SYNONYMS)
+#longest first so "turn on" wins over "on"-like shorter phrases of the same spot
+SYNONYM_RE = re.compile(r"\b(" + "|".join(re.escape(p) for p in sorted(_synonyms, key=len, reverse=True)) + r")\b", re.IGNORECASE)
+WORD_RE = re.compile(r"\b[A-Za-z]{4,}\b")
+
+#what a query asks for, to check that synonyms keep it; the first matching intent wins
+INTENT_PATTERNS = [(intent, re.compile(pattern, re.IGNORECASE)) for intent, pattern in [
+    ("position", r"\b(open|close|shut|raise|lower)\b.*\b(blinds?|shades?|curtains?|garage|doors?|windows?|valves?)\b"),
+    ("on", r"\b(turn|switch|power) on\b"),
+    ("off", r"\b(turn|switch|shut|power) off\b"),
+    ("dim", r"\b(dim|lower)\b"),
+    ("brighten", r"\b(brighten|raise the brightness of)\b"),
+    ("lock", r"\b(lock|secure)\b"),
+    ("set", r"\b(set|change|adjust)\b"),
+    ("query", r"\b(what is|what's|tell me|check|look up)\b"),
+]]
+#shapes no variant may have
+UNGRAMMATICAL_RE = re.compile(r"\bthe (the|two the|two of)\b|\bevery one of (?!the\b)|[^\s.!?]\s+could you\b", re.IGNORECASE)
+SYNONYM_EXAMPLES = [
+    ("Turn on the kitchen lights", "on"),
+    ("please switch off both lamps", "off"),
+    ("Dim the office lights to 30%", "dim"),
+    ("lower the blinds in the bedroom", "position"),
+    ("open the garage door", "position"),
+    ("Close the living room shades", "position"),
+    ("shut off the porch light", "off"),
+    ("lock the front door", "lock"),
+    ("Set the thermostat temperature to 72", "set"),
+    ("what is the temperature in the den?", "query"),
+    ("could you brighten the hallway", "brighten"),
+    ("check both locks", "query"),
+    ("turn on both the lamps and the fan", "on"),
+    ("turn off the lights please", "off"),
+    ("Turn off all lights, please", "off"),
+]
+
+
+def get_query(sample: dict) -> str:
+    return sample["messages"][1]["content"].split(QUERY_MARKER, 1)[1]
+
+def get_key(user_content: str) -> str:
+    """
+    The deduplication key of a user message: its text without case and whitespace differences.
+    """
+    return hashlib.sha1(" ".join(user_content.lower().split()).encode("utf-8")).hexdigest()
+
+def index_structure(structure: str) -> Dict[str, List[Device]]:
+    """
+    The devices of a DEVICE STRUCTURE that have a twin, grouped by signature.
+    """
+    groups = {}
+    for device in parse_device_structure(structure):
+        if device.name:
+            groups.setdefault(get_signature(device), []).append(device)
+    return {signature: devices for signature, devices in groups.items() if len(devices) > 1}
+
+def name_re(name: str) -> re.Pattern:
+    return re.compile(r"(?<![\w])" + re.escape(name) + r"(?![\w])", re.IGNORECASE)
+
+def match_case(text: str, name: str) -> str:
+    """
+    The name written like text is (lower, upper or as defined).
+    """
+    if text.islower():
+        return name.lower()
+    if text.isupper():
+        return name.upper()
+    return name
+
+def substitute_device(query: str, response: str, old: Device, new: Device, names: List[str]):
+    """
+    Replaces old by new in the query and the response. Returns (query, response), or None if old is referred to
+    in a way that cannot be replaced consistently (e.g. only by part of its name).
+    names are the names of the devices of the structure the query mentions, which may share words with old.
+    """
+    old_re = name_re(old.name)
+    if not old_re.search(query):
+        return None
+    query = old_re.sub(lambda m: match_case(m.group(0), new.name), query)
+    response = old_re.sub(lambda m: match_case(m.group(0), new.name), response)
+    response = response.replace(json.dumps(old.id), json.dumps(new.id))
+    #the id may also be quoted in the reasoning; short ids ("1") are left alone there
+    if json.dumps(old.id) in response or (len(old.id) > 3 and old.id in response):
+        return None
+    #a leftover word of the old name (e.g. "patio" of "Family Room Patio Light") is a partial reference to it
+    residue = (query + "\n" + response).lower()
+    for name in names + [new.name]:
+        residue = name_re(name).sub(" ", residue)
+    new_words = set(new.name.lower().split())
+    for word in set(old.name.lower().split()) - new_words:
+        if len(word) > 2 and re.search(r"(?<![\w])" + re.escape(word) + r"(?![\w])", residue):
+            return None
+    return query, response
+
+def substitute_phrase(query: str, match: re.Match, phrase: str) -> str:
+    replacement = match_case(match.group(0), phrase)
+    if match.group(0)[:1].isupper():
+        replacement = replacement[:1].upper() + replacement[1:]
+    return query[:match.start()] + replacement + query[match.end():]
+
+def get_replacements(query: str, match: re.Match) -> List[str]:
+    """
+    The synonyms that fit where the phrase matched.
+    """
+    at_start = not query[:match.start()].strip() or query[:match.start()].rstrip()[-1] in ".!?"
+    return [phrase for phrase in _synonyms[match.group(0).lower()] if at_start or phrase not in SENTENCE_START]
+
+def add_synonym(query: str, rng: random.Random) -> str:
+    matches = [match for match in SYNONYM_RE.finditer(query) if get_replacements(query, match)]
+    if not matches:
+        return query
+    match = rng.choice(matches)
+    return substitute_phrase(query, match, rng.choice(get_replacements(query, match)))
+
+def get_intent(query: str) -> str:
+    for intent, pattern in INTENT_PATTERNS:
+        if pattern.search(query):
+            return intent
+    return None
+
+def check_synonyms(examples: List[tuple] = SYNONYM_EXAMPLES) -> List[str]:
+    """
+    Applies every synonym to every (query, intent) example. Returns the variants whose intent changed or that
+    are not grammatical.
+    """
+    failures = []
+    for query, intent in examples:
+        if get_intent(query) != intent:
+            failures.append(f"{query!r} is not {intent}")
+            continue
+        for match in SYNONYM_RE.finditer(query):
+            for phrase in get_replacements(query, match):
+                variant = substitute_phrase(query, match, phrase)
+                if get_intent(variant) != intent:
+                    failures.append(f"{query!r} -> {variant!r} is {get_intent(variant)}, not {intent}")
+                elif UNGRAMMATICAL_RE.search(variant):
+                    failures.append(f"{query!r} -> {variant!r} is not grammatical")
+    return failures
+
+def add_typo(query: str, rng: random.Random) -> str:
+    matches = list(WORD_RE.finditer(query))
+    if not matches:
+        return query
+    match = rng.choice(matches)
+    word = match.group(0)
+    i = rng.randrange(1, len(word) - 1)
+    kind = rng.choice(("swap", "drop", "double"))
+    if kind == "swap":
+        word = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    elif kind == "drop":
+        word = word[:i] + word[i + 1:]
+    else:
+        word = word[:i] + word[i] + word[i:]
+    return query[:match.start()] + word + query[match.end():]
+
+def augment_sample(sample: dict, twins: Dict[str, List[Device]], devices: Dict[str, Device], rng: random.Random, variants: int = VARIANTS_PER_SAMPLE) -> List[dict]:
+    """
+    Up to variants new samples of one single turn sample. twins and devices come from the sample's structure.
+    """
+    system, user, assistant = sample["messages"]
+    query = get_query(sample)
+    context = user["content"][:len(user["content"]) - len(query)]
+    response = assistant["content"]
+    referenced = [devices[id] for id in sorted({reference[1] for reference in get_references(response)}) if id in devices]
+    mentioned = [device.name for device in devices.values() if device.name and name_re(device.name).search(query)]
+    results = []
+    for _ in range(variants * 3):
+        if len(results) >= variants:
+            break
+        new_query, new_response = query, response
+        taken = {device.id for device in referenced}
+        for device in referenced:
+            candidates = [twin for twin in twins.get(get_signature(device), []) if twin.id not in taken and twin.name not in mentioned]
+            if not candidates:
+                continue
+            twin = rng.choice(candidates)
+            substituted = substitute_device(new_query, new_response, device, twin, mentioned)
+            if substituted:
+                new_query, new_response = substituted
+                taken.add(twin.id)
+        if rng.random() < SYNONYM_RATE:
+            new_query = add_synonym(new_query, rng)
+        if rng.random() < TYPO_RATE or new_query == query:
+            new_query = add_typo(new_query, rng)
+        if new_query == query:
+            continue
+        results.append({"messages": [system, dict(user, content=context + new_query), dict(assistant, content=new_response)]})
+    return results
+
+def augment_group(structure: str, items: List[tuple], seed: int = SEED) -> List[tuple]:
+    """
+    Augments the (custom id, sample) items that share one DEVICE STRUCTURE. Returns (custom id, variant) items.
+    """
+    try:
+        devices = {device.id: device for device in parse_device_structure(structure)}
+        twins = index_structure(structure)
+    except Exception as e:
+        print(f"Error parsing a device structure: {e}")
+        return []
+    results = []
+    for custom_id, sample in items:
+        #the same sample always gets the same variants
+        rng = random.Random(f"{seed}:{custom_id}:{get_key(sample['messages'][1]['content'])}")
+        try:
+            results.extend((custom_id, variant) for variant in augment_sample(sample, twins, devices, rng))
+        except Exception as e:
+            print(f"Error augmenting a sample of {custom_id}: {e}")
+    return results
+
+def _augment_groups(groups: List[tuple]) -> List[tuple]:
+    return [result for structure, items, seed in groups for result in augment_group(structure, items, seed)]
+
+def is_augmentable(sample: dict) -> bool:
+    if not check_sample_structure(sample) or len(sample["messages"]) != 3:
+        return False
+    #clarifications are dropped by combine_samples anyway
+    return "clarify" not in sample["messages"][2]["content"].lower()
+
+def augment_catalog(catalog: SampleCatalog, types: Iterable[str], seed: int = SEED, max_workers: int = MAX_WORKERS, dry_run: bool = False) -> dict:
+    """
+    Augments the samples of the given types in the catalog's directory and writes the variants that are not
+    duplicates next to them. Returns counts of the samples read, variants generated and variants written.
+    """
+    catalog.refresh()
+    keys = set()
+    groups = {}
+    stats = {"samples": 0, "variants": 0, "duplicates": 0, "written": 0, "files": 0}
+    for row in catalog.select(types=types):
+        source = not (row["batch_id"] or "").startswith(AUGMENT_BATCH_PREFIX)
+        for line in catalog.read_lines(row):
+            try:
+                sample = json.loads(line)
+                keys.add(get_key(sample["messages"][1]["content"]))
+            except Exception:
+                continue
+            if source and is_augmentable(sample):
+                stats["samples"] += 1
+                structure = extract_device_structure(sample["messages"][1]["content"])
+                groups.setdefault(structure, []).append((row["custom_id"], sample))
+    tasks = [(structure, items, seed) for structure, items in groups.items()]
+    chunks = [tasks[i:i + GROUPS_PER_TASK] for i in range(0, len(tasks), GROUPS_PER_TASK)]
+    outputs = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for results in executor.map(_augment_groups, chunks):
+            for custom_id, variant in results:
+                stats["variants"] += 1
+                key = get_key(variant["messages"][1]["content"])
+                if key in keys:
+                    stats["duplicates"] += 1
+                    continue
+                keys.add(key)
+                outputs.setdefault(custom_id, []).append(variant)
+    batch_id = f"{AUGMENT_BATCH_PREFIX}{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    for custom_id, variants in outputs.items():
+        stats["written"] += len(variants)
+        stats["files"] += 1
+        if dry_run:
+            continue
+        output_file = catalog.samples_path / sample_file_name(batch_id, custom_id)
+        with output_file.open("w", encoding="utf-8") as f:
+            for variant in variants:
+                f.write(json.dumps(variant) + "\n")
+        catalog.add(output_file)
+    return stats
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Generate variants of validated samples locally: device substitution, synonyms and typos.")
+    parser.add_argument("--input_path", default="batched-samples", type=str, help="Directory with the samples; the variants are written there too. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--types", type=str, help="Sample types to augment (commands, properties). Defaults to both.")
+    parser.add_argument("--seed", default=SEED, type=int, help="Seed of the variants; the same seed gives the same variants.")
+    parser.add_argument("--max_workers", default=MAX_WORKERS, type=int, help="Processes augmenting structure groups in parallel.")
+    parser.add_argument("--dry_run", default="false", type=str, help="Only count the variants.")
+    args = parser.parse_args()
+
+    input_path = Path(args.input_path)
+    if not input_path.is_absolute():
+        input_path = Path(get_data_directory("datasets", args.input_path))
+    if not input_path.exists() or not input_path.is_dir():
+        raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+    types = [t.strip() for t in args.types.split(",")] if args.types else ["commands", "properties"]
+
+    failures = check_synonyms()
+    if failures:
+        raise ValueError("Synonyms that change the meaning of a query:\n" + "\n".join(failures))
+
+    catalog = SampleCatalog(input_path)
+    try:
+        stats = augment_catalog(catalog, types, args.seed, args.max_workers, args.dry_run.lower() == "true")
+    finally:
+        catalog.close()
+    print(f"✅ {stats['samples']} samples -> {stats['variants']} variants, {stats['duplicates']} duplicates dropped, "
+          f"{stats['written']} written to {stats['files']} files in {input_path}")
@@ -1,14 +1,29 @@
 #this file checks samples that are in jsonl format for structural validity.
 #if not valid, they are moved to errors directory for manual checking
+#validation results are cached per file (content hash + rules version) so that only new or modified files
+#are checked again, unless the validation rules themselves changed.
+#per batch stores (see sample_store.py) are checked per request: the samples of an invalid request are
+#written to the errors directory and the request is retired from the store.
+#compressed samples (.jsonl.gz, .jsonl.zst, see jsonl_io.py) are checked as they are, without unpacking them.
 
 
-import json, os
+import json, os, sys, hashlib, inspect
+from datetime import datetime
 from pathlib import Path
 from typing import List
-from util import get_data_directory
+from util import get_data_directory, get_file_hash, write_json_atomic
+from sample_store import STORE_RE, SampleStore, iter_stores
+from jsonl_io import open_jsonl, glob_jsonl
 
 
-def check_sample_structure(sample: dict) -> bool:
+CACHE_FILE = ".check_cache.json"
+REPORT_FILE = "check_report.json"
+#references the prefix layout has the samples hold instead of the texts, and the template placeholders; a sample
+#that still has one was not restored (see prompt_layout.restore_references)
+PLACEHOLDERS = ("<RUNTIME SYSTEM PROMPT>", "<DEVICE STRUCTURE>", "{{TEMPLATE_PROMPTS_RUNTIME}}", "{{DEVICE_STRUCTURE}}")
+
+
+def check_sample_structure(sample: dict, packed: bool = False) -> bool:
     """
     We have chat completion messages of the form:
     {"messages":[
@@ -16,6 +31,9 @@ def check_sample_structure(sample: dict) -> bool:
         {"role":"user","content":"DEVICE STRUCTURE:\n{{DEVICE_STRUCTURE}}\n\nUSER QUERY: <natural language command>"},
         {"role":"assistant","content":"<ASSISTANT RESPONSE>"}
     ]}  
+    Packed conversations (see pack_conversations.py; only with packed=True) continue with more turns of
+        {"role":"user","content":"USER QUERY: <natural language command>"},
+        {"role":"assistant","content":"<ASSISTANT RESPONSE>"}
     We want to ensure that each sample has the correct structure.   
     Returns True if the sample is valid, False otherwise.
     Invalid samples are logged to the error_pa
@@ -32,9 +50,12 @@ def check_sample_structure(sample: dict) -> bool:
         if not isinstance(messages, list):
             print(f"'messages' is not a list: {messages}")
             return False
-        if len(messages) != 3:
+        if not packed and len(messages) != 3:
             print(f"'messages' does not have 3 elements: {messages}")
             return False
+        if len(messages) < 3 or len(messages) % 2 == 0:
+            print(f"'messages' does not have 3 elements plus a user and an assistant message per further turn: {messages}")
+            return False
         system = messages[0]
         user = messages[1]
         assistant = messages[2]
@@ -74,6 +95,25 @@ def check_sample_structure(sample: dict) -> bool:
             if "USER QUERY:" not in user_content:
                 print(f"User message does not have USER QUERY: {user_content}")
                 return False
+            for placeholder in PLACEHOLDERS:
+                if placeholder in system_content or placeholder in user_content:
+                    print(f"Sample holds {placeholder} instead of the text: {user_content[:100]}")
+                    return False
+
+            #the further turns of a packed conversation
+            for turn_user, turn_assistant in zip(messages[3::2], messages[4::2]):
+                if not isinstance(turn_user, dict) or turn_user.get('role') != 'user':
+                    print(f"Turn does not start with an user message: {turn_user}")
+                    return False
+                if not isinstance(turn_assistant, dict) or turn_assistant.get('role') != 'assistant':
+                    print(f"Turn does not end with an assistant message: {turn_assistant}")
+                    return False
+                if not isinstance(turn_user.get('content'), str) or "USER QUERY:" not in turn_user['content']:
+                    print(f"User message of a turn does not have USER QUERY: {turn_user}")
+                    return False
+                if not isinstance(turn_assistant.get('content'), str) or not turn_assistant['content'].strip():
+                    print(f"Assistant message of a turn is invalid: {turn_assistant}")
+                    return False
 
             return True
 
@@ -85,35 +125,107 @@ def check_sample_structure(sample: dict) -> bool:
         print(f"Error checking sample structure: {e}")
         return False
 
+def check_packed_structure(sample: dict) -> bool:
+    """
+    check_sample_structure for the conversations of packed files (*_packed.jsonl), which may have further turns.
+    """
+    return check_sample_structure(sample, packed=True)
+
+def is_packed_file(file_path: Path) -> bool:
+    return "_packed" in Path(file_path).name
+
+def check_samples_in_lines(lines, source: str, packed: bool = False) -> bool:
+    """
+    Check all samples in the given JSONL lines for structural validity; further turns only if packed.
+    """
+    for line in lines:
+        try:
+            if line.strip():
+                sample = json.loads(line)
+                if check_sample_structure(sample, packed):
+                    continue
+                return False
+        except json.JSONDecodeError as e:
+            print(f"JSON decode error in {source}: {e}")
+            return False
+    return True
+
 def check_samples_in_file(file_path: Path)-> bool:
     """
     Check all samples in a given JSONL file for structural validity.
     Invalid samples are logged to the error_path.
     """
     try:
-        with file_path.open('r', encoding='utf-8') as f:
-            for line in f:
-                try:
-                    if line.strip():
-                        sample = json.loads(line)
-                        if check_sample_structure(sample):
-                            continue
-                        return False
-                except json.JSONDecodeError as e:
-                    print(f"JSON decode error in file {file_path}: {e}")
-                    return False
+        with open_jsonl(file_path, 'r') as f:
+            if not check_samples_in_lines(f, f"file {file_path}", is_packed_file(file_path)):
+                return False
             print(f"All samples in {file_path} are valid.")
             return True
     except Exception as e:
         print(f"Error reading file {file_path}: {e}")
         return False
-    
+
+def check_samples_in_store(store: SampleStore) -> List[str]:
+    """
+    Check the samples of every request in a store. Returns the custom ids of the requests with invalid samples.
+    """
+    invalid = []
+    for custom_id, _ in store.iter_entries():
+        try:
+            if not check_samples_in_lines(store.read_lines(custom_id), f"{store.store_path.name}#{custom_id}"):
+                invalid.append(custom_id)
+        except Exception as e:
+            print(f"Error reading {custom_id} from {store.store_path}: {e}")
+            invalid.append(custom_id)
+    return invalid
+
+def get_rules_version() -> str:
+    """
+    The version of the validation rules is the hash of the module that implements them (functions and the
+    constants they use alike), so any change to the rules invalidates every cached result.
+    """
+    source = inspect.getsource(sys.modules[__name__])
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()[:16]
+
+def load_cache(cache_path: Path, rules_version: str) -> dict:
+    """
+    Returns the cached results {file name: {size, mtime, hash, valid}} for the current rules version.
+    """
+    if not cache_path.exists():
+        return {}
+    try:
+        with cache_path.open('r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except Exception as e:
+        print(f"Error reading cache {cache_path}, checking everything: {e}")
+        return {}
+    if cache.get('rules_version') != rules_version:
+        print("Validation rules changed since the last run; checking everything.")
+        return {}
+    return cache.get('files', {})
+
+def is_unchanged(file: Path, entry: dict) -> bool:
+    """
+    True if the file still has the content it had when it was validated.
+    The hash is only computed when size or mtime changed.
+    """
+    if not entry:
+        return False
+    stat = file.stat()
+    if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return True
+    if entry['size'] == stat.st_size and entry['hash'] == get_file_hash(file):
+        entry['mtime'] = stat.st_mtime
+        return True
+    return False
+
 # Example usage
 if __name__ == "__main__":
     argparse = __import__('argparse')
     parser = argparse.ArgumentParser(description="check samples for structural validity")
     parser.add_argument("--input-path", default="batched-samples", type=str, help="Path to the input directory where the samples are stored.")
     parser.add_argument("--errors-path", default="errors", type=str, help="Path to the directory where errors will be logged.")
+    parser.add_argument("--full", default="false", type=str, help="Ignore the validation cache and check every file.")
 
     args = parser.parse_args()
 
@@ -129,12 +241,63 @@ if __name__ == "__main__":
     if not input_path.exists() or not input_path.is_dir():
         raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
     
-    for file in input_path.glob("*.jsonl"):
+    rules_version = get_rules_version()
+    cache_path = input_path / CACHE_FILE
+    cache = load_cache(cache_path, rules_version) if args.full.lower() != "true" else {}
+    results = {}
+    newly_invalid = []
+    skipped = 0
+
+    for file in glob_jsonl(input_path, "*"):
+        if STORE_RE.match(file.name):
+            continue
+        entry = cache.get(file.name)
+        if is_unchanged(file, entry) and entry['valid']:
+            results[file.name] = entry
+            skipped += 1
+            continue
         print(f"Checking samples in file: {file}")
+        stat = file.stat()
+        file_hash = get_file_hash(file)
         if not check_samples_in_file(file):
             print(f"Invalid samples found in {file}. Moving to errors directory.")
             dest_file = errors_path / file.name
             file.rename(dest_file)
             print(f"Moved {file} to {dest_file}")
+            newly_invalid.append(file.name)
+            continue
+        results[file.name] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": file_hash, "valid": True}
+
+    for store_path in iter_stores(input_path):
+        #stores only grow by appending, so an unchanged store file has no unchecked requests
+        entry = cache.get(store_path.name)
+        if is_unchanged(store_path, entry) and entry['valid']:
+            results[store_path.name] = entry
+            skipped += 1
+            continue
+        print(f"Checking samples in store: {store_path}")
+        store = SampleStore(store_path)
+        stat = store_path.stat()
+        file_hash = get_file_hash(store_path)
+        invalid = check_samples_in_store(store)
+        for custom_id in invalid:
+            dest_file = store.write_view(custom_id, errors_path)
+            print(f"Invalid samples found for {custom_id} in {store_path.name}. Moved to {dest_file}")
+            newly_invalid.append(f"{store_path.name}#{custom_id}")
+        store.retire(invalid)
+        store.close()
+        results[store_path.name] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": file_hash, "valid": True}
+
+    write_json_atomic(cache_path, {"rules_version": rules_version, "files": results})
 
-    print ("Sample check completed.")
+    report = {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "rules_version": rules_version,
+        "checked": len(results) - skipped + len(newly_invalid),
+        "skipped": skipped,
+        "newly_invalid": newly_invalid
+    }
+    write_json_atomic(errors_path / REPORT_FILE, report)
+    for name in newly_invalid:
+        print(f"NEWLY INVALID: {name}")
+    print (f"Sample check completed: {report['checked']} checked, {skipped} unchanged, {len(newly_invalid)} newly invalid (report in {errors_path / REPORT_FILE}).")
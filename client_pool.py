@@ -0,0 +1,127 @@
+#Spreads chat completion requests over a pool of clients (several API keys and/or providers) so that the
+#total throughput is the sum of all of them. Every request goes to the member with the best score:
+#    measured throughput * remaining rate limit headroom / (cost weight * (1 + requests in flight))
+#Members that have not completed a request yet are assumed to be as fast as the fastest known member
+#so that they get tried.
+
+import threading
+import time
+from typing import List
+from openai import OpenAI
+from rate_limiter import RateLimitedClient, DEFAULT_RPM, DEFAULT_TPM, DEFAULT_MAX_CONCURRENCY
+
+
+THROUGHPUT_SMOOTHING = 0.2   # weight of the newest observation in the throughput moving average
+MIN_HEADROOM = 0.02          # members below this are only used when every member is exhausted
+
+
+class PoolMember:
+    """
+    One client in the pool: a rate limited client, the model to use with it and its relative cost.
+    """
+    def __init__(self, name:str, client:RateLimitedClient, model:str, cost_weight:float=1.0):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.cost_weight = cost_weight if cost_weight > 0 else 1.0
+        self.throughput = None    # completion tokens per second, moving average
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    def score(self, default_throughput:float)->float:
+        throughput = self.throughput if self.throughput is not None else default_throughput
+        headroom = self.client.headroom
+        if headroom < MIN_HEADROOM:
+            headroom *= 0.01
+        return throughput * headroom / (self.cost_weight * (1 + self.in_flight))
+
+
+class ClientPool:
+    """
+    A drop-in replacement for RateLimitedClient.create_chat_completion that picks a member per request.
+    The model argument is ignored; each member uses its own model.
+    """
+    def __init__(self, members:List[PoolMember]):
+        if not members:
+            raise ValueError("A client pool needs at least one member.")
+        self.members = members
+        self.lock = threading.Lock()
+
+    def pick(self)->PoolMember:
+        with self.lock:
+            known = [member.throughput for member in self.members if member.throughput is not None]
+            default_throughput = max(known) if known else 1.0
+            member = max(self.members, key=lambda m: m.score(default_throughput))
+            member.in_flight += 1
+            return member
+
+    def _done(self, member:PoolMember, tokens:int, elapsed:float, failed:bool):
+        with self.lock:
+            member.in_flight -= 1
+            if failed:
+                member.failed += 1
+                return
+            member.completed += 1
+            if tokens and elapsed > 0:
+                observed = tokens / elapsed
+                if member.throughput is None:
+                    member.throughput = observed
+                else:
+                    member.throughput = (1 - THROUGHPUT_SMOOTHING) * member.throughput + THROUGHPUT_SMOOTHING * observed
+
+    def create_chat_completion(self, **kwargs):
+        member = self.pick()
+        kwargs["model"] = member.model
+        start = time.monotonic()
+        try:
+            response = member.client.create_chat_completion(**kwargs)
+        except Exception:
+            self._done(member, 0, 0, True)
+            raise
+        usage = getattr(response, "usage", None)
+        self._done(member, getattr(usage, "completion_tokens", 0) or 0, time.monotonic() - start, False)
+        return response
+
+    def create_chat_completion_stream(self, **kwargs):
+        member = self.pick()
+        kwargs["model"] = member.model
+        start = time.monotonic()
+        tokens = 0
+        failed = True
+        try:
+            for chunk in member.client.create_chat_completion_stream(**kwargs):
+                usage = getattr(chunk, "usage", None)
+                if usage:
+                    tokens = getattr(usage, "completion_tokens", 0) or 0
+                yield chunk
+            failed = False
+        finally:
+            self._done(member, tokens, time.monotonic() - start, failed)
+
+    def print_stats(self):
+        for member in self.members:
+            throughput = f"{member.throughput:.1f} tok/s" if member.throughput is not None else "n/a"
+            print(f"{member.name} ({member.model}): {member.completed} completed, {member.failed} failed, {throughput}, headroom {member.client.headroom:.0%}")
+
+
+def make_member(name:str, api_key:str, model:str, base_url:str=None, cost_weight:float=1.0,
+                rpm:int=DEFAULT_RPM, tpm:int=DEFAULT_TPM, max_concurrency:int=DEFAULT_MAX_CONCURRENCY)->PoolMember:
+    client = OpenAI(api_key=api_key, base_url=base_url) if base_url else OpenAI(api_key=api_key)
+    return PoolMember(name, RateLimitedClient(client, rpm=rpm, tpm=tpm, max_concurrency=max_concurrency), model, cost_weight)
+
+def load_members(config:List[dict], keys:dict)->List[PoolMember]:
+    """
+    Builds members from a list of dicts (e.g. read from a JSON file):
+        {"name": "local", "base_url": "http://localhost:8080/v1", "api_key": "...", "model": "...",
+         "cost_weight": 0.1, "rpm": 600, "tpm": 1000000, "max_concurrency": 8}
+    "api_key_var" can be used instead of "api_key" to name a variable defined in keys.py.
+    """
+    members = []
+    for entry in config:
+        api_key = entry.get("api_key") or keys.get(entry.get("api_key_var", ""), None) or "none"
+        members.append(make_member(entry.get("name", entry.get("base_url", "endpoint")), api_key, entry["model"],
+                                   base_url=entry.get("base_url"), cost_weight=entry.get("cost_weight", 1.0),
+                                   rpm=entry.get("rpm", DEFAULT_RPM), tpm=entry.get("tpm", DEFAULT_TPM),
+                                   max_concurrency=entry.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)))
+    return members
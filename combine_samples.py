@@ -1,14 +1,167 @@
 #traverses the samples directory and combines all the samples into a single file
+#combining is incremental: a manifest of the input files (size, mtime, content hash) is kept next to the
+#combined outputs and only new or changed inputs are parsed and cleaned. the cleaned samples of each input
+#are cached so that the combined files can be reassembled without re-parsing anything; removed inputs are
+#simply dropped from the manifest and their samples disappear from the combined outputs.
+#per batch stores (see sample_store.py) are one input per (store, type), identified by the content hash of
+#the store's index: adding or retiring entries changes it.
+#compressed inputs (.jsonl.gz, .jsonl.zst, see jsonl_io.py) are read as they are; the combined outputs stay plain
+#JSONL since that is what the fine-tuning upload expects.
+#with --pack the combined samples are also exported as multi-turn conversations that carry each device
+#structure once (<TYPE>_packed.jsonl, see pack_conversations.py).
 
 import os
 import json
 import argparse
-from util import get_data_directory
-from pathlib import Path 
+import shutil
+import hashlib
+from util import get_data_directory, get_file_hash, write_json_atomic
+from pathlib import Path
+from sample_store import SampleStore, iter_stores
+from jsonl_io import open_jsonl, glob_jsonl
+from pack_conversations import pack_file, MAX_CONVERSATION_TOKENS
 
 
+MANIFEST_FILE = "combine_manifest.json"
+CACHE_DIR = ".combine_cache"
+SAMPLE_TYPES = ["commands", "properties", "routines"]
 
 
+def clean_sample(jl: dict, file_name: str) -> dict:
+    """
+    Cleans one sample in place for fine-tuning.
+    Returns None if the sample must be skipped (assistant asks for clarification).
+    """
+    messages = jl.get("messages", [])
+    for message in messages:
+        if message['role'] == 'assistant':
+            if 'clarify' in message.get('content', '').lower():
+                print(f"Skipping clarify message in file {file_name}: {message['content']}")
+                return None
+
+        if "name" in message:
+            message['name'] = 'system' if message['role'] == 'system' else 'user' if message['role'] == 'user' else 'assistant'
+
+        #remove id
+        message.pop('id', None)
+        #now make sure that there's only a role and content keys in each message and remove the rest
+        keys_to_keep = ['role', 'content', 'name']
+        for key in list(message.keys()):
+            if key not in keys_to_keep:
+                message.pop(key, None)
+    return jl
+
+def clean_lines(lines, source_name: str, cache_file: Path) -> int:
+    """
+    Parses and cleans the samples of one input, given as JSONL lines, and writes them, one per line, to cache_file.
+    Returns the number of samples kept.
+    """
+    count = 0
+    tmp_file = cache_file.with_suffix(".tmp")
+    with tmp_file.open('w', encoding='utf-8') as out:
+        for line in lines:
+            try:
+                jl = clean_sample(json.loads(line), source_name)
+                if jl:
+                    out.write(json.dumps(jl) + "\n")
+                    count += 1
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON from {source_name}: {e}")
+    os.replace(tmp_file, cache_file)
+    return count
+
+def clean_file(jsonl_file: Path, cache_file: Path) -> int:
+    """
+    Parses and cleans all the samples in one input file and writes them, one per line, to cache_file.
+    Returns the number of samples kept.
+    """
+    with open_jsonl(jsonl_file, 'r') as f:
+        return clean_lines(f, jsonl_file.name, cache_file)
+
+def get_store_hash(store: SampleStore, type: str) -> str:
+    return hashlib.sha256(f"{get_file_hash(store.index_path)}:{type}".encode("utf-8")).hexdigest()
+
+def load_manifest(manifest_path: Path) -> dict:
+    if not manifest_path.exists():
+        return {}
+    try:
+        with manifest_path.open('r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as ex:
+        print(f"failed loading manifest {manifest_path}, combining everything again: {ex}")
+        return {}
+
+def update_input(name: str, stat, get_hash, clean, entry: dict, cache_path: Path):
+    """
+    Brings the manifest entry of one input up to date. stat is the os.stat of the file that identifies the input,
+    get_hash() returns its content hash and clean(cache_file) writes its cleaned samples.
+    Returns (entry, changed).
+    """
+    if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime and (cache_path / f"{entry['hash']}.jsonl").exists():
+        return entry, False
+    input_hash = get_hash()
+    cache_file = cache_path / f"{input_hash}.jsonl"
+    if entry and entry['hash'] == input_hash and cache_file.exists():
+        #touched but not modified
+        entry['mtime'] = stat.st_mtime
+        return entry, False
+    print(f"Processing file: {name}")
+    count = clean(cache_file) if not cache_file.exists() else entry_count(cache_file)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "hash": input_hash, "samples": count}, True
+
+def update_type(input_path: Path, cache_path: Path, type: str, entries: dict):
+    """
+    Brings the manifest entries of one sample type up to date with the input directory.
+    Returns (entries, changed) where changed is True if the combined output must be reassembled.
+    """
+    changed = False
+    current = {}
+    for jsonl_file in glob_jsonl(input_path, f"sample_batch*_{type}"):
+        current[jsonl_file.name], input_changed = update_input(jsonl_file.name, jsonl_file.stat(), lambda: get_file_hash(jsonl_file),
+                                                               lambda cache_file: clean_file(jsonl_file, cache_file),
+                                                               entries.get(jsonl_file.name), cache_path)
+        changed = changed or input_changed
+
+    for store_path in iter_stores(input_path):
+        store = SampleStore(store_path)
+        if not store.index_path.exists() or next(store.iter_entries([type]), None) is None:
+            continue
+        name = f"{store_path.name}:{type}"
+        current[name], input_changed = update_input(name, store.index_path.stat(), lambda: get_store_hash(store, type),
+                                                    lambda cache_file: clean_lines((line for _, line in store.iter_lines([type])), name, cache_file),
+                                                    entries.get(name), cache_path)
+        changed = changed or input_changed
+
+    removed = set(entries) - set(current)
+    for name in removed:
+        print(f"Retracting samples of removed file: {name}")
+    return current, changed or bool(removed)
+
+def entry_count(cache_file: Path) -> int:
+    with cache_file.open('r', encoding='utf-8') as f:
+        return sum(1 for _ in f)
+
+def assemble(output_file: Path, cache_path: Path, entries: dict) -> int:
+    """
+    Concatenates the cached cleaned samples of every input into the combined output.
+    Returns the number of samples written.
+    """
+    total = 0
+    tmp_file = output_file.with_suffix(".tmp")
+    with tmp_file.open("wb") as out:
+        for name in sorted(entries):
+            with (cache_path / f"{entries[name]['hash']}.jsonl").open("rb") as f:
+                shutil.copyfileobj(f, out)
+            total += entries[name]['samples']
+    os.replace(tmp_file, output_file)
+    return total
+
+def remove_unused_cache_files(cache_path: Path, manifest: dict):
+    used = {f"{entry['hash']}.jsonl" for entries in manifest.values() for entry in entries.values()}
+    for cache_file in cache_path.glob("*.jsonl"):
+        if cache_file.name not in used:
+            cache_file.unlink()
+
 
 # Example usage
 if __name__ == "__main__":
@@ -17,6 +170,9 @@ if __name__ == "__main__":
     parser.add_argument("--input_path", default="batched-samples", type=str, help="Path to the directory that holds samples in jsonl format.")
     parser.add_argument("--output_path", default="samples", type=str, help="Path to the directory that holds samples in jsonl format.")
     parser.add_argument("--all", default="false", type=str, help="Combine all samples into a single file.")
+    parser.add_argument("--full", default="false", type=str, help="Ignore the manifest and combine every input again.")
+    parser.add_argument("--pack", default="false", type=str, help="Also write <TYPE>_packed.jsonl: the samples sharing a device structure packed into multi-turn conversations.")
+    parser.add_argument("--max_tokens", default=MAX_CONVERSATION_TOKENS, type=int, help="pack: token budget per conversation.")
     args = parser.parse_args()
 
     input_path = Path(get_data_directory("datasets", args.input_path))
@@ -26,56 +182,57 @@ if __name__ == "__main__":
     output_path = Path(get_data_directory("datasets", args.output_path))
     if not output_path.exists() or not output_path.is_dir():
         raise ValueError(f"Output path {output_path} does not exist or is not a directory.")
-    
+
     all = args.all.lower() == "true"
+    pack = args.pack.lower() == "true"
 
-    sample_types = ["commands", "properties", "routines"]
-    i=0; 
-    if all:
-        all_output_file = output_path / f"ALL_combined.jsonl"
+    manifest_path = output_path / MANIFEST_FILE
+    cache_path = output_path / CACHE_DIR
+    if args.full.lower() == "true" and cache_path.exists():
+        shutil.rmtree(cache_path)
+    cache_path.mkdir(exist_ok=True)
+    manifest = load_manifest(manifest_path) if args.full.lower() != "true" else {}
 
-    for type in sample_types:
+    i=0;
+    any_changed = False
+    for type in SAMPLE_TYPES:
         output_file = output_path / f"{type.upper()}_combined.jsonl"
-        #now traverse the input directory and combine all jsonl files into a single file
-        jsonl_data = []
-        for jsonl_file in input_path.glob(f"sample_batch*_{type}.jsonl"):
-            print(f"Processing file: {jsonl_file.name}")
-            with jsonl_file.open('r', encoding='utf-8') as f:
-                for line in f:
-                    try:
-                        jl = json.loads(line)
-                        messages = jl.get("messages", [])
-                        for message in messages:
-                            if message['role'] == 'assistant':
-                                if 'clarify' in message.get('content', '').lower():
-                                    print(f"Skipping clarify message in file {jsonl_file.name}: {message['content']}")
-                                    jl=None
-                                    break
-
-                            if "name" in message:
-                                message['name'] = 'system' if message['role'] == 'system' else 'user' if message['role'] == 'user' else 'assistant'
-
-                            #remove id
-                            message.pop('id', None)
-                            #now make sure that there's only a role and content keys in each message and remove the rest
-                            keys_to_keep = ['role', 'content', 'name']
-                            for key in list(message.keys()):
-                                if key not in keys_to_keep:
-                                    message.pop(key, None)
-                        if jl:
-                            jsonl_data.append(jl)
-                    except json.JSONDecodeError as e:
-                        print(f"Error decoding JSON from {jsonl_file.name}: {e}")   
-
-        with output_file.open("w", encoding='utf-8') as f:
-            for item in jsonl_data:
-                f.write(json.dumps(item) + "\n")
-        print(f"✅ {len(jsonl_data)} entries saved to {output_file}")  
-        
-        if all: 
-            with all_output_file.open("a", encoding='utf-8') as f:
-                for item in jsonl_data:
-                    f.write(json.dumps(item) + "\n")
-                    i+=1
+        entries, changed = update_type(input_path, cache_path, type, manifest.get(type, {}))
+        manifest[type] = entries
+        if changed or not output_file.exists():
+            count = assemble(output_file, cache_path, entries)
+            any_changed = True
+            print(f"✅ {count} entries saved to {output_file}")
+        else:
+            count = sum(entry['samples'] for entry in entries.values())
+            print(f"✅ {output_file} is up to date ({count} entries)")
+        i += count
+        if pack:
+            #packing is cheap next to combining, and depends on --max_tokens
+            packed_file = output_path / f"{type.upper()}_packed.jsonl"
+            stats = pack_file(output_file, packed_file, args.max_tokens)
+            saved = 1 - stats['tokens_after'] / stats['tokens_before'] if stats['tokens_before'] else 0.0
+            print(f"✅ {stats['samples']} entries packed into {stats['conversations']} conversations in {packed_file} ({saved:.0%} fewer tokens)")
+
+    write_json_atomic(manifest_path, manifest)
+    remove_unused_cache_files(cache_path, manifest)
+
     if all:
-        print(f"✅ {i} total entries saved to {all_output_file}")
\ No newline at end of file
+        all_output_file = output_path / f"ALL_combined.jsonl"
+        if any_changed or not all_output_file.exists():
+            tmp_file = all_output_file.with_suffix(".tmp")
+            with tmp_file.open("wb") as out:
+                for type in SAMPLE_TYPES:
+                    with (output_path / f"{type.upper()}_combined.jsonl").open("rb") as f:
+                        shutil.copyfileobj(f, out)
+            os.replace(tmp_file, all_output_file)
+        print(f"✅ {i} total entries saved to {all_output_file}")
+        if pack:
+            all_packed_file = output_path / f"ALL_packed.jsonl"
+            tmp_file = all_packed_file.with_suffix(".tmp")
+            with tmp_file.open("wb") as out:
+                for type in SAMPLE_TYPES:
+                    with (output_path / f"{type.upper()}_packed.jsonl").open("rb") as f:
+                        shutil.copyfileobj(f, out)
+            os.replace(tmp_file, all_packed_file)
+            print(f"✅ packed conversations saved to {all_packed_file}")
@@ -0,0 +1,480 @@
+#a compact serialization of the flattened DEVICE STRUCTURE (NuCore.format_nodes()). in the flat text every
+#enum value sits on its own indented line (value lines are more than half of all lines), the same value lists
+#repeat under properties and commands and across devices, and so do whole sections and parameter blocks.
+#the compact form:
+#  - writes the values of an Enum/Range on its header line: "Enum [uom id=25] :: True [0] | False". a value
+#    whose index is one more than the one before leaves it out, and labels that count along with the index
+#    are written as a range: "On  {0..15} / Off 0 [0]"
+#  - moves unit names into a shared table: "Range 0 to 255 [uom id=107]" and "UNITS: 107=1 Byte (Unsigned)"
+#  - defines the value lists (E<n>) and the section and parameter blocks (B<n>) that occur more than once
+#    in a DEFINITIONS header; they are referenced as ":: E1" and ":: B1"
+#compact text keeps every [id=..] and [uom id=..] and expands back to exactly the flat text; a structure that
+#would not is left flat. device_structure.py expands compact text before parsing it.
+
+import json, re
+from pathlib import Path
+from typing import Dict, List, Tuple
+from util import get_data_directory, estimate_tokens
+from device_structure import SECTIONS, extract_device_structure
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+DEFINITIONS_HEADER = "DEFINITIONS (used as :: <name>; values are label [index], unlisted indexes count up by one, {a..b} counts along):"
+SEP = " :: "
+ITEM_SEP = " | "
+UNITS_KEY = "UNITS: "
+MIN_COUNTING_RUN = 4     # shorter counting runs are as short written out
+MIN_VALUES_CHARS = 24    # shorter value lists are not worth a definition
+MIN_BLOCK_CHARS = 80     # neither are shorter blocks
+TOKEN_ENCODING = "o200k_base"
+
+VALUE_RE = re.compile(r"^(?P<indent> *)(?P<label>.*) \[(?P<value>-?[0-9.]+)\]$")
+ITEM_RE = re.compile(r"^(?P<label>.*) \[(?P<value>-?[0-9.]+)\]$")
+COUNTING_RE = re.compile(r"\{(?P<first>[0-9]+)\.\.(?P<last>[0-9]+)\}")
+NUMBER_RE = re.compile(r"[0-9]+")
+INT_RE = re.compile(r"^-?[0-9]+$")
+UNIT_RE = re.compile(r"^(?P<head> *Range .+?) Unit (?P<unit>.+?) \[uom id=(?P<uom>[^\]]+)\](?P<tail>.*)$")
+UOM_RE = re.compile(r"^(?P<head> *Range .+?) \[uom id=(?P<uom>[^\]]+)\](?P<tail>.*)$")
+REF_RE = re.compile(r"^[BE][0-9]+$")
+
+
+def is_compact(text: str) -> bool:
+    return SEP in text
+
+def _is_values_header(stripped: str) -> bool:
+    return stripped.startswith(("Enum", "Range "))
+
+def _is_block_header(stripped: str) -> bool:
+    return stripped in SECTIONS or stripped.startswith("Parameter ")
+
+def _indent(line: str) -> int:
+    return len(line) - len(line.lstrip(" "))
+
+def _next_value(value: str) -> str:
+    return str(int(value) + 1) if INT_RE.match(value) else None
+
+def _format_number(n: int, width: int) -> str:
+    return str(n).zfill(width)
+
+# === values ===
+
+def _counting_run(run: List[Tuple[str, str]], start: int) -> Tuple[int, str]:
+    """
+    Finds the labels from start on that differ from the first one only in one number, which counts by one
+    along with the index. Returns (index of the last one, the label with the number written as {first..last}),
+    or (start, None) if there are fewer than MIN_COUNTING_RUN.
+    """
+    parts = NUMBER_RE.split(run[start][0])
+    numbers = NUMBER_RE.findall(run[start][0])
+    for k, number in enumerate(numbers):
+        #zero padded numbers keep their width
+        width = len(number) if number.startswith("0") else 1
+        def label(field: str) -> str:
+            return "".join(part + (field if i == k else numbers[i]) if i < len(numbers) else part for i, part in enumerate(parts))
+        for step in (1, -1):
+            end = start
+            while end + 1 < len(run) and _next_value(run[end][1]) == run[end + 1][1]:
+                n = int(number) + (end + 1 - start) * step
+                if n < 0 or run[end + 1][0] != label(_format_number(n, width)):
+                    break
+                end += 1
+            if end + 1 - start >= MIN_COUNTING_RUN:
+                return end, label("{" + number + ".." + _format_number(int(number) + (end - start) * step, width) + "}")
+    return start, None
+
+def encode_values(run: List[Tuple[str, str]]) -> str:
+    """
+    Writes (label, index) values on one line. Returns None if a label could not be told apart from the notation.
+    """
+    if any("|" in label or "{" in label or not label.strip() for label, _ in run):
+        return None
+    items = []
+    previous = None
+    i = 0
+    while i < len(run):
+        end, label = _counting_run(run, i)
+        if label is None:
+            label = run[i][0]
+        value = run[i][1]
+        items.append(label if previous is not None and _next_value(previous) == value else f"{label} [{value}]")
+        previous = run[end][1]
+        i = end + 1
+    return ITEM_SEP.join(items)
+
+def decode_values(text: str) -> List[Tuple[str, str]]:
+    run = []
+    previous = None
+    for item in text.split(ITEM_SEP):
+        match = ITEM_RE.match(item)
+        if match:
+            label, value = match.group("label"), match.group("value")
+        else:
+            label, value = item, _next_value(previous) if previous is not None else None
+        if value is None:
+            raise ValueError(f"No index for {item}")
+        counting = COUNTING_RE.search(label)
+        if counting:
+            first, last = counting.group("first"), counting.group("last")
+            width = len(first) if first.startswith("0") else 1
+            step = 1 if int(last) >= int(first) else -1
+            for n in range(int(first), int(last) + step, step):
+                run.append((label[:counting.start()] + _format_number(n, width) + label[counting.end():], value))
+                value = _next_value(value)
+            previous = run[-1][1]
+        else:
+            run.append((label, value))
+            previous = value
+    return run
+
+def _compact_values(lines: List[str]) -> List[str]:
+    out = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        out.append(line)
+        i += 1
+        if not _is_values_header(line.strip()):
+            continue
+        run = []
+        while i + len(run) < len(lines):
+            match = VALUE_RE.match(lines[i + len(run)])
+            if not match or len(match.group("indent")) != _indent(line) + 2:
+                break
+            run.append((match.group("label"), match.group("value")))
+        text = encode_values(run) if run else None
+        if text is not None and decode_values(text) == run:
+            out[-1] = line + SEP + text
+            i += len(run)
+    return out
+
+def _expand_values(lines: List[str]) -> List[str]:
+    out = []
+    for line in lines:
+        head, sep, tail = line.partition(SEP)
+        if not sep or not _is_values_header(head.strip()):
+            out.append(line)
+            continue
+        out.append(head)
+        out.extend(" " * (_indent(head) + 2) + f"{label} [{value}]" for label, value in decode_values(tail))
+    return out
+
+# === units ===
+
+def _compact_units(lines: List[str]) -> Tuple[List[str], Dict[str, str]]:
+    units = {}
+    conflicting = set()
+    for line in lines:
+        match = UNIT_RE.match(line)
+        if match:
+            if units.setdefault(match.group("uom"), match.group("unit")) != match.group("unit"):
+                conflicting.add(match.group("uom"))
+        elif UOM_RE.match(line):
+            #a Range without a unit name could not be told apart once the names are gone
+            conflicting.add(UOM_RE.match(line).group("uom"))
+    units = {uom: unit for uom, unit in units.items() if uom not in conflicting and "|" not in unit and "=" not in uom}
+    out = []
+    for line in lines:
+        match = UNIT_RE.match(line)
+        if match and match.group("uom") in units:
+            line = f"{match.group('head')} [uom id={match.group('uom')}]{match.group('tail')}"
+        out.append(line)
+    return out, units
+
+def _expand_units(lines: List[str], units: Dict[str, str]) -> List[str]:
+    out = []
+    for line in lines:
+        match = UOM_RE.match(line)
+        if match and match.group("uom") in units and " Unit " not in match.group("head"):
+            line = f"{match.group('head')} Unit {units[match.group('uom')]} [uom id={match.group('uom')}]{match.group('tail')}"
+        out.append(line)
+    return out
+
+# === definitions ===
+
+def _iter_blocks(lines: List[str]):
+    """
+    Yields (header index, end index, body) of the blocks (a section or parameter line and the lines indented
+    below it); the body is the lines with their indent relative to the header.
+    """
+    for i, line in enumerate(lines):
+        if not _is_block_header(line.strip()):
+            continue
+        end = i + 1
+        while end < len(lines) and lines[end].strip() and _indent(lines[end]) > _indent(line):
+            end += 1
+        if end > i + 1:
+            yield i, end, tuple(" " * (_indent(body) - _indent(line)) + body.strip() for body in lines[i + 1:end])
+
+def _define_blocks(documents: List[List[str]], definitions: Dict[str, list]) -> List[List[str]]:
+    """
+    Replaces the blocks that occur more than once (outer blocks first) with references to a definition.
+    """
+    counts = {}
+    for lines in documents:
+        for _, _, body in _iter_blocks(lines):
+            counts[body] = counts.get(body, 0) + 1
+    names = {body: name for name, body in definitions.items()}
+    result = []
+    for lines in documents:
+        out = []
+        skip_to = 0
+        for i, end, body in _iter_blocks(lines):
+            if i < skip_to or counts[body] < 2 or sum(map(len, body)) < MIN_BLOCK_CHARS:
+                continue
+            if body not in names:
+                names[body] = f"B{sum(1 for name in definitions if name.startswith('B')) + 1}"
+                definitions[names[body]] = body
+            out.extend(lines[skip_to:i])
+            out.append(lines[i] + SEP + names[body])
+            skip_to = end
+        out.extend(lines[skip_to:])
+        result.append(out)
+    return result
+
+def _define_values(documents: List[List[str]], definitions: Dict[str, list]) -> List[List[str]]:
+    counts = {}
+    for lines in documents:
+        for line in lines:
+            head, sep, tail = line.partition(SEP)
+            if sep and not REF_RE.match(tail):
+                counts[tail] = counts.get(tail, 0) + 1
+    names = {}
+    result = []
+    for lines in documents:
+        out = []
+        for line in lines:
+            head, sep, tail = line.partition(SEP)
+            if sep and counts.get(tail, 0) > 1 and len(tail) >= MIN_VALUES_CHARS:
+                if tail not in names:
+                    names[tail] = f"E{len(names) + 1}"
+                    definitions[names[tail]] = tail
+                line = head + SEP + names[tail]
+            out.append(line)
+        result.append(out)
+    return result
+
+def _expand_blocks(lines: List[str], definitions: Dict[str, object]) -> List[str]:
+    out = []
+    for line in lines:
+        head, sep, tail = line.partition(SEP)
+        if sep and tail.startswith("B") and tail in definitions:
+            out.append(head)
+            #blocks may refer to blocks
+            out.extend(_expand_blocks([" " * _indent(head) + body for body in definitions[tail]], definitions))
+        elif sep and tail.startswith("E") and tail in definitions:
+            out.append(head + SEP + definitions[tail])
+        else:
+            out.append(line)
+    return out
+
+# === structures ===
+
+def compact(text: str) -> str:
+    """
+    The compact form of a flat device structure. Text that is already compact or would not expand back to
+    exactly itself is returned as it is.
+    """
+    if not text or is_compact(text) or DEFINITIONS_HEADER in text:
+        return text
+    lines, units = _compact_units(text.split("\n"))
+    lines = _compact_values(lines)
+    definitions = {}
+    #outer blocks first: a section defined once takes its parameter blocks along
+    main = _define_blocks([lines], definitions)[0]
+    #then the parameter blocks repeated between the defined sections and the rest
+    names = list(definitions)
+    documents = _define_blocks([main] + [list(definitions[name]) for name in names], definitions)
+    main = documents[0]
+    definitions.update(zip(names, map(tuple, documents[1:])))
+    names = list(definitions)
+    documents = _define_values([main] + [list(definitions[name]) for name in names], definitions)
+    definitions.update(zip(names, map(tuple, documents[1:])))
+    header = []
+    units = {uom: unit for uom, unit in units.items() if any(f"[uom id={uom}]" in line and line.lstrip().startswith("Range ")
+                                                             for lines in documents for line in lines)}
+    if units:
+        header.append("  " + UNITS_KEY + ITEM_SEP.join(f"{uom}={unit}" for uom, unit in units.items()))
+    for name, definition in definitions.items():
+        if name.startswith("E"):
+            header.append(f"  {name}{SEP}{definition}")
+    for name, definition in definitions.items():
+        if name.startswith("B"):
+            header.append(f"  {name}:")
+            header.extend("  " + body for body in definition)
+    result = "\n".join(([DEFINITIONS_HEADER] + header if header else []) + documents[0])
+    return result if expand(result) == text else text
+
+def expand(text: str) -> str:
+    """
+    The flat device structure of a compact one. Flat text is returned as it is.
+    """
+    if not is_compact(text) and not text.startswith(DEFINITIONS_HEADER):
+        return text
+    lines = text.split("\n")
+    definitions = {}
+    units = {}
+    if lines[0] == DEFINITIONS_HEADER:
+        i = 1
+        name = None
+        while i < len(lines) and lines[i].startswith("  "):
+            line = lines[i][2:]
+            if line.startswith(UNITS_KEY):
+                units = dict(item.split("=", 1) for item in line[len(UNITS_KEY):].split(ITEM_SEP))
+            elif line.startswith("E") and SEP in line:
+                name, _, values = line.partition(SEP)
+                definitions[name] = values
+            elif line.startswith("B") and line.endswith(":") and not line.startswith(" "):
+                name = line[:-1]
+                definitions[name] = []
+            elif name and name.startswith("B"):
+                definitions[name].append(line)
+            i += 1
+        lines = lines[i:]
+    lines = _expand_blocks(lines, definitions)
+    lines = _expand_values(lines)
+    lines = _expand_units(lines, units)
+    return "\n".join(lines)
+
+# === samples ===
+
+_encoding = {}
+
+def count_tokens(text: str) -> int:
+    """
+    The number of tokens of a text: counted with tiktoken if it is installed, estimated otherwise.
+    """
+    if tiktoken is None:
+        return estimate_tokens(text)
+    if "encoding" not in _encoding:
+        _encoding["encoding"] = tiktoken.get_encoding(TOKEN_ENCODING)
+    return len(_encoding["encoding"].encode(text, disallowed_special=()))
+
+def convert_sample(sample: dict, to_compact: bool = True) -> Tuple[dict, List[Tuple[str, str]]]:
+    """
+    Converts the DEVICE STRUCTURE of every message of a sample to the compact (or back to the flat) form.
+    Returns (the sample, [(old structure, new structure)]).
+    """
+    changes = []
+    for message in sample.get("messages", []):
+        content = message.get("content")
+        if not isinstance(content, str) or "DEVICE STRUCTURE:" not in content:
+            continue
+        structure = extract_device_structure(content)
+        converted = compact(structure) if to_compact else expand(structure)
+        if converted != structure:
+            start = content.find("DEVICE STRUCTURE:") + len("DEVICE STRUCTURE:")
+            message["content"] = content[:start] + converted + content[start + len(structure):]
+        changes.append((structure, converted))
+    return sample, changes
+
+def convert_file(input_file: Path, output_file: Path, to_compact: bool = True) -> Tuple[int, int, int]:
+    """
+    Writes the samples of a JSONL file (plain or compressed, see jsonl_io.py) with converted device structures.
+    Returns (samples, tokens before, tokens after) of the device structures.
+    """
+    from jsonl_io import open_jsonl
+    samples = before = after = 0
+    tmp_file = output_file.with_name(output_file.name + ".tmp")
+    with open_jsonl(input_file, "r") as src, open_jsonl(tmp_file, "w", suffix=output_file.name) as dst:
+        for line in src:
+            if not line.strip():
+                continue
+            try:
+                sample, changes = convert_sample(json.loads(line), to_compact)
+            except Exception as e:
+                #the line is kept as it is
+                print(f"Error converting a sample of {input_file.name}: {e}")
+                dst.write(line if line.endswith("\n") else line + "\n")
+                continue
+            for old, new in changes:
+                before += count_tokens(old)
+                after += count_tokens(new)
+            dst.write(json.dumps(sample) + "\n")
+            samples += 1
+    tmp_file.replace(output_file)
+    return samples, before, after
+
+def report(structures: List[str]) -> dict:
+    """
+    Tokens of the device structures flat and compact. Identical structures are converted once but counted every time they occur.
+    """
+    cache = {}
+    result = {"structures": 0, "flat_tokens": 0, "compact_tokens": 0, "left_flat": 0}
+    for structure in structures:
+        if structure not in cache:
+            flat = expand(structure)
+            compacted = compact(flat)
+            cache[structure] = (count_tokens(flat), count_tokens(compacted), compacted == flat)
+        flat_tokens, compact_tokens, left_flat = cache[structure]
+        result["structures"] += 1
+        result["flat_tokens"] += flat_tokens
+        result["compact_tokens"] += compact_tokens
+        result["left_flat"] += left_flat
+    result["saved"] = 1 - result["compact_tokens"] / result["flat_tokens"] if result["flat_tokens"] else 0.0
+    return result
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    from jsonl_io import glob_jsonl, iter_lines
+    parser = argparse.ArgumentParser(description="Compact device structures: token report and conversion of existing samples.")
+    parser.add_argument("--operation", default="report", type=str, help="report: tokens of the device structures flat and compact, convert: write the samples with compact (or, with --expand, flat) device structures")
+    parser.add_argument("--input_path", default="batched-samples", type=str, help="Directory with JSONL samples. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--nodes_path", type=str, help="report: measure the generation prompts of the nodes in this directory (e.g. customer_data) instead of samples.")
+    parser.add_argument("--output_path", type=str, help="convert: directory for the converted files (same names). Required: the samples are never converted in place.")
+    parser.add_argument("--pattern", default="*", type=str, help="Only the files matching this pattern (without suffix).")
+    parser.add_argument("--expand", default="false", type=str, help="convert: back to the flat form.")
+    args = parser.parse_args()
+
+    operation = args.operation.strip()
+    if operation == "report" and args.nodes_path:
+        from sample_generation import iter_node_chunks
+        print(f"Using {'tiktoken ' + TOKEN_ENCODING if tiktoken else 'estimated'} token counts.")
+        structures = [full_text for _, _, full_text in iter_node_chunks(Path(args.nodes_path))]
+        result = report(structures)
+        print(f"✅ {result['structures']} chunks: {result['flat_tokens']} tokens flat, {result['compact_tokens']} compact ({result['saved']:.0%} saved)")
+    else:
+        input_path = Path(args.input_path)
+        if not input_path.is_absolute():
+            input_path = Path(get_data_directory("datasets", args.input_path))
+        if not input_path.exists() or not input_path.is_dir():
+            raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+        #the stores are read by offset; view or combine them first
+        files = [path for path in glob_jsonl(input_path, args.pattern) if not path.name.startswith("store_")]
+        if operation == "report":
+            print(f"Using {'tiktoken ' + TOKEN_ENCODING if tiktoken else 'estimated'} token counts.")
+            structures = []
+            for path in files:
+                try:
+                    for line in iter_lines(path):
+                        structures.extend(old for old, _ in convert_sample(json.loads(line), False)[1])
+                except Exception as e:
+                    print(f"Error reading {path.name}: {e}")
+            result = report(structures)
+            print(f"✅ {result['structures']} device structures in {len(files)} files: {result['flat_tokens']} tokens flat, "
+                  f"{result['compact_tokens']} compact ({result['saved']:.0%} saved, {result['left_flat']} left flat)")
+        elif operation == "convert":
+            if not args.output_path:
+                raise ValueError("convert needs --output_path")
+            output_path = Path(args.output_path)
+            if output_path.resolve() == input_path.resolve():
+                raise ValueError("convert writes to another directory; --output_path must not be the input path")
+            output_path.mkdir(parents=True, exist_ok=True)
+            to_compact = args.expand.lower() != "true"
+            total = before = after = 0
+            for path in files:
+                try:
+                    samples, tokens_before, tokens_after = convert_file(path, output_path / path.name, to_compact)
+                except Exception as e:
+                    print(f"Error converting {path.name}: {e}")
+                    continue
+                total += samples
+                before += tokens_before
+                after += tokens_after
+            print(f"✅ {total} samples converted to {output_path}: device structures {before} -> {after} tokens")
+        else:
+            print(f"Unknown operation {operation}")
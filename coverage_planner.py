@@ -0,0 +1,219 @@
+#Plans sample generation by coverage instead of regenerating everything on every run.
+#The training prompts ask for samples that cover most (75%) of each device's commands and properties, but
+#nothing checked what the existing samples already cover. This builds a coverage matrix per
+#(node, device, type) from the assistant responses of the existing samples: which accepted commands,
+#properties, sent commands (routine triggers) and uoms they reference. Chunks whose devices are all
+#covered up to the target are skipped; only the others are (re)requested.
+
+import json, re
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+from util import get_data_directory
+from device_structure import Device, parse_device_structure
+from sample_catalog import SampleCatalog
+
+
+COVERAGE_TARGET = 0.75
+
+#what a type of samples is expected to exercise on a device
+TYPE_TARGETS = {
+    "commands": ("command", "command_uom"),
+    "properties": ("property", "property_uom"),
+    "routines": ("command", "property", "control"),
+}
+ALL_TARGETS = ("command", "command_uom", "property", "property_uom", "control")
+
+LEGACY_MARKER_RE = re.compile(r"__(BEGIN|END)_NUCORE_[A-Z_]+__")
+
+_decoder = json.JSONDecoder()
+
+
+def decode_objects(text: str) -> list:
+    """
+    Decodes every JSON object in an assistant response; prose and legacy markers in between are skipped.
+    """
+    text = LEGACY_MARKER_RE.sub("\n", text)
+    objects = []
+    pos = text.find("{")
+    while pos >= 0:
+        try:
+            value, end = _decoder.raw_decode(text, pos)
+            objects.append(value)
+            pos = text.find("{", end)
+        except json.JSONDecodeError:
+            pos = text.find("{", pos + 1)
+    return objects
+
+def get_references(assistant_content: str) -> Set[Tuple[str, str, str]]:
+    """
+    Returns the (kind, device id, id) references in an assistant response, kind being command, property,
+    control or uom. Works for the tool calls (Command, PropQuery, Routine) as well as the legacy blocks
+    since all of them name the device with device_id/device next to the command/property.
+    """
+    references = set()
+
+    def walk(value):
+        if isinstance(value, list):
+            for item in value:
+                walk(item)
+            return
+        if not isinstance(value, dict):
+            return
+        device = value.get("device_id", value.get("device"))
+        if isinstance(device, str):
+            for key, kind in (("command_id", "command"), ("command", "command"), ("control", "control"),
+                              ("property_id", "property"), ("status", "property")):
+                if isinstance(value.get(key), str):
+                    references.add((kind, device, value[key]))
+            uoms = [value.get("uom")]
+            for parameter in (value.get("command_params") or value.get("parameters") or []):
+                if isinstance(parameter, dict):
+                    uoms.append(parameter.get("uom"))
+            for uom in uoms:
+                if uom is not None:
+                    references.add(("uom", device, str(uom)))
+        for item in value.values():
+            walk(item)
+
+    for value in decode_objects(assistant_content):
+        walk(value)
+    return references
+
+def get_targets(device: Device, type: str) -> Set[Tuple[str, str]]:
+    """
+    Returns the (kind, id) pairs a type of samples should cover on a device.
+    """
+    targets = set()
+    kinds = TYPE_TARGETS.get(type, ALL_TARGETS)
+    if "command" in kinds:
+        targets.update(("command", id) for id in device.accept_commands)
+    if "property" in kinds:
+        targets.update(("property", id) for id in device.properties)
+    if "control" in kinds:
+        targets.update(("control", id) for id in device.send_commands)
+    if "command_uom" in kinds:
+        targets.update(("uom", uom) for uoms in device.accept_commands.values() for uom in uoms)
+    if "property_uom" in kinds:
+        targets.update(("uom", uom) for uoms in device.properties.values() for uom in uoms)
+    return targets
+
+
+class CoverageMatrix:
+    """
+    What the existing samples cover, per (node uuid, device id, type): a set of (kind, id) pairs.
+    """
+    def __init__(self):
+        self.covered: Dict[Tuple[str, str, str], Set[Tuple[str, str]]] = {}
+        self.samples = 0
+
+    def add_sample(self, node_uuid: str, type: str, sample: dict):
+        try:
+            assistant_content = sample["messages"][-1]["content"]
+        except Exception:
+            return
+        self.samples += 1
+        for kind, device_id, id in get_references(assistant_content):
+            self.covered.setdefault((node_uuid, device_id, type), set()).add((kind, id))
+
+    def load(self, samples_path: Path, types: Iterable[str] = None, node_uuids: Iterable[str] = None):
+        """
+        Adds the samples of a directory, using its catalog to find the samples (files or store entries) of each node and type.
+        """
+        catalog = SampleCatalog(samples_path)
+        try:
+            catalog.refresh()
+            for row in catalog.select(node_uuids=node_uuids, types=types):
+                if not row["node_uuid"]:
+                    continue
+                try:
+                    for line in catalog.read_lines(row):
+                        if line.strip():
+                            try:
+                                self.add_sample(row["node_uuid"], row["type"], json.loads(line))
+                            except json.JSONDecodeError:
+                                continue
+                except Exception as e:
+                    print(f"Error reading {row['name']}: {e}")
+        finally:
+            catalog.close()
+
+    def device_coverage(self, node_uuid: str, device: Device, type: str) -> float:
+        """
+        Fraction (0..1) of the device's targets for the type that the samples cover. A device with nothing
+        to cover counts as covered.
+        """
+        targets = get_targets(device, type)
+        if not targets:
+            return 1.0
+        covered = self.covered.get((node_uuid, device.id, type), set())
+        return len(targets & covered) / len(targets)
+
+    def chunk_coverage(self, node_uuid: str, full_text: str, type: str) -> float:
+        """
+        The coverage of the least covered device in a chunk.
+        """
+        devices = parse_device_structure(full_text)
+        if not devices:
+            return 0.0
+        return min(self.device_coverage(node_uuid, device, type) for device in devices)
+
+
+def get_node_uuid(node_file: Path) -> str:
+    return node_file.stem.split("-", 1)[-1]
+
+def plan_chunks(node_chunks: List[tuple], type: str, matrix: CoverageMatrix, target: float = COVERAGE_TARGET) -> List[tuple]:
+    """
+    Returns the (node_file, chunk, full_text) chunks (see sample_generation.iter_node_chunks) whose least
+    covered device is below the target for the type.
+    """
+    planned = []
+    for node_file, chunk, full_text in node_chunks:
+        if matrix.chunk_coverage(get_node_uuid(node_file), full_text, type) < target:
+            planned.append((node_file, chunk, full_text))
+    return planned
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    from sample_generation import iter_node_chunks
+    parser = argparse.ArgumentParser(description="Report the coverage of the existing samples and plan which chunks still need samples.")
+    parser.add_argument("--input_path", type=str, help="Path to the directory that holds profiles and nodes directories within. If none given, it will use customer_data.")
+    parser.add_argument("--samples_path", default="batched-samples", type=str, help="Comma separated directories with the existing samples. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--types", type=str, help="Type of training: properties, commands, routines.")
+    parser.add_argument("--nodes", type=str, help="Comma separated node stems or uuids to restrict to.")
+    parser.add_argument("--target", default=COVERAGE_TARGET, type=float, help="Coverage (0..1) every device of a chunk must reach for the chunk to be skipped.")
+    parser.add_argument("--operation", default="plan", type=str, help="report: coverage per node and type, plan: the chunks to generate.")
+    args = parser.parse_args()
+
+    types = [t.strip() for t in args.types.split(",")] if args.types else ["properties", "commands"]
+    nodes = [n.strip() for n in args.nodes.split(",")] if args.nodes else None
+    input_path = Path(args.input_path) if args.input_path else Path(get_data_directory("customer_data", None))
+    if not input_path.exists() or not input_path.is_dir():
+        raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+
+    matrix = CoverageMatrix()
+    for samples_path in args.samples_path.split(","):
+        samples_path = Path(samples_path.strip())
+        if not samples_path.is_absolute():
+            samples_path = Path(get_data_directory("datasets", str(samples_path)))
+        if not samples_path.exists() or not samples_path.is_dir():
+            raise ValueError(f"Samples path {samples_path} does not exist or is not a directory.")
+        matrix.load(samples_path, types=types)
+    print(f"{matrix.samples} existing samples loaded.")
+
+    node_chunks = list(iter_node_chunks(input_path, nodes))
+    for type in types:
+        if args.operation == "report":
+            devices = {}
+            for node_file, _, full_text in node_chunks:
+                node_uuid = get_node_uuid(node_file)
+                for device in parse_device_structure(full_text):
+                    devices.setdefault(node_uuid, []).append(matrix.device_coverage(node_uuid, device, type))
+            for node_uuid, coverages in sorted(devices.items()):
+                below = sum(1 for coverage in coverages if coverage < args.target)
+                print(f"{type} {node_uuid}: {sum(coverages)/len(coverages):.0%} average coverage, {below} of {len(coverages)} devices below {args.target:.0%}")
+        else:
+            planned = plan_chunks(node_chunks, type, matrix, args.target)
+            for node_file, chunk, _ in planned:
+                print(f"{type}: {node_file.stem} chunk {chunk}")
+            print(f"✅ {type}: {len(planned)} of {len(node_chunks)} chunks need samples.")
@@ -4,11 +4,17 @@
 
 from openai import OpenAI
 import json
-import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from nucore import NuCore
 from util import get_data_directory
-from typing import Literal
+from sample_generation import make_request_id, iter_node_chunks, JsonlStreamExtractor
+from prompt_layout import get_prompt_parts, render_messages, restore_references
+from sample_generation import split_request_id, record_completion, get_chunk_size
+from device_structure import split_devices
+from rate_limiter import RateLimitedClient, DEFAULT_RPM, DEFAULT_TPM, DEFAULT_MAX_CONCURRENCY
+from client_pool import ClientPool, make_member, load_members
+from salvage_samples import salvage_lines, TRUNCATED_MARKER
+from typing import Literal, List, Tuple
 
 
 # === CONFIGURATION ===
@@ -21,85 +27,202 @@ if not (SECRETS_DIR / "keys.py").exists():
 
 exec(open(SECRETS_DIR / "keys.py").read())  # This will set OPENAI_API_KEY  
 
-PROMPTS_DIR = Path(get_data_directory("prompts", None))
-if not PROMPTS_DIR.exists():
-    raise FileNotFoundError(f"Prompt directory {PROMPTS_DIR} does not exist. Please use git clone to get everything." ) 
-
 
 #MODEL = "gpt-4o"  # Use the latest model available
 #MODEL = "gpt-5-mini"
 OPENAI_MODEL = "gpt-4.1-mini"
 XAI_MODEL = "grok-code-fast-1"
+XAI_BASE_URL = "https://api.x.ai/v1"
+OPENAI_COST_WEIGHT = 1.0    # relative cost per request, used by the client pool
+XAI_COST_WEIGHT = 0.9
 TEMPERATURE = 1.0
-
-TRAIN_PROMPT = ""
-RUN_PROMPT = ""
-
-global g_client 
-global g_model
-
-g_client = None
-g_model = None
+RPM = DEFAULT_RPM                          # requests per minute per API key
+TPM = DEFAULT_TPM                          # tokens per minute per API key
+MAX_CONCURRENCY = DEFAULT_MAX_CONCURRENCY  # upper bound for the adaptive concurrency window
+STREAM = False                             # stream completions and save each sample as soon as its line is complete
+
+global g_clients
+
+#clients are cached per (service, type) so that each type uses its own OPENAI_API_KEY_{type}
+g_clients = {}
+POOL_CONFIG = []  # extra OpenAI compatible endpoints for the pool, see client_pool.load_members
+
+def get_client_pool():
+    """
+    Builds a pool of every client we have keys for: the OpenAI per-type keys, xAI and any extra
+    OpenAI compatible endpoint from POOL_CONFIG.
+    """
+    members = []
+    seen_keys = set()
+    for name, value in sorted(globals().items()):
+        if name.startswith("OPENAI_API_KEY_") and name != "OPENAI_API_KEY_BATCH" and value and value not in seen_keys:
+            seen_keys.add(value)
+            members.append(make_member(f"openai:{name[len('OPENAI_API_KEY_'):]}", value, OPENAI_MODEL, cost_weight=OPENAI_COST_WEIGHT,
+                                       rpm=RPM, tpm=TPM, max_concurrency=MAX_CONCURRENCY))
+    if globals().get("XAI_API_KEY_SAMPLES"):
+        members.append(make_member("xai", globals()["XAI_API_KEY_SAMPLES"], XAI_MODEL, base_url=XAI_BASE_URL, cost_weight=XAI_COST_WEIGHT,
+                                   rpm=RPM, tpm=TPM, max_concurrency=MAX_CONCURRENCY))
+    members.extend(load_members(POOL_CONFIG, globals()))
+    return ClientPool(members)
 
 def get_client_and_model(service:str, type:str):
-    global g_client, g_model
-    if g_client:
-        return g_client, g_model
-    if not service or service == "openai":
-        g_client = OpenAI(
+    if not service:
+        service = "openai"
+    #the pool serves every type
+    key = (service, None if service == "pool" else type)
+    if key in g_clients:
+        return g_clients[key]
+    if service == "openai":
+        client = RateLimitedClient(OpenAI(
             api_key=globals()[f"OPENAI_API_KEY_{type}"]
-        )  # or use environment variable
-        g_model = OPENAI_MODEL
+        ), rpm=RPM, tpm=TPM, max_concurrency=MAX_CONCURRENCY)  # or use environment variable
+        model = OPENAI_MODEL
     elif service == "xai":
-        g_client = OpenAI(
+        client = RateLimitedClient(OpenAI(
             api_key=globals()[f"XAI_API_KEY_SAMPLES"],  # or use environment variable,
-            base_url="https://api.x.ai/v1",
-        )
-        g_model = XAI_MODEL
+            base_url=XAI_BASE_URL,
+        ), rpm=RPM, tpm=TPM, max_concurrency=MAX_CONCURRENCY)
+        model = XAI_MODEL
+    elif service == "pool":
+        client = get_client_pool()
+        model = "pool" # each pool member uses its own model
     else:
         return None, None
-    return g_client, g_model
-
-
-def setup_prompts(type: Literal["properties", "commands", "routines", "general"]):
-    global TRAIN_PROMPT, RUN_PROMPT
-    TRAIN_PROMPT = ""
-    RUN_PROMPT = ""
-    try:
-        with open(os.path.join(PROMPTS_DIR, f"{type}.prompt.train"), "r") as f:
-            TRAIN_PROMPT = f.read()
-    except:
-        raise ValueError(f"Failed to load training prompt for type {type}.")
-
-    try:
-        with open(os.path.join(PROMPTS_DIR, f"{type}.prompt.run"), "r") as f:
-            RUN_PROMPT = f.read().replace("\n", "\\n")
-    except:
-        raise ValueError(f"Failed to load run prompt for type {type}.")
-
-    ##Now, replace {{NUCORE_BASICS}} in SYSTEM_PROMPT with RUNTIME_SYSTEM_PROMPT
-    TRAIN_PROMPT = TRAIN_PROMPT.replace("{{TEMPLATE_PROMPTS_RUNTIME}}", f"{RUN_PROMPT}")
-
+    g_clients[key] = (client, model)
+    return client, model
+
+
+def setup_prompts(type: Literal["properties", "commands", "routines", "nucore"]):
+    #loads (and caches) the prompts of the type so that a missing prompt fails before any request is made
+    get_prompt_parts(type)
+
+
+def save_salvaged(failed: List[tuple], f, output_path, restore=None) -> int:
+    """
+    Salvages the (error, line) entries that did not decode (restoring their samples with restore, if given
+    and before they are checked), writes the recovered samples to f and records what could not be recovered in the .error file. Returns the number of samples recovered.
+    """
+    samples, unsalvaged = salvage_lines([entry for _, entry in failed], restore)
+    for json_data in samples:
+        f.write(json.dumps(json_data) + "\n")
+    if samples:
+        print(f"Salvaged {len(samples)} samples from {len(failed)} lines that did not decode | {output_path}")
+    errors = {entry: e for e, entry in failed}
+    for entry in unsalvaged:
+        print(f"Error decoding JSON: {errors[entry]} | Entry: {entry}")
+        with open(output_path.with_suffix(".error"), "a") as ef:
+            ef.write(str(errors[entry])+"\n*****\n")
+            ef.write(str(entry)+"\n")
+    return len(samples)
+
+def generate_openpipe_entries_streaming(client, model, messages, output_path, restore=None) -> Tuple[int, str, int]:
+    """
+    Streams the completion and appends every JSONL sample (through restore, if given) to output_path as soon as
+    its line is complete, so the samples received before a late failure (e.g. a timeout) are kept.
+    Returns (the number of entries saved, finish reason, completion tokens); raises if the request failed before
+    anything was saved.
+    """
+    saved = 0
+    finish_reason = None
+    completion_tokens = 0
+    extractor = JsonlStreamExtractor()
+    failed = []    # (error, line) of the lines that did not decode; salvaged once the stream is done
+
+    def save(entries, f):
+        nonlocal saved
+        for json_data, error in entries:
+            if error:
+                failed.append(error)
+                continue
+            f.write(json.dumps(restore(json_data) if restore else json_data) + "\n")
+            f.flush()
+            saved += 1
 
-def generate_openpipe_entries(full_text, output_path, service, type, dump=True):
+    with open(output_path, "w") as f:
+        try:
+            for chunk in client.create_chat_completion_stream(
+                model=model,
+                messages=messages,
+                temperature=TEMPERATURE
+            ):
+                if chunk.choices:
+                    save(extractor.feed(chunk.choices[0].delta.content), f)
+                    finish_reason = chunk.choices[0].finish_reason or finish_reason
+                if getattr(chunk, "usage", None):
+                    completion_tokens = getattr(chunk.usage, "completion_tokens", 0) or 0
+            #a reply cut off at the token limit ends in an incomplete line; do not try to save it
+            if finish_reason != "length":
+                save(extractor.flush(), f)
+        except Exception as e:
+            print(f"Error after {saved} entries: {e} | {output_path}")
+            #the buffer holds the line the stream broke off in; it is kept for inspection, never salvaged
+            with open(output_path.with_suffix(".error"), "a") as ef:
+                ef.write(f"{TRUNCATED_MARKER} {e}"+"\n*****\n")
+                ef.write(extractor.buffer+"\n")
+            if not saved and not failed:
+                raise
+        if failed:
+            saved += save_salvaged(failed, f, output_path, restore)
+    return saved, finish_reason, completion_tokens
+
+def generate_split(full_text, output_path, service, type, stream=None) -> int:
+    """
+    The reply for a chunk was cut off at the token limit: requests its devices again in two halves
+    (recursively, if a half is still too large). Returns the number of entries saved.
+    """
+    documents = split_devices(full_text)
+    if len(documents) < 2:
+        print(f"Reply truncated for a single device; nothing left to split | {output_path}")
+        return 0
+    half = (len(documents) + 1) // 2
+    saved = 0
+    for part, part_documents in zip("ab", (documents[:half], documents[half:])):
+        part_path = output_path.with_name(split_request_id(output_path.stem, part) + output_path.suffix)
+        print(f"Reply truncated; requesting {len(part_documents)} of {len(documents)} devices again in {part_path}")
+        saved += generate_openpipe_entries("".join(part_documents), part_path, service, type, stream=stream) or 0
+    return saved
+
+def generate_openpipe_entries(full_text, output_path, service, type, dump=True, stream=None):
+    """
+    Generates the samples of one device structure into output_path. Returns the number of entries saved, or
+    None if the request failed (no output file is left behind then, so the chunk counts as not generated).
+    """
     #XAI=https://api.x.ai/v1/chat/completions
     client, model = get_client_and_model(service, type)
 
     if not client or not model:
         print ("need service (xai vs. openai) ...") 
         return None
+    if stream is None:
+        stream = STREAM
+    #samples of the prefix layout refer to the runtime system prompt and the device structure
+    restore = lambda json_data: restore_references(type, json_data, full_text)
+    if stream and full_text:
+        messages = render_messages(type, full_text)
+        try:
+            saved, finish_reason, completion_tokens = generate_openpipe_entries_streaming(client, model, messages, output_path, restore)
+        except Exception as e:
+            print(f"Error: {e} | Input: {full_text[:60]}")
+            output_path.unlink(missing_ok=True)
+            return None
+        record_completion(type, len(split_devices(full_text)), completion_tokens, finish_reason == "length")
+        print(f"✅ {saved} entries saved to {output_path}")
+        if finish_reason == "length":
+            saved += generate_split(full_text, output_path, service, type, stream)
+        return saved
+
     jsonl_data = [] 
+    assistant_reply = ""
+    failed = []    # (error, line) of the lines that did not decode
+    truncated = False
+    error = None
 
     if full_text: 
-        # replace <device_info> in the system prompt with the actual device info
-        system_prompt = TRAIN_PROMPT.replace("{{DEVICE_STRUCTURE}}", full_text)
-
         try:
-            messages = [
-                {"role": "system", "content": system_prompt},
-            ]
+            messages = render_messages(type, full_text)
 
-            response = client.chat.completions.create(
+            #retries throttled/failed requests with backoff before giving up
+            response = client.create_chat_completion(
                 model=model,
                 messages=messages,
                 temperature=TEMPERATURE
@@ -108,31 +231,69 @@ def generate_openpipe_entries(full_text, output_path, service, type, dump=True):
             assistant_reply = response.choices[0].message.content.strip()
             if not assistant_reply:
                 ("Assistant reply is empty. Please check the input text.")
+            truncated = response.choices[0].finish_reason == "length"
+            usage = getattr(response, "usage", None)
+            record_completion(type, len(split_devices(full_text)), getattr(usage, "completion_tokens", 0) or 0, truncated)
             # Split the assistant reply into individual JSON objects
             entries = assistant_reply.split("\n")
+            if truncated:
+                #the last line was cut off at the token limit
+                entries = entries[:-1]
             for entry in entries:
                 entry = entry.strip()
                 if entry:
                     try:
                         json_data = json.loads(entry)
-                        jsonl_data.append(json_data)
+                        jsonl_data.append(restore(json_data))
                     except json.JSONDecodeError as e:
-                        print(f"Error decoding JSON: {e} | Entry: {entry}")
-                        with open(output_path.with_suffix(".error"), "w") as f:
-                            f.write(str(e)+"\n*****\n")
-                            f.write(str(entry))
+                        failed.append((e, entry))
 
         except Exception as e:
             print(f"Error: {e} | Input: {full_text[:60]}")
             with open(output_path.with_suffix(".error"), "w") as f:
                 f.write(str(e)+"\n*****\n")
                 f.write(str(assistant_reply))
+            error = e
+
+        if error and not jsonl_data and not failed:
+            return None
 
+        saved = len(jsonl_data)
         with open(output_path, "w") as f:
             for item in jsonl_data:
                 f.write(json.dumps(item) + "\n")
+            if failed:
+                saved += save_salvaged(failed, f, output_path, restore)
+        print(f"✅ {saved} entries saved to {output_path}")
+        if truncated:
+            saved += generate_split(full_text, output_path, service, type, stream)
+        return saved
 
     print(f"✅ {len(jsonl_data)} entries saved to {output_path}")
+    return len(jsonl_data)
+
+def generate_all(items: List[Tuple[str, Path]], service: str, type: str) -> int:
+    """
+    Generates the samples for many (device structure, output file) pairs concurrently.
+    setup_prompts(type) must have been called. Returns the number of entries saved.
+    """
+    #the rate limiter decides how many of these are actually in flight
+    client, _ = get_client_and_model(service, type)
+    total = 0
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY * (len(client.members) if isinstance(client, ClientPool) else 1)) as executor:
+        futures = []
+        for full_text, output_file in items:
+            print(f"Writing to {output_file}")
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            futures.append(executor.submit(generate_openpipe_entries, full_text, output_file, service, type, dump=True))
+        for future in futures:
+            try:
+                total += future.result() or 0
+            except Exception as e:
+                print(f"Error generating entries: {e}")
+    if isinstance(client, ClientPool):
+        client.print_stats()
+    return total
 
 # Example usage
 if __name__ == "__main__":
@@ -141,8 +302,18 @@ if __name__ == "__main__":
     parser.add_argument("--input_path", type=str, help="Path to the directory that holds profiles and nodes directories within. If none given, it will use the default references directory.")
     parser.add_argument("--output_path", type=str, help="Path to the output directory where flattened structures are stored. If none given, it will be printed to stdout.")
     parser.add_argument("--types", type=str, help="Type of training: properties, commands, routines, general.")
-    parser.add_argument("--service", type=str, help="The service to use: xai, openai")
+    parser.add_argument("--service", type=str, help="The service to use: xai, openai, pool (all keys and providers)")
+    parser.add_argument("--pool_config", type=str, help="pool: JSON file with extra OpenAI compatible endpoints (name, base_url, api_key or api_key_var, model, cost_weight, rpm, tpm).")
+    parser.add_argument("--rpm", type=int, default=DEFAULT_RPM, help="Requests per minute allowed per API key.")
+    parser.add_argument("--tpm", type=int, default=DEFAULT_TPM, help="Tokens per minute allowed per API key.")
+    parser.add_argument("--max_concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY, help="Maximum number of concurrent requests; the actual number adapts to throttling.")
+    parser.add_argument("--stream", default="false", type=str, help="Stream completions and save each sample as soon as it is complete.")
     args = parser.parse_args()
+    RPM, TPM, MAX_CONCURRENCY = args.rpm, args.tpm, args.max_concurrency
+    STREAM = args.stream.lower() == "true"
+    if args.pool_config:
+        with open(args.pool_config, "r") as f:
+            POOL_CONFIG = json.load(f)
 
     types = args.types.split(",") if args.types else ["properties", "commands"]
     service = args.service.strip() if args.service else "openai" 
@@ -160,73 +331,12 @@ if __name__ == "__main__":
     if not output_path.exists() or not output_path.is_dir():
         raise ValueError(f"Output path {output_path} does not exist or is not a directory.")
 
-    # now traverse the input directory where you will find profiles and nodes directories
-    # start with files in the nodes directory and then use the name of the file (without extension) to find the corresponding profile in the profiles directory
-    nodes_dir = input_path / "nodes"
-    profiles_dir = input_path / "profiles"
-    if not nodes_dir.exists() or not nodes_dir.is_dir():
-        raise ValueError(f"Nodes directory {nodes_dir} does not exist or is not a directory.")
-    if not profiles_dir.exists() or not profiles_dir.is_dir():
-        raise ValueError(f"Profiles directory {profiles_dir} does not exist or is not a directory.")
-
     for type in types:
         type=type.strip()
         setup_prompts(type)
-        for node_file in nodes_dir.glob("*.xml"):
-            profile_file = profiles_dir / (f"{node_file.stem}.json").replace("nodes-", "profile-")
-            out_file = None if not output_path else output_path / f"{node_file.stem}_finetune.jsonl"
-            
-            print(f"Processing node: {node_file.name} with profile: {profile_file.name}")
-            if not profile_file.exists():
-                print(f"Warning: Profile file {profile_file} does not exist for node {node_file}. Skipping.")
-                continue
-            nuCore = NuCore(collection_path="/tmp/nucore.finetuner", collection_name="finetuner", backend_url="http://localhost:8000", backend_username="admin", backend_password="admin"
-            )
-            try:
-                nuCore.load(include_rag_docs=False, profile_path=profile_file, nodes_path=node_file)
-            except Exception as e:
-                print(f"Error loading NuCore with profile {profile_file} and node {node_file}. Skipping: {e}")
-                continue
-            try:
-                rag = nuCore.format_nodes()
-            except Exception as e:
-                print(f"Error formatting nodes for profile {profile_file} and node {node_file}. Skipping: {e}")
-                continue
-            
-            try:
-                if not rag:
-                    print(f"Warning: No RAG documents found for node {node_file}. Skipping.")
-                    continue
-                rag_docs = rag["documents"]
-                if not rag_docs:
-                    print(f"Warning: No documents found in RAG for node {node_file}. Skipping.")
-                    continue
-
-
-                for i in range(0, len(rag_docs), 3):
-                    batch = rag_docs[i:i+3]
-                    full_text = "".join(batch)
-                    if out_file:
-                        batch_file = out_file.with_stem(f"{out_file.stem}_{i//3 + 1}_{type}")
-                        print(f"Writing to {batch_file}")
-                        batch_file.parent.mkdir(parents=True, exist_ok=True)
-                        generate_openpipe_entries(full_text, batch_file, service, type, dump=True) 
-
-    #            full_text = ""
-    #            for rag_doc in rag_docs:
-    #                full_text += rag_doc
-    #            if out_file:
-    #                print(f"Writing to {out_file}")
-    #                if not out_file.parent.exists():
-    #                    out_file.parent.mkdir(parents=True, exist_ok=True)
-    #                generate_openpipe_entries(full_text, out_file, dump=True)
-
-            except Exception as e:
-                print(f"Error processing RAG documents for node {node_file}. Skipping: {e}")
-                continue    
-                        
-                    
-                    
-     #EXAMPLES.append((node_data, profile_data))
-
-#    generate_openpipe_entries(EXAMPLES, "openpipe_finetune.jsonl")
+        items = []
+        for node_file, chunk, full_text in iter_node_chunks(input_path, chunk_size=get_chunk_size(type)):
+            if output_path:
+                items.append((full_text, output_path / f"{make_request_id(node_file.stem, chunk, type)}.jsonl"))
+        #wait for this type to finish before the prompts are set up for the next one
+        generate_all(items, service, type)
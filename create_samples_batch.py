@@ -2,13 +2,15 @@
 #This way, we do not use unnecessary tokens during inference.
 
 
-from random import random
+import random
 from openai import OpenAI
 import json, os, tempfile
 from pathlib import Path
-from nucore import NuCore
 from util import get_data_directory
-from typing import Literal, List
+from sample_generation import make_request_id, iter_node_chunks, get_chunk_size
+from prompt_layout import get_prompt_parts, render_messages
+from request_index import RequestIndex
+from typing import Literal, List, Tuple
 
 
 # === CONFIGURATION ===
@@ -21,10 +23,6 @@ if not (SECRETS_DIR / "keys.py").exists():
 
 exec(open(SECRETS_DIR / "keys.py").read())  # This will set OPENAI_API_KEY  
 
-PROMPTS_DIR = Path(get_data_directory("prompts", None))
-if not PROMPTS_DIR.exists():
-    raise FileNotFoundError(f"Prompt directory {PROMPTS_DIR} does not exist. Please use git clone to get everything." ) 
-
 
 #MODEL = "gpt-4o"  # Use the latest model available
 #MODEL = "gpt-4.1-mini"
@@ -36,28 +34,9 @@ COMPLETION_WINDOW = "24h"          # 24h or 4h depending on availability in your
 BATCH_MAX_LINES_PER_REQUEST = 900  # max lines per batch request for OpenAI
 
 
-TRAIN_PROMPT = ""
-RUN_PROMPT = ""
-
 def setup_prompts(type: Literal["properties", "commands", "routines", "nucore"]):
-    global TRAIN_PROMPT, RUN_PROMPT
-    TRAIN_PROMPT = ""
-    RUN_PROMPT = ""
-    try:
-        #with open(os.path.join(PROMPTS_DIR, f"{type}.prompt.train"), "r") as f:
-        with open(os.path.join(PROMPTS_DIR, f"{type}.prompt.train"), "r") as f:
-            TRAIN_PROMPT = f.read()
-    except:
-        raise ValueError(f"Failed to load training prompt for type {type}.")
-
-    try:
-        with open(os.path.join(PROMPTS_DIR, f"system.prompt.preamble"), "r") as f:
-            RUN_PROMPT = f.read().replace("\n", "\\n")
-    except:
-        raise ValueError(f"Failed to load run prompt for type {type}.")
-
-    ##Now, replace {{NUCORE_BASICS}} in SYSTEM_PROMPT with RUNTIME_SYSTEM_PROMPT
-    TRAIN_PROMPT = TRAIN_PROMPT.replace("{{TEMPLATE_PROMPTS_RUNTIME}}", f"{RUN_PROMPT}")
+    #loads (and caches) the prompts of the type so that a missing prompt fails before any request is built
+    get_prompt_parts(type)
 
 def make_and_save_batch(client:OpenAI, batch_num:int, lines: List[dict], batched_requests_dir: Path)->str:
     """
@@ -89,16 +68,39 @@ def make_and_save_batch(client:OpenAI, batch_num:int, lines: List[dict], batched
         os.rename(jsonl_path, new_jsonl_path)
         jsonl_path = new_jsonl_path
         print(f"Created batch: {jsonl_path} with id: {batch_id}")
-        return jsonl_path, batch_id
     except Exception as e:
         print(f"Error creating batch for {jsonl_path}: {e}")
         return None, None
+    #index the requests so that failed ones can be resubmitted as is (process_batch_completion.py --operation=retry)
+    try:
+        index = RequestIndex(batched_requests_dir)
+        try:
+            index.add_file(jsonl_path)
+        finally:
+            index.close()
+    except Exception as e:
+        print(f"Error indexing {jsonl_path}: {e}")
+    return jsonl_path, batch_id
+
+def submit_requests(client:OpenAI, requests: List[dict], batched_requests_dir: Path, batch_num:int) -> Tuple[List[Tuple[Path, str]], int]:
+    """
+    Shards the requests into batches of at most BATCH_MAX_LINES_PER_REQUEST lines and submits them.
+    Stops at the first batch that cannot be created.
+    Returns the (request file, batch id) of every submitted batch and the next batch number.
+    """
+    submitted = []
+    for i in range(0, len(requests), BATCH_MAX_LINES_PER_REQUEST):
+        path, id = make_and_save_batch(client, batch_num, requests[i:i+BATCH_MAX_LINES_PER_REQUEST], batched_requests_dir)
+        if path == None or id == None:
+            print(f"Error creating batch {batch_num}. Stopping further processing.")
+            break
+        submitted.append((path, id))
+        batch_num += 1
+    return submitted, batch_num
 
 def generate_request(full_text, request_id, type, dump=True):
 
     if full_text: 
-        # replace <device_info> in the system prompt with the actual device info
-        system_prompt = TRAIN_PROMPT.replace("{{DEVICE_STRUCTURE}}", full_text)
         return {
             "custom_id": request_id,             # must be unique (string)
             "method": "POST",
@@ -106,9 +108,8 @@ def generate_request(full_text, request_id, type, dump=True):
             "body": {
                 "model": MODEL,
                 "temperature": TEMPERATURE,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                ],
+                #static prompt prefix first so that the provider caches it (see prompt_layout.py)
+                "messages": render_messages(type, full_text),
             # add any other Chat Completions params you need:
             "response_format": {"type": "json_object"}
             }
@@ -140,108 +141,25 @@ if __name__ == "__main__":
     if not output_path.exists() or not output_path.is_dir():
         raise ValueError(f"Output path {output_path} does not exist or is not a directory.")
 
-    # now traverse the input directory where you will find profiles and nodes directories
-    # start with files in the nodes directory and then use the name of the file (without extension) to find the corresponding profile in the profiles directory
-    nodes_dir = input_path / "nodes"
-    profiles_dir = input_path / "profiles"
-    if not nodes_dir.exists() or not nodes_dir.is_dir():
-        raise ValueError(f"Nodes directory {nodes_dir} does not exist or is not a directory.")
-    if not profiles_dir.exists() or not profiles_dir.is_dir():
-        raise ValueError(f"Profiles directory {profiles_dir} does not exist or is not a directory.")
-
-    batch_lines = []
     batch_num  = 1
 
     for type in types:
         type=type.strip()
         client = OpenAI(api_key=globals()[f"OPENAI_API_KEY_{type}"])  # or use environment variable
         setup_prompts(type)
+        requests = []
 
         if type == "nucore":
             request_id = f"nucore_generic_{random.randint(1000,9999)}"
             request = generate_request(" ", request_id, type, dump=True)
             if request:
-                batch_lines.append(request)
-                if len(batch_lines) >= BATCH_MAX_LINES_PER_REQUEST:
-                    path, id = make_and_save_batch(client, batch_num, batch_lines, BATCHED_REQUESTS_DIR)
-                    if path == None or id == None:
-                        print(f"Error creating batch for lines for request_id {request_id}. Stopping further processing.")
-                        batch_lines = []
-                        break
-                    batch_lines = []
-                    batch_num += 1
-                #save any remaining lines
-                if batch_lines:
-                    path, id = make_and_save_batch(client, batch_num, batch_lines, BATCHED_REQUESTS_DIR)
-                    if path == None or id == None:
-                        print(f"Error creating final batch for lines for request_id {request_id}. Stopping further processing.")
-                        batch_lines = []
-                    else:
-                        batch_num += 1
-                batch_lines = []
-            exit(0)
-
-        for node_file in nodes_dir.glob("*.xml"):
-            profile_file = profiles_dir / (f"{node_file.stem}.json").replace("nodes-", "profile-")
-            out_file = f"{node_file.stem}_finetune"
-            
-            print(f"Processing node: {node_file.name} with profile: {profile_file.name}")
-            if not profile_file.exists():
-                print(f"Warning: Profile file {profile_file} does not exist for node {node_file}. Skipping.")
-                continue
-            nuCore = NuCore(collection_path="/tmp/nucore.finetuner", collection_name="finetuner", backend_url="http://localhost:8000", backend_username="admin", backend_password="admin"
-            )
-            try:
-                nuCore.load(include_rag_docs=False, profile_path=profile_file, nodes_path=node_file)
-            except Exception as e:
-                print(f"Error loading NuCore with profile {profile_file} and node {node_file}. Skipping: {e}")
-                continue
-            try:
-                rag = nuCore.format_nodes()
-            except Exception as e:
-                print(f"Error formatting nodes for profile {profile_file} and node {node_file}. Skipping: {e}")
-                continue
-            
-            try:
-                if not rag:
-                    print(f"Warning: No RAG documents found for node {node_file}. Skipping.")
-                    continue
-                rag_docs = rag["documents"]
-                if not rag_docs:
-                    print(f"Warning: No documents found in RAG for node {node_file}. Skipping.")
-                    continue
-                for i in range(0, len(rag_docs), 3):
-                    batch = rag_docs[i:i+3]
-                    full_text = "".join(batch)
-                    if out_file:
-                        request_id = f"{out_file}_{i//3 + 1}_{type}"
-                        print(f"Writing to {request_id}")
-                        request = generate_request(full_text, request_id, type, dump=True)
-                        if request:
-                            batch_lines.append(request)
-                            if len(batch_lines) >= BATCH_MAX_LINES_PER_REQUEST:
-                                path, id = make_and_save_batch(client, batch_num, batch_lines, BATCHED_REQUESTS_DIR)
-                                if path == None or id == None:
-                                    print(f"Error creating batch for lines for request_id {request_id}. Stopping further processing.")
-                                    batch_lines = []
-                                    break
-                                batch_lines = []
-                            batch_num += 1
-                #save any remaining lines
-                if batch_lines:
-                    path, id = make_and_save_batch(client, batch_num, batch_lines, BATCHED_REQUESTS_DIR)
-                    if path == None or id == None:
-                        print(f"Error creating final batch for lines for request_id {request_id}. Stopping further processing.")
-                        batch_lines = []
-                        break
-                    batch_num += 1
-
-            except Exception as e:
-                print(f"Error processing RAG documents for node {node_file}. Skipping: {e}")
-                continue    
-                        
-                    
-                    
-     #EXAMPLES.append((node_data, profile_data))
-
-#    generate_openpipe_entries(EXAMPLES, "openpipe_finetune.jsonl")
+                requests.append(request)
+        else:
+            for node_file, chunk, full_text in iter_node_chunks(input_path, chunk_size=get_chunk_size(type)):
+                request_id = make_request_id(node_file.stem, chunk, type)
+                print(f"Writing to {request_id}")
+                request = generate_request(full_text, request_id, type, dump=True)
+                if request:
+                    requests.append(request)
+
+        _, batch_num = submit_requests(client, requests, BATCHED_REQUESTS_DIR, batch_num)
@@ -4,6 +4,7 @@
 #1 directory - path to the directory holding these files (not recursive)
 #2 batch NOT to be removed 
 #3 the extension of the files (properties, commands, routines) 
+#the files are looked up in the sample catalog (see sample_catalog.py) instead of listing the directory per node
 
 if [ -z "$1" ] || [ -z "$2" ] || [ "$1" = "" ] || [ "$2" = "" ] || [ -z "$3" ] || [ "$3" = "" ]
 then
@@ -11,15 +12,5 @@ then
 	exit 1 
 fi
 
-for f in `ls ../customer_data/nodes/*.xml`; do
-	uuid=$(basename $f .xml | awk -F '-' '{print $2;}')
-	echo "processing ${uuid}"
-	cd $1
-
-	ls *${uuid}*${3}* | grep -v $2 | while read sample; do
-			echo "removing $sample"
-			rm -- "$sample"
-	done
-	cd -
-done
-
+DIR=$(dirname "$0")
+python3 "$DIR/../sample_catalog.py" --operation=prune --input_path="$(realpath "$1")" --keep_batch="$2" --types="$3" --nodes_path="$(realpath ../customer_data/nodes)"
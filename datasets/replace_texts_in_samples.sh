@@ -1,5 +1,6 @@
 #!/bin/sh
 #Replaces texts in files of certain pattern
+#All the replacements are listed in replace_rules.json and applied in a single pass per file
 #1. relative path to the directory
 #2. the pattern of files to look at 
 
@@ -9,13 +10,5 @@ then
 	exit 1 
 fi
 
-./replace_text_in_samples.sh "$1" "$2" '"name of ambiguous event 1"}' '"name of ambiguous event 1\\"}'
-./replace_text_in_samples.sh "$1" "$2" '"name of ambiguous event 2"}' '"name of ambiguous event 2\\"}'
-./replace_text_in_samples.sh "$1" "$2" '"name of possible device 1"}' '"name of possible device 1\\"}'
-./replace_text_in_samples.sh "$1" "$2" '"name of possible device 2"}' '"name of possible device 2\\"}'
-./replace_text_in_samples.sh "$1" "$2" 'contextal' 'contextual'
-./replace_text_in_samples.sh "$1" "$2" 'Aways' 'Always'
-./replace_text_in_samples.sh "$1" "$2" '=! (is not)' '!= (is not), is, is not' 
-./replace_text_in_samples.sh "$1" "$2" 'IS' '==' 
-./replace_text_in_samples.sh "$1" "$2" '=!' '!=' 
-
+DIR=$(dirname "$0")
+python3 "$DIR/../rewrite_samples.py" --input_path="$(realpath "$1")" --pattern="$2" --rules="$DIR/replace_rules.json"
@@ -0,0 +1,122 @@
+#Parses the flattened DEVICE STRUCTURE text produced by NuCore.format_nodes() back into devices:
+#    ***Device***
+#    Name: Ext Light - Laundry Door
+#    ID: 2A 60 99 1
+#      ***Properties***
+#        Status [id=ST]
+#          Enum [uom id=51]
+#      ***Accept Commands***
+#        On [id=DON]
+#            Parameter 1: name=n/a [id=n/a]
+#              Enum [uom id=51]
+#      ***Send Commands***
+#        On [id=DON]
+
+import re
+from typing import Dict, List, Set
+
+
+DEVICE_MARKER = "***Device***"
+SECTIONS = {
+    "***Properties***": "properties",
+    "***Accept Commands***": "accept_commands",
+    "***Send Commands***": "send_commands",
+}
+
+ID_RE = re.compile(r"\[id=([^\]]+)\]")
+UOM_RE = re.compile(r"\[uom id=([^\]]+)\]")
+
+
+class Device:
+    """
+    One device block: its id and name, the ids of its properties, accepted and sent commands
+    and, per property/accepted command, the uom ids of its values/parameters.
+    """
+    def __init__(self, id: str, name: str, text: str):
+        self.id = id
+        self.name = name
+        self.text = text
+        self.properties: Dict[str, Set[str]] = {}
+        self.accept_commands: Dict[str, Set[str]] = {}
+        self.send_commands: Dict[str, Set[str]] = {}
+
+    @property
+    def uoms(self) -> Set[str]:
+        uoms = set()
+        for entries in (self.properties, self.accept_commands):
+            for entry_uoms in entries.values():
+                uoms.update(entry_uoms)
+        return uoms
+
+    def __repr__(self):
+        return f"Device({self.id!r}, {self.name!r}, {len(self.properties)} properties, {len(self.accept_commands)} commands)"
+
+
+def split_devices(text: str) -> List[str]:
+    """
+    Splits a device structure into device blocks, each starting with ***Device***.
+    """
+    return [DEVICE_MARKER + block for block in text.split(DEVICE_MARKER)[1:]]
+
+def parse_device(block: str) -> Device:
+    """
+    Parses one device block. Returns None if the block has no ID line.
+    """
+    name = None
+    id = None
+    section = None
+    entry = None
+    entries = {}
+    for line in block.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped == DEVICE_MARKER:
+            continue
+        if id is None and stripped.startswith("Name:") and name is None:
+            name = stripped[len("Name:"):].strip()
+        elif id is None and stripped.startswith("ID:"):
+            id = stripped[len("ID:"):].strip()
+        elif stripped in SECTIONS:
+            section = SECTIONS[stripped]
+            entries[section] = {}
+            entry = None
+        elif section:
+            uom = UOM_RE.search(stripped)
+            if uom:
+                if entry is not None:
+                    entries[section][entry].add(uom.group(1))
+                continue
+            match = ID_RE.search(stripped)
+            #parameter lines ("Parameter 1: name=n/a [id=n/a]") belong to the command above them
+            if match and not stripped.startswith("Parameter"):
+                entry = match.group(1)
+                entries[section].setdefault(entry, set())
+    if id is None:
+        return None
+    device = Device(id, name, block)
+    device.properties = entries.get("properties", {})
+    device.accept_commands = entries.get("accept_commands", {})
+    device.send_commands = entries.get("send_commands", {})
+    return device
+
+def get_signature(device: Device) -> str:
+    """
+    A device's definition without its name and id: devices with the same signature are of the same type.
+    """
+    lines = [line.strip() for line in device.text.splitlines()]
+    return "\n".join(line for line in lines if line and not line.startswith(("Name:", "ID:")))
+
+def parse_device_structure(text: str) -> List[Device]:
+    #compact structures (see compact_structure.py) are parsed in their flat form
+    from compact_structure import expand
+    return [device for device in map(parse_device, split_devices(expand(text))) if device]
+
+def extract_device_structure(user_content: str) -> str:
+    """
+    Returns the DEVICE STRUCTURE part of a sample's user message.
+    """
+    start = user_content.find("DEVICE STRUCTURE:")
+    if start < 0:
+        return ""
+    start += len("DEVICE STRUCTURE:")
+    end = user_content.find("USER QUERY:", start)
+    return user_content[start:end if end >= 0 else len(user_content)]
@@ -0,0 +1,194 @@
+#computes what changed between two versions of the combined dataset, so that a new model version only needs the
+#delta uploaded next to the previous one. a version is a combined file or a directory of <TYPE>_combined.jsonl
+#files of the sample types (ALL_ and SELECTED_combined.jsonl are skipped there: they repeat the others, see
+#sample_table.get_combined_files). samples are compared by a hash of their
+#normalized messages (role and content, whitespace collapsed), so re-combining, key order or reformatted
+#whitespace do not count as changes; repeated samples are compared as multisets.
+#memory stays bounded for any size: both versions are streamed once into BUCKETS temporary partitions of
+#(hash, file, offset) by hash prefix, and the partitions are compared one pair at a time. the added and removed
+#samples are then copied by offset, in their original order, to added.jsonl and removed.jsonl.
+#changes are summarized per type and per node; the node of a sample is looked up by its DEVICE STRUCTURE in the
+#sample catalog (a node's structures are the chunks of its devices, so their number stays small).
+
+import hashlib, json, os, shutil, tempfile
+from array import array
+from pathlib import Path
+from typing import Dict, List
+from util import get_data_directory
+from device_structure import extract_device_structure
+from sample_catalog import SampleCatalog
+from select_samples import get_type
+
+
+BUCKETS = 64
+COMBINED_PATTERN = "*_combined.jsonl"
+
+
+def get_sample_hash(sample: dict) -> str:
+    messages = [(message.get("role"), " ".join(str(message.get("content") or "").split())) for message in sample["messages"]]
+    return hashlib.sha1(json.dumps(messages, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def get_structure_hash(sample: dict) -> str:
+    structure = extract_device_structure(sample["messages"][1]["content"])
+    return hashlib.sha1(" ".join(structure.split()).encode("utf-8")).hexdigest()[:16]
+
+def get_version_files(path: Path) -> List[Path]:
+    if path.is_dir():
+        return sorted(file for file in path.glob(COMBINED_PATTERN) if get_type(file) != "all")
+    return [path]
+
+def load_node_map(samples_path: Path) -> Dict[str, str]:
+    """
+    The node uuid of every device structure in the samples directory: {structure hash: node uuid}.
+    """
+    nodes = {}
+    catalog = SampleCatalog(samples_path)
+    try:
+        catalog.refresh()
+        for row in catalog.select():
+            if not row["node_uuid"]:
+                continue
+            try:
+                lines = catalog.read_lines(row)
+            except Exception as e:
+                print(f"Error reading {row['name']}: {e}")
+                continue
+            for line in lines:
+                try:
+                    nodes[get_structure_hash(json.loads(line))] = row["node_uuid"]
+                except Exception:
+                    continue
+    finally:
+        catalog.close()
+    return nodes
+
+def partition(files: List[Path], work_path: Path, name: str, buckets: int = BUCKETS) -> int:
+    """
+    Streams the samples of a version into bucket files of "hash file offset" lines. Returns the samples read.
+    """
+    outs = [(work_path / f"{name}_{i}.txt").open("w", encoding="utf-8") for i in range(buckets)]
+    count = 0
+    try:
+        for file_number, file in enumerate(files):
+            with open(file, "rb") as f:
+                offset = 0
+                for line in f:
+                    start, offset = offset, offset + len(line)
+                    if not line.strip():
+                        continue
+                    try:
+                        sample_hash = get_sample_hash(json.loads(line))
+                    except Exception as e:
+                        print(f"Skipping a sample of {file.name} at {start}: {e}")
+                        continue
+                    outs[int(sample_hash[:8], 16) % buckets].write(f"{sample_hash} {file_number} {start}\n")
+                    count += 1
+    finally:
+        for out in outs:
+            out.close()
+    return count
+
+def compare_buckets(work_path: Path, buckets: int = BUCKETS):
+    """
+    Compares the old and new partitions bucket by bucket. Returns (added, removed) as {file number: offsets}.
+    """
+    added = {}
+    removed = {}
+    for i in range(buckets):
+        old = {}
+        with (work_path / f"old_{i}.txt").open("r", encoding="utf-8") as f:
+            for line in f:
+                sample_hash, file_number, offset = line.split()
+                old.setdefault(sample_hash, []).append((int(file_number), int(offset)))
+        with (work_path / f"new_{i}.txt").open("r", encoding="utf-8") as f:
+            for line in f:
+                sample_hash, file_number, offset = line.split()
+                if old.get(sample_hash):
+                    old[sample_hash].pop()
+                else:
+                    added.setdefault(int(file_number), array("q")).append(int(offset))
+        for locations in old.values():
+            for file_number, offset in locations:
+                removed.setdefault(file_number, array("q")).append(offset)
+    return added, removed
+
+def write_delta(files: List[Path], offsets: Dict[int, array], output_file: Path, nodes: Dict[str, str], summary: dict, change: str) -> int:
+    """
+    Copies the samples at offsets to output_file in file and offset order and counts them per type and node.
+    """
+    count = 0
+    tmp_file = output_file.with_suffix(".tmp")
+    with tmp_file.open("wb") as out:
+        for file_number in sorted(offsets):
+            type = get_type(files[file_number])
+            with open(files[file_number], "rb") as f:
+                for offset in sorted(offsets[file_number]):
+                    f.seek(offset)
+                    line = f.readline().rstrip(b"\r\n")
+                    out.write(line + b"\n")
+                    count += 1
+                    try:
+                        node = nodes.get(get_structure_hash(json.loads(line)), "unknown")
+                    except Exception:
+                        node = "unknown"
+                    for key in (("type", type), ("node", node)):
+                        entry = summary.setdefault(key, {"added": 0, "removed": 0})
+                        entry[change] += 1
+    os.replace(tmp_file, output_file)
+    return count
+
+def diff(old_path: Path, new_path: Path, output_path: Path, nodes: Dict[str, str] = None, buckets: int = BUCKETS) -> dict:
+    """
+    Writes added.jsonl and removed.jsonl of new_path against old_path to output_path.
+    Returns the counts and the summary {("type" or "node", name): {"added": n, "removed": n}}.
+    """
+    old_files = get_version_files(old_path)
+    new_files = get_version_files(new_path)
+    nodes = nodes or {}
+    work_path = Path(tempfile.mkdtemp(prefix=".diff_", dir=output_path))
+    try:
+        old_count = partition(old_files, work_path, "old", buckets)
+        new_count = partition(new_files, work_path, "new", buckets)
+        added, removed = compare_buckets(work_path, buckets)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    summary = {}
+    return {
+        "old": old_count,
+        "new": new_count,
+        "added": write_delta(new_files, added, output_path / "added.jsonl", nodes, summary, "added"),
+        "removed": write_delta(old_files, removed, output_path / "removed.jsonl", nodes, summary, "removed"),
+        "summary": summary,
+    }
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Diff two versions of the combined dataset: write the added and removed samples and summarize them per type and node.")
+    parser.add_argument("--old", required=True, type=str, help="The previous version: a combined file or a directory of <TYPE>_combined.jsonl files.")
+    parser.add_argument("--new", default="samples", type=str, help="The new version. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--output_path", required=True, type=str, help="Directory for added.jsonl and removed.jsonl.")
+    parser.add_argument("--samples_path", default="batched-samples", type=str, help="Samples directory whose catalog maps device structures to nodes; empty to skip the per node summary.")
+    parser.add_argument("--buckets", default=BUCKETS, type=int, help="Partitions; memory use is about one partition of each version.")
+    args = parser.parse_args()
+
+    paths = []
+    for name in (args.old, args.new, args.output_path):
+        path = Path(name)
+        path = path if path.is_absolute() else Path(get_data_directory("datasets", name))
+        if not path.exists():
+            raise ValueError(f"Path {path} does not exist.")
+        paths.append(path)
+    old_path, new_path, output_path = paths
+
+    nodes = {}
+    if args.samples_path:
+        samples_path = Path(args.samples_path)
+        samples_path = samples_path if samples_path.is_absolute() else Path(get_data_directory("datasets", args.samples_path))
+        if samples_path.is_dir():
+            nodes = load_node_map(samples_path)
+
+    result = diff(old_path, new_path, output_path, nodes, args.buckets)
+    for (kind, name), counts in sorted(result["summary"].items()):
+        print(f"{kind} {name}: +{counts['added']} -{counts['removed']}")
+    print(f"✅ {result['old']} -> {result['new']} samples: {result['added']} added, {result['removed']} removed, saved to {output_path}")
@@ -0,0 +1,202 @@
+#scores a fine-tuned model on held-out samples: every sample's system and user messages are replayed against an
+#OpenAI compatible endpoint (OpenAI, or a local llama.cpp server running the quantized GGUF: --base_url=
+#http://localhost:8080/v1) and the reply is compared with the sample's assistant message.
+#  - exact: the reply references exactly the commands/properties/controls per device the sample's does
+#    (coverage_planner.get_references), precision and recall of those references across all samples
+#  - grounded: every command/property/control the reply references exists on that device in the DEVICE STRUCTURE
+#  - json: the reply holds at least one JSON object that decodes (what counts for routines)
+#requests run concurrently (bounded by --max_concurrency, through the rate limited client) and are streamed, so
+#latency, time to first token and tokens/sec are measured per request, from the moment the request is sent: time
+#spent waiting for a slot or for the --rpm/--tpm budgets (unlimited by default, for local servers) does not count.
+
+import json, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterator, List, Tuple
+from openai import OpenAI
+from util import get_data_directory, estimate_tokens
+from rate_limiter import RateLimitedClient
+from device_structure import parse_device_structure, extract_device_structure
+from coverage_planner import get_references, decode_objects
+from pack_conversations import unpack_conversation
+from select_samples import get_type
+
+
+BASE_URL = "http://localhost:8080/v1"    # llama.cpp server
+MODEL = "nucore"
+MAX_CONCURRENCY = 8
+MAX_TOKENS = 2_000
+TEMPERATURE = 0.0
+UNLIMITED = 10**9    # rpm/tpm of endpoints without rate limits (a local server)
+
+#the kinds of references an answer is judged on; uoms follow from the command and are not scored separately
+SCORED_KINDS = ("command", "property", "control")
+SECTIONS = {"command": "accept_commands", "property": "properties", "control": "send_commands"}
+
+
+def iter_samples(input_file: Path, limit: int = None) -> Iterator[dict]:
+    """
+    The single turn samples of a combined (or packed) file.
+    """
+    count = 0
+    with open(input_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                samples = unpack_conversation(json.loads(line))
+            except json.JSONDecodeError as e:
+                print(f"Error decoding JSON from {input_file.name}: {e}")
+                continue
+            for sample in samples:
+                messages = sample.get("messages") if isinstance(sample, dict) else None
+                if not isinstance(messages, list) or len(messages) != 3 or messages[2].get("role") != "assistant":
+                    continue
+                yield sample
+                count += 1
+                if limit and count >= limit:
+                    return
+
+def get_scored_references(content: str) -> set:
+    return {reference for reference in get_references(content) if reference[0] in SCORED_KINDS}
+
+def score(sample: dict, reply: str) -> dict:
+    """
+    Compares a reply with the sample's assistant message.
+    """
+    expected = get_scored_references(sample["messages"][2]["content"])
+    predicted = get_scored_references(reply)
+    devices = {device.id: device for device in parse_device_structure(extract_device_structure(sample["messages"][1]["content"]))}
+    grounded = all(device_id in devices and id in getattr(devices[device_id], SECTIONS[kind]) for kind, device_id, id in predicted)
+    return {
+        "exact": expected == predicted,
+        "expected": len(expected),
+        "predicted": len(predicted),
+        "correct": len(expected & predicted),
+        "grounded": grounded,
+        "json": bool(decode_objects(reply)),
+    }
+
+def evaluate_sample(client: RateLimitedClient, model: str, sample: dict, max_tokens: int = MAX_TOKENS) -> dict:
+    """
+    Streams the reply to one sample and scores it. Returns the scores with latency, time to first token and tokens.
+    """
+    start = None
+    first_token = None
+    parts = []
+    completion_tokens = 0
+
+    def on_send():
+        #a retried request is timed from its last attempt
+        nonlocal start
+        start = time.monotonic()
+
+    for chunk in client.create_chat_completion_stream(on_send=on_send, model=model, messages=sample["messages"][:2], temperature=TEMPERATURE, max_tokens=max_tokens):
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token is None:
+                first_token = time.monotonic() - start
+            parts.append(chunk.choices[0].delta.content)
+        if getattr(chunk, "usage", None):
+            completion_tokens = getattr(chunk.usage, "completion_tokens", 0) or 0
+    latency = time.monotonic() - start
+    reply = "".join(parts)
+    result = score(sample, reply)
+    #servers that do not report usage in streams get the estimate
+    result.update(reply=reply, latency=latency, first_token=first_token if first_token is not None else latency,
+                  completion_tokens=completion_tokens or estimate_tokens(reply))
+    return result
+
+def evaluate(client: RateLimitedClient, model: str, samples: List[Tuple[str, dict]], max_concurrency: int = MAX_CONCURRENCY,
+             max_tokens: int = MAX_TOKENS, output_file: Path = None) -> Tuple[List[dict], float]:
+    """
+    Evaluates the (type, sample) items concurrently. Returns the results (with type and index) and the wall time.
+    """
+    results = []
+    start = time.monotonic()
+    out = output_file.open("w", encoding="utf-8") if output_file else None
+    try:
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            futures = {executor.submit(evaluate_sample, client, model, sample, max_tokens): (i, type) for i, (type, sample) in enumerate(samples)}
+            for future in as_completed(futures):
+                i, type = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error evaluating sample {i}: {e}")
+                    result = {"error": str(e)}
+                result.update(index=i, type=type)
+                results.append(result)
+                if out:
+                    out.write(json.dumps(result) + "\n")
+                if len(results) % 100 == 0:
+                    print(f"{len(results)} of {len(samples)} samples evaluated")
+    finally:
+        if out:
+            out.close()
+    return results, time.monotonic() - start
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+def summarize(results: List[dict]) -> dict:
+    done = [result for result in results if "error" not in result]
+    expected = sum(result["expected"] for result in done)
+    predicted = sum(result["predicted"] for result in done)
+    correct = sum(result["correct"] for result in done)
+    generation = sum(max(result["latency"] - result["first_token"], 1e-6) for result in done)
+    return {
+        "samples": len(results),
+        "errors": len(results) - len(done),
+        "exact": sum(result["exact"] for result in done) / max(len(done), 1),
+        "precision": correct / predicted if predicted else 0.0,
+        "recall": correct / expected if expected else 0.0,
+        "grounded": sum(result["grounded"] for result in done) / max(len(done), 1),
+        "json": sum(result["json"] for result in done) / max(len(done), 1),
+        "latency_p50": percentile([result["latency"] for result in done], 0.5),
+        "latency_p95": percentile([result["latency"] for result in done], 0.95),
+        "first_token_p50": percentile([result["first_token"] for result in done], 0.5),
+        "tokens_per_second": sum(result["completion_tokens"] for result in done) / generation if done else 0.0,
+    }
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Evaluate a fine-tuned model on held-out samples against an OpenAI compatible endpoint.")
+    parser.add_argument("--input_files", required=True, type=str, help="Comma separated held-out combined (or packed) files. Relative paths are resolved against datasets/samples.")
+    parser.add_argument("--base_url", default=BASE_URL, type=str, help="The OpenAI compatible endpoint.")
+    parser.add_argument("--api_key", default="none", type=str, help="API key of the endpoint (a local server ignores it).")
+    parser.add_argument("--model", default=MODEL, type=str, help="The model name to send.")
+    parser.add_argument("--max_concurrency", default=MAX_CONCURRENCY, type=int, help="Requests in flight at most.")
+    parser.add_argument("--max_tokens", default=MAX_TOKENS, type=int, help="Completion tokens per request at most.")
+    parser.add_argument("--rpm", default=0, type=int, help="Requests per minute allowed by the endpoint; 0 for unlimited (a local server).")
+    parser.add_argument("--tpm", default=0, type=int, help="Tokens per minute allowed by the endpoint; 0 for unlimited (a local server).")
+    parser.add_argument("--limit", type=int, help="Only the first samples of each file.")
+    parser.add_argument("--output_file", type=str, help="JSONL file for the reply and scores of every sample.")
+    args = parser.parse_args()
+
+    samples_path = Path(get_data_directory("datasets", "samples"))
+    samples = []
+    for name in args.input_files.split(","):
+        input_file = Path(name.strip())
+        input_file = input_file if input_file.is_absolute() else samples_path / input_file
+        if not input_file.exists():
+            raise ValueError(f"Input file {input_file} does not exist.")
+        type = get_type(input_file)
+        samples.extend((type, sample) for sample in iter_samples(input_file, args.limit))
+
+    client = RateLimitedClient(OpenAI(api_key=args.api_key, base_url=args.base_url), rpm=args.rpm or UNLIMITED, tpm=args.tpm or UNLIMITED,
+                               max_concurrency=args.max_concurrency)
+    results, wall = evaluate(client, args.model, samples, args.max_concurrency, args.max_tokens, Path(args.output_file) if args.output_file else None)
+
+    types = sorted({result["type"] for result in results})
+    for type in types + (["all"] if len(types) > 1 else []):
+        summary = summarize([result for result in results if type == "all" or result["type"] == type])
+        print(f"{type}: {summary['samples']} samples, {summary['errors']} errors, exact {summary['exact']:.1%}, "
+              f"precision {summary['precision']:.1%}, recall {summary['recall']:.1%}, grounded {summary['grounded']:.1%}, json {summary['json']:.1%}, "
+              f"latency p50 {summary['latency_p50']:.2f}s p95 {summary['latency_p95']:.2f}s, first token p50 {summary['first_token_p50']:.2f}s, "
+              f"{summary['tokens_per_second']:.1f} tokens/s")
+    total_tokens = sum(result.get("completion_tokens", 0) for result in results)
+    print(f"✅ {len(results)} samples evaluated in {wall:.1f}s ({total_tokens / max(wall, 1e-6):.1f} tokens/s overall)")
@@ -0,0 +1,191 @@
+#One entry point for sample generation that decides, per type, whether to run the requests synchronously
+#(create_samples.py: concurrent chat completions, results in minutes) or through the Batch API
+#(create_samples_batch.py: half the price, results within the 24h completion window).
+#Small or urgent workloads (e.g. a handful of changed nodes) go synchronous, large ones are sharded into
+#batches. Synchronous results are written with the same sample layout the batch processing produces
+#(sample_<batch id>_output_<custom id>.jsonl in batched-samples), so check/combine do not care which path was used.
+#With --coverage_target only the chunks whose devices are not yet covered by the existing samples are requested
+#(see coverage_planner.py). With --incremental only the devices that were added or changed since the last
+#incremental run are requested; the node state only takes the new chunks once their samples exist (right away for
+#sync, when process_batch_completion.py or the work_queue.py workers save them otherwise), and only then are the
+#samples of chunks whose devices changed or were removed retired.
+#With --mode=queue the requests are added to the shared work queue instead (see work_queue.py) and generated by
+#any number of work_queue.py workers, on this host or others.
+
+import time
+from datetime import datetime
+from pathlib import Path
+from openai import OpenAI
+from util import get_data_directory
+from sample_generation import make_request_id, sample_file_name, iter_node_documents, chunk_documents
+from sample_generation import diff_node, load_node_state, save_node_state, get_chunk_size, get_pending_state, commit_node_states
+from sample_catalog import SampleCatalog
+from coverage_planner import CoverageMatrix, plan_chunks
+from work_queue import WorkQueue
+import create_samples
+import create_samples_batch
+
+
+SYNC_MAX_REQUESTS = 50          # up to this many requests per type, synchronous calls are worth the price
+BATCH_TURNAROUND_HOURS = 24     # worst case turnaround of the Batch API (COMPLETION_WINDOW)
+
+
+def choose_mode(request_count: int, deadline_hours: float = None, mode: str = "auto", max_sync_requests: int = SYNC_MAX_REQUESTS) -> str:
+    """
+    Returns "sync" or "batch" ("queue" only when asked for).
+    A deadline shorter than the batch completion window forces synchronous calls; otherwise the Batch API
+    is used as soon as the workload is larger than max_sync_requests because it costs half as much.
+    """
+    if mode in ("sync", "batch", "queue"):
+        return mode
+    if deadline_hours is not None and deadline_hours < BATCH_TURNAROUND_HOURS:
+        return "sync"
+    return "sync" if request_count <= max_sync_requests else "batch"
+
+def get_changed_chunks(node_documents: list, type: str):
+    """
+    Diffs every node against its committed state of the type. Chunks still pending from a run less than
+    BATCH_TURNAROUND_HOURS ago are not requested again.
+    Returns (new chunks as (node_file, chunk id, text), {node_file: (previous state, new state)}, retired chunk count).
+    """
+    chunks = []
+    states = {}
+    retired = 0
+    for node_file, rag_docs in node_documents:
+        previous = load_node_state(type, node_file.stem)
+        new_chunks, retired_chunks, state = diff_node(rag_docs, previous, get_chunk_size(type))
+        pending = previous.get("pending", {})
+        chunks.extend((node_file, chunk_id, full_text) for chunk_id, full_text in new_chunks
+                      if time.time() - pending.get(chunk_id, {}).get("requested", 0) > BATCH_TURNAROUND_HOURS * 3600)
+        states[node_file] = (previous, state)
+        retired += len(retired_chunks)
+    return chunks, states, retired
+
+def run_sync(type: str, chunks: list, output_path: Path, service: str, catalog: SampleCatalog = None) -> int:
+    """
+    Generates the samples for the chunks with concurrent synchronous calls.
+    Returns the number of samples saved.
+    """
+    run_id = f"batch_sync{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    create_samples.setup_prompts(type)
+    items = [(full_text, output_path / sample_file_name(run_id, custom_id)) for custom_id, full_text in chunks]
+    total = create_samples.generate_all(items, service, type)
+    if catalog:
+        #truncated replies may have added files for split chunks
+        catalog.refresh()
+    return total
+
+def run_batch(type: str, chunks: list, batched_requests_dir: Path, batch_num: int) -> int:
+    """
+    Submits the chunks as Batch API requests. The results are collected later by process_batch_completion.py.
+    Returns the next batch number.
+    """
+    client = OpenAI(api_key=getattr(create_samples_batch, f"OPENAI_API_KEY_{type}"))
+    create_samples_batch.setup_prompts(type)
+    requests = []
+    for custom_id, full_text in chunks:
+        request = create_samples_batch.generate_request(full_text, custom_id, type)
+        if request:
+            requests.append(request)
+    submitted, batch_num = create_samples_batch.submit_requests(client, requests, batched_requests_dir, batch_num)
+    for path, id in submitted:
+        print(f"Submitted {path} as {id}")
+    return batch_num
+
+def run_queue(type: str, type_chunks: list, queue_path: Path = None) -> int:
+    """
+    Adds the (node_file, chunk, full_text) chunks to the work queue. Returns the number of units added.
+    """
+    queue = WorkQueue(queue_path)
+    try:
+        return queue.enqueue((make_request_id(node_file.stem, chunk, type), type, node_file.stem, str(chunk), full_text)
+                             for node_file, chunk, full_text in type_chunks)
+    finally:
+        queue.close()
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Generate fine-tuning samples synchronously or through the Batch API, whichever fits the workload.")
+    parser.add_argument("--input_path", type=str, help="Path to the directory that holds profiles and nodes directories within. If none given, it will use customer_data.")
+    parser.add_argument("--output_path", type=str, help="Directory where synchronous results are written. Defaults to datasets/batched-samples.")
+    parser.add_argument("--types", type=str, help="Type of training: properties, commands, routines.")
+    parser.add_argument("--nodes", type=str, help="Comma separated node stems or uuids to restrict to (e.g. the nodes that changed).")
+    parser.add_argument("--mode", default="auto", type=str, help="auto, sync, batch or queue (add the requests to the work queue for work_queue.py workers).")
+    parser.add_argument("--queue_path", type=str, help="queue: the work queue database; defaults to the one under datasets.")
+    parser.add_argument("--deadline_hours", type=float, help="Results are needed within this many hours; shorter than the batch window forces sync.")
+    parser.add_argument("--max_sync_requests", default=SYNC_MAX_REQUESTS, type=int, help="auto: largest workload per type that still runs synchronously.")
+    parser.add_argument("--service", default="openai", type=str, help="sync: the service to use: xai, openai, pool")
+    parser.add_argument("--stream", default="false", type=str, help="sync: stream completions and save each sample as soon as it is complete.")
+    parser.add_argument("--incremental", default="false", type=str, help="Only request the devices added or changed since the last incremental run; retire the samples of changed/removed devices.")
+    parser.add_argument("--coverage_target", type=float, help="Only request chunks with a device whose coverage by the existing samples in output_path is below this (0..1, e.g. 0.75).")
+    args = parser.parse_args()
+    create_samples.STREAM = args.stream.lower() == "true"
+
+    types = [t.strip() for t in args.types.split(",")] if args.types else ["properties", "commands"]
+    nodes = [n.strip() for n in args.nodes.split(",")] if args.nodes else None
+
+    input_path = Path(args.input_path) if args.input_path else Path(get_data_directory("customer_data", None))
+    if not input_path.exists() or not input_path.is_dir():
+        raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+    output_path = Path(args.output_path) if args.output_path else Path(get_data_directory("datasets", "batched-samples"))
+    if not output_path.exists() or not output_path.is_dir():
+        raise ValueError(f"Output path {output_path} does not exist or is not a directory.")
+    batched_requests_dir = Path(get_data_directory("datasets", "batched-requests"))
+
+    incremental = args.incremental.lower() == "true"
+
+    #the device structures do not depend on the type; format the nodes only once
+    node_documents = list(iter_node_documents(input_path, nodes))
+
+    catalog = SampleCatalog(output_path)
+    batch_num = 1
+    try:
+        if incremental:
+            #samples of earlier runs may have arrived since
+            catalog.refresh()
+            committed, removed = commit_node_states(catalog, types)
+            if committed or removed:
+                print(f"{committed} pending chunks committed, {removed} sample files retired")
+        for type in types:
+            if incremental:
+                node_chunks, states, retired = get_changed_chunks(node_documents, type)
+                print(f"{type}: {len(node_chunks)} new or changed chunks, {retired} to retire")
+            else:
+                #the chunk size adapts to the output cost per device learned for the type
+                chunk_size = get_chunk_size(type)
+                node_chunks = [(node_file, i + 1, full_text) for node_file, rag_docs in node_documents
+                               for i, full_text in enumerate(chunk_documents(rag_docs, chunk_size))]
+            type_chunks = node_chunks
+            if args.coverage_target is not None:
+                matrix = CoverageMatrix()
+                matrix.load(output_path, types=[type])
+                type_chunks = plan_chunks(node_chunks, type, matrix, args.coverage_target)
+                print(f"{type}: {len(node_chunks) - len(type_chunks)} of {len(node_chunks)} chunks already covered up to {args.coverage_target:.0%}")
+            chunks = [(make_request_id(node_file.stem, chunk, type), full_text) for node_file, chunk, full_text in type_chunks]
+            if not chunks:
+                print(f"Nothing to generate for {type}.")
+            else:
+                mode = choose_mode(len(chunks), args.deadline_hours, args.mode.strip(), args.max_sync_requests)
+                print(f"{type}: {len(chunks)} requests -> {mode}")
+                if mode == "queue":
+                    added = run_queue(type, type_chunks, args.queue_path)
+                    print(f"✅ {type}: {added} units queued; run work_queue.py --operation=work to generate them.")
+                elif mode == "sync":
+                    total = run_sync(type, chunks, output_path, args.service.strip(), catalog)
+                    print(f"✅ {type}: {total} samples saved to {output_path}")
+                else:
+                    batch_num = run_batch(type, chunks, batched_requests_dir, batch_num)
+                    print(f"✅ {type}: batches submitted; run process_batch_completion.py once they complete.")
+            if incremental:
+                #the requested chunks stay pending until their samples exist; a failed request is simply repeated
+                requested = {}
+                for node_file, chunk, _ in type_chunks:
+                    requested.setdefault(node_file, set()).add(chunk)
+                for node_file, (previous, state) in states.items():
+                    save_node_state(type, node_file.stem, get_pending_state(previous, state, requested.get(node_file, set())))
+                if chunks and mode == "sync":
+                    committed, removed = commit_node_states(catalog, [type])
+                    print(f"{type}: {committed} chunks committed, {removed} sample files retired")
+    finally:
+        catalog.close()
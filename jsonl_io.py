@@ -0,0 +1,182 @@
+#reads and writes JSONL datasets plain or compressed, chosen by the file suffix: x.jsonl, x.jsonl.gz or
+#x.jsonl.zst. the samples repeat the same system prompt and DEVICE STRUCTUREs over and over and compress
+#several-fold (the legacy datasets: ~9x per file with gzip -6, ~18x as a whole). zstd is preferred when the
+#zstandard package is installed: with a dictionary trained on our own samples (datasets/jsonl.zstd.dict, see
+#--operation=train) even the small per request files compress well, since the dictionary already holds the
+#shared prompt text. gzip only needs the standard library.
+#readers and writers stream through the codec; nothing is decompressed to disk or held in memory.
+#the per batch stores (sample_store.py) stay plain JSONL since they are read by offset.
+
+import gzip, io, os
+from pathlib import Path
+from typing import Iterable, Iterator, List
+from util import get_data_directory
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+JSONL_SUFFIXES = (".jsonl", ".jsonl.gz", ".jsonl.zst")
+GZIP_LEVEL = 6      # 9 saves ~4% more on this data at twice the time
+ZSTD_LEVEL = 12     # higher levels barely help on this data and compress a lot slower
+ZSTD_DICT_FILE = "jsonl.zstd.dict"    # under datasets; used for every .zst file when present
+ZSTD_DICT_SIZE = 112_640
+#suffix of the files this repo writes compressed (downloaded batch outputs)
+WRITE_SUFFIX = ".jsonl.zst" if zstandard else ".jsonl.gz"
+
+_zstd_dict = {}
+
+
+def is_jsonl(name: str) -> bool:
+    return str(name).endswith(JSONL_SUFFIXES)
+
+def strip_suffix(name: str) -> str:
+    """
+    The name without its .jsonl, .jsonl.gz or .jsonl.zst suffix.
+    """
+    name = str(name)
+    for suffix in sorted(JSONL_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def find_jsonl(path: Path) -> Path:
+    """
+    Returns the existing variant (plain, .gz or .zst) of a JSONL path, or None if there is none.
+    """
+    path = Path(path)
+    base = strip_suffix(path.name)
+    for suffix in JSONL_SUFFIXES:
+        candidate = path.with_name(base + suffix)
+        if candidate.exists():
+            return candidate
+    return None
+
+def glob_jsonl(directory: Path, pattern: str) -> List[Path]:
+    """
+    The JSONL files of a directory matching pattern (given without suffix), plain or compressed.
+    """
+    paths = []
+    for suffix in JSONL_SUFFIXES:
+        paths.extend(Path(directory).glob(pattern + suffix))
+    return sorted(paths)
+
+def get_zstd_dict():
+    """
+    The zstd dictionary trained for our samples, or None if none was trained.
+    """
+    if "dict" not in _zstd_dict:
+        dict_path = Path(get_data_directory("datasets", ZSTD_DICT_FILE))
+        _zstd_dict["dict"] = zstandard.ZstdCompressionDict(dict_path.read_bytes()) if dict_path.exists() else None
+    return _zstd_dict["dict"]
+
+def open_jsonl(path: Path, mode: str = "r", suffix: str = None, newline: str = None):
+    """
+    Opens a JSONL file in text mode ("r", "w" or "a"), compressed or not depending on its suffix
+    (or on the given suffix, e.g. for a temporary file).
+    """
+    path = Path(path)
+    suffix = suffix or path.name
+    if suffix.endswith(".gz"):
+        return gzip.open(path, mode + "t", compresslevel=GZIP_LEVEL, encoding="utf-8", newline=newline)
+    if suffix.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(f"{path.name} is zstd compressed; pip install zstandard to read or write it.")
+        raw = open(path, "rb" if mode == "r" else mode + "b")
+        dictionary = get_zstd_dict()
+        if mode == "r":
+            #appended files hold one frame per append
+            stream = zstandard.ZstdDecompressor(dict_data=dictionary).stream_reader(raw, read_across_frames=True, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dictionary).stream_writer(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8", newline=newline)
+    return open(path, mode, encoding="utf-8", newline=newline)
+
+def iter_lines(path: Path) -> Iterator[str]:
+    """
+    Yields the non empty lines of a JSONL file, without their line end.
+    """
+    with open_jsonl(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield line.rstrip("\n")
+
+def convert(path: Path, suffix: str) -> Path:
+    """
+    Rewrites a JSONL file with another suffix (.jsonl, .jsonl.gz or .jsonl.zst), streaming, and removes the
+    original once the new file is complete. Returns the new path.
+    """
+    path = Path(path)
+    target = path.with_name(strip_suffix(path.name) + suffix)
+    if target == path:
+        return path
+    tmp_file = target.with_name(target.name + ".tmp")
+    with open_jsonl(path, "r") as src, open_jsonl(tmp_file, "w", suffix) as dst:
+        for line in src:
+            dst.write(line)
+    os.replace(tmp_file, target)
+    os.remove(path)
+    return target
+
+def train_dictionary(paths: Iterable[Path], size: int = ZSTD_DICT_SIZE) -> Path:
+    """
+    Trains the zstd dictionary on the lines of the given files and saves it under datasets.
+    .zst files can only be read with the dictionary they were written with, so an existing dictionary is never
+    replaced: decompress the .zst files and remove it first.
+    """
+    if zstandard is None:
+        raise ImportError("pip install zstandard to train a dictionary.")
+    dict_path = Path(get_data_directory("datasets", ZSTD_DICT_FILE))
+    if dict_path.exists():
+        raise ValueError(f"{dict_path} exists; decompress the .zst files and remove it before training a new one.")
+    lines = [line.encode("utf-8") for path in paths for line in iter_lines(path)]
+    dictionary = zstandard.train_dictionary(size, lines)
+    dict_path.write_bytes(dictionary.as_bytes())
+    _zstd_dict.clear()
+    return dict_path
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Compress, decompress and measure JSONL datasets; train the zstd dictionary.")
+    parser.add_argument("--input_path", default="batched-samples", type=str, help="Directory with the JSONL files. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--operation", default="stats", type=str, help="stats: sizes per suffix, compress: convert to --suffix, decompress: convert to plain .jsonl, train: train the zstd dictionary on the files")
+    parser.add_argument("--pattern", default="*", type=str, help="Only the files matching this pattern (without suffix).")
+    parser.add_argument("--suffix", default=WRITE_SUFFIX, type=str, help="compress: .jsonl.gz or .jsonl.zst")
+    args = parser.parse_args()
+
+    input_path = Path(args.input_path)
+    if not input_path.is_absolute():
+        input_path = Path(get_data_directory("datasets", args.input_path))
+    if not input_path.exists() or not input_path.is_dir():
+        raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+
+    #the stores are read by offset and never compressed
+    paths = [path for path in glob_jsonl(input_path, args.pattern) if not path.name.startswith("store_")]
+    operation = args.operation.strip()
+    if operation == "stats":
+        sizes = {}
+        for path in paths:
+            suffix = path.name[len(strip_suffix(path.name)):]
+            count, size = sizes.get(suffix, (0, 0))
+            sizes[suffix] = (count + 1, size + path.stat().st_size)
+        for suffix, (count, size) in sorted(sizes.items()):
+            print(f"{suffix}: {count} files, {size / 1e6:.1f}MB")
+    elif operation in ("compress", "decompress"):
+        suffix = args.suffix.strip() if operation == "compress" else ".jsonl"
+        before = after = 0
+        for path in paths:
+            if path.name.endswith(suffix):
+                continue
+            before += path.stat().st_size
+            try:
+                after += convert(path, suffix).stat().st_size
+            except Exception as e:
+                print(f"Error converting {path.name}: {e}")
+        print(f"✅ {before / 1e6:.1f}MB -> {after / 1e6:.1f}MB")
+    elif operation == "train":
+        print(f"✅ dictionary saved to {train_dictionary(paths)}")
+    else:
+        print(f"Unknown operation {operation}")
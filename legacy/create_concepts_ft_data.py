@@ -4,6 +4,7 @@ import json
 import os
 from pathlib import Path
 from util import get_data_directory
+from jsonl_io import open_jsonl, glob_jsonl, strip_suffix
 
 
 # === CONFIGURATION ===
@@ -121,7 +122,7 @@ def generate_openpipe_entries(full_text, output_path, dump=True):
         except Exception as e:
             print(f"Error: {e} | Input: {full_text[:60]}")
 
-    with open(output_path, "w") as f:
+    with open_jsonl(output_path, "w") as f:
         for item in jsonl_data:
             f.write(json.dumps(item) + "\n")
 
@@ -149,11 +150,12 @@ if __name__ == "__main__":
 
     # now traverse the input directory where you will find profiles and nodes directories
     # start with files in the nodes directory and then use the name of the file (without extension) to find the corresponding profile in the profiles directory
-    for node_file in INPUT_DIR.glob("*.jsonl"):
+    #the device samples may be compressed (see jsonl_io.py)
+    for node_file in glob_jsonl(INPUT_DIR, "*"):
         
         try:
             print(f"Processing node: {node_file.name} ")
-            with open(node_file, 'r') as f:
+            with open_jsonl(node_file, 'r') as f:
                 full_text = f.read()
                 #extract the device structure from the file
                 if not full_text:
@@ -169,7 +171,7 @@ if __name__ == "__main__":
                     continue
                 sample_count = 0
                 for sample in jsonl_data:
-                    out_file = output_path / f"{node_file.stem}_{sample_count}.jsonl"
+                    out_file = output_path / f"{strip_suffix(node_file.name)}_{sample_count}.jsonl"
                     sample_count += 1
                     if "messages" not in sample or len(sample["messages"]) < 3:
                         print(f"Warning: Invalid sample format in {node_file}. Skipping.")
@@ -4,6 +4,7 @@ import json
 import os
 from pathlib import Path
 from util import get_data_directory
+from jsonl_io import open_jsonl, glob_jsonl, strip_suffix
 
 
 # === CONFIGURATION ===
@@ -140,7 +141,7 @@ def generate_openpipe_entries(full_text, output_path, dump=True):
                     f.write(str(e)+"\n*****\n")
                     f.write(str(encoded))
 
-    with open(output_path, "w") as f:
+    with open_jsonl(output_path, "w") as f:
         for item in jsonl_data:
             f.write(json.dumps(item) + "\n")
             print(f"✅ {len(jsonl_data)} entries saved to {output_path}")
@@ -168,11 +169,12 @@ if __name__ == "__main__":
 
     # now traverse the input directory where you will find profiles and nodes directories
     # start with files in the nodes directory and then use the name of the file (without extension) to find the corresponding profile in the profiles directory
-    for node_file in INPUT_DIR.glob("*.jsonl"):
+    #the device samples may be compressed (see jsonl_io.py)
+    for node_file in glob_jsonl(INPUT_DIR, "*"):
         
         try:
             print(f"Processing node: {node_file.name} ")
-            with open(node_file, 'r') as f:
+            with open_jsonl(node_file, 'r') as f:
                 full_text = f.read()
                 #extract the device structure from the file
                 if not full_text:
@@ -187,7 +189,7 @@ if __name__ == "__main__":
                     print(f"Warning: No valid JSON objects found in {node_file}. Skipping.")
                     continue
                 sample_count = 0
-                out_file = output_path / f"{node_file.stem}_{sample_count}.jsonl"
+                out_file = output_path / f"{strip_suffix(node_file.name)}_{sample_count}.jsonl"
                 full_text = ""
                 for sample in jsonl_data:
                     if "messages" not in sample or len(sample["messages"]) < 3:
@@ -0,0 +1,150 @@
+#packs single turn samples (system, user, assistant) that share the same system prompt and DEVICE STRUCTURE
+#into multi-turn conversations: the first user message carries the device structure and its query, every
+#following turn only its USER QUERY and the assistant's reply. the context, by far the largest part of a sample,
+#is then trained on once per conversation instead of once per sample. conversations are filled up to a token
+#budget in the order the samples come in; a sample that cannot be packed stays a conversation of its own.
+#note that a later turn sees the earlier turns as context, which the single turn requests at inference do not.
+
+import json, os
+from pathlib import Path
+from typing import Iterable, Iterator, List, Tuple
+from util import estimate_tokens
+
+
+MAX_CONVERSATION_TOKENS = 16_000    # budget per packed conversation
+MESSAGE_OVERHEAD_TOKENS = 4         # role and separators of a message
+QUERY_MARKER = "USER QUERY:"
+
+
+def get_context(sample: dict) -> Tuple[str, str]:
+    """
+    The shared context of a single turn sample: (system content, user content up to USER QUERY:), or None if the
+    sample cannot be packed.
+    """
+    messages = sample.get("messages") if isinstance(sample, dict) else None
+    if not isinstance(messages, list) or len(messages) != 3 or [m.get("role") for m in messages] != ["system", "user", "assistant"]:
+        return None
+    user_content = messages[1].get("content")
+    if not isinstance(user_content, str) or "DEVICE STRUCTURE:" not in user_content or QUERY_MARKER not in user_content:
+        return None
+    return messages[0].get("content"), user_content[:user_content.index(QUERY_MARKER)]
+
+def count_tokens(messages: List[dict]) -> int:
+    return sum(estimate_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+def pack_samples(samples: Iterable[dict], max_tokens: int = MAX_CONVERSATION_TOKENS) -> Iterator[dict]:
+    """
+    Yields the conversations packed from the samples. Samples are grouped by their context in the order the
+    contexts first occur; within a group the samples keep their order.
+    """
+    groups = {}
+    for sample in samples:
+        context = get_context(sample)
+        if context is None:
+            #already multi-turn or not in the expected shape: passed through as it is
+            yield sample
+            continue
+        groups.setdefault(context, []).append(sample)
+    for group in groups.values():
+        conversation = None
+        tokens = 0
+        for sample in group:
+            system, user, assistant = sample["messages"]
+            user_content = user["content"]
+            if conversation is None:
+                conversation = {"messages": [system, user, assistant]}
+                tokens = count_tokens(conversation["messages"])
+                continue
+            turn = [dict(user, content=user_content[user_content.index(QUERY_MARKER):]), assistant]
+            turn_tokens = count_tokens(turn)
+            if tokens + turn_tokens > max_tokens:
+                yield conversation
+                conversation = {"messages": [system, user, assistant]}
+                tokens = count_tokens(conversation["messages"])
+                continue
+            conversation["messages"].extend(turn)
+            tokens += turn_tokens
+        if conversation:
+            yield conversation
+
+def is_packed(conversation: dict) -> bool:
+    """
+    True for a conversation packed by pack_samples: a context and query, then turns that only have a query.
+    """
+    messages = conversation.get("messages") or []
+    if len(messages) <= 3 or len(messages) % 2 == 0 or get_context({"messages": messages[:3]}) is None:
+        return False
+    return all(user.get("role") == "user" and str(user.get("content")).startswith(QUERY_MARKER) and assistant.get("role") == "assistant"
+               for user, assistant in zip(messages[3::2], messages[4::2]))
+
+def unpack_conversation(conversation: dict) -> List[dict]:
+    """
+    The single turn samples of a packed conversation (anything else is returned as it is).
+    """
+    if not is_packed(conversation):
+        return [conversation]
+    messages = conversation["messages"]
+    system, first_user = messages[0], messages[1]
+    context = first_user["content"][:first_user["content"].index(QUERY_MARKER)]
+    samples = [{"messages": messages[:3]}]
+    for i in range(3, len(messages), 2):
+        user, assistant = messages[i], messages[i + 1]
+        samples.append({"messages": [system, dict(user, content=context + user["content"]), assistant]})
+    return samples
+
+def pack_file(input_file: Path, output_file: Path, max_tokens: int = MAX_CONVERSATION_TOKENS) -> dict:
+    """
+    Packs the samples of a JSONL file into conversations written to output_file.
+    Returns the number of samples and conversations and the tokens before and after packing.
+    """
+    samples = []
+    with open(input_file, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                try:
+                    sample = json.loads(line)
+                except json.JSONDecodeError as e:
+                    print(f"Error decoding JSON from {input_file.name}: {e}")
+                    continue
+                if not isinstance(sample, dict) or not isinstance(sample.get("messages"), list):
+                    print(f"Skipping an entry without messages in {input_file.name}")
+                    continue
+                samples.append(sample)
+    stats = {"samples": len(samples), "conversations": 0, "tokens_before": sum(count_tokens(sample["messages"]) for sample in samples), "tokens_after": 0}
+    tmp_file = output_file.with_suffix(".tmp")
+    with tmp_file.open("w", encoding="utf-8") as out:
+        for conversation in pack_samples(samples, max_tokens):
+            out.write(json.dumps(conversation) + "\n")
+            stats["conversations"] += 1
+            stats["tokens_after"] += count_tokens(conversation["messages"])
+    os.replace(tmp_file, output_file)
+    return stats
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Pack single turn samples that share their device structure into multi-turn conversations, or unpack them.")
+    parser.add_argument("--input_file", required=True, type=str, help="JSONL file with the samples (e.g. samples/COMMANDS_combined.jsonl).")
+    parser.add_argument("--output_file", required=True, type=str, help="JSONL file to write.")
+    parser.add_argument("--operation", default="pack", type=str, help="pack or unpack")
+    parser.add_argument("--max_tokens", default=MAX_CONVERSATION_TOKENS, type=int, help="pack: token budget per conversation.")
+    args = parser.parse_args()
+
+    input_file = Path(args.input_file)
+    output_file = Path(args.output_file)
+    if args.operation.strip() == "pack":
+        stats = pack_file(input_file, output_file, args.max_tokens)
+        saved = 1 - stats["tokens_after"] / stats["tokens_before"] if stats["tokens_before"] else 0.0
+        print(f"✅ {stats['samples']} samples packed into {stats['conversations']} conversations in {output_file}: "
+              f"~{stats['tokens_before']} -> ~{stats['tokens_after']} tokens ({saved:.0%} saved)")
+    elif args.operation.strip() == "unpack":
+        count = 0
+        with open(input_file, "r", encoding="utf-8") as f, open(output_file, "w", encoding="utf-8") as out:
+            for line in f:
+                if line.strip():
+                    for sample in unpack_conversation(json.loads(line)):
+                        out.write(json.dumps(sample) + "\n")
+                        count += 1
+        print(f"✅ {count} samples saved to {output_file}")
+    else:
+        print(f"Unknown operation {args.operation}")
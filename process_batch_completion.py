@@ -7,7 +7,17 @@ from datetime import datetime
 from pathlib import Path
 from nucore import NuCore
 from util import get_data_directory
-from typing import Literal, List
+from sample_catalog import SampleCatalog
+from sample_generation import split_request_id, record_completion, commit_node_states
+from prompt_layout import match_request, render_messages, get_prompt_version, restore_references
+from sample_catalog import parse_custom_id
+from sample_store import SampleStore, get_store_path
+from device_structure import split_devices
+from salvage_samples import salvage_text
+from request_index import RequestIndex
+from usage_ledger import UsageLedger
+from jsonl_io import open_jsonl, find_jsonl, WRITE_SUFFIX
+from typing import Literal, List, Tuple
 
 
 # === CONFIGURATION ===
@@ -34,6 +44,22 @@ BATCH_MAX_LINES_PER_REQUEST = 1800  # max lines per batch request for OpenAI
 
 # A dictionary of completion status/archived
 archives={}
+def get_request_devices(index:RequestIndex, batch_id:str, custom_id:str) -> Tuple[List[str], str, str]:
+    """
+    Returns (the device documents a batch request was rendered with, its prompt layout, its device format), or
+    (None, None, None) if the request cannot be found or was not rendered from the current prompts.
+    """
+    row = index.lookup(custom_id, batch_id) if index else None
+    type = parse_custom_id(custom_id)["type"]
+    if not row or not type:
+        return None, None, None
+    try:
+        request = index.read_request(row)
+        layout, device_text, device_format = match_request(type, request["body"]["messages"])
+    except Exception as ex:
+        print(f"failed reading the request of {custom_id}: {ex}")
+        return None, None, None
+    return (split_devices(device_text) if device_text else None), layout, device_format
 
 def is_archived(batch)->bool:
     try:
@@ -92,8 +118,10 @@ def archive_batches(client:OpenAI, path:Path):
         json.dump(archives, fp)
 
 
-def download_result(client:OpenAI, batch, path, is_error:bool):
-    """Download a Files API asset to disk."""
+def download_result(client:OpenAI, batch, path, is_error:bool, catalog:SampleCatalog=None, index:RequestIndex=None, ledger:UsageLedger=None):
+    """Download a Files API asset to disk. The samples are added to the batch's store and the catalog is refreshed if one is given.
+    With the request index, truncated replies (finish_reason=length) are recorded for retry and the output
+    tokens per device are learned for chunk sizing. With the ledger, the token usage of every completion is recorded."""
     try:
 #        row = [
 #            batch.id,
@@ -108,73 +136,133 @@ def download_result(client:OpenAI, batch, path, is_error:bool):
         output_file_id=""
         if is_error:
             if getattr(batch, "error_file_id", None):
-                out_path = path / f"{batch.id}_error.jsonl"
+                out_name = f"{batch.id}_error"
                 output_file_id=batch.error_file_id
             else:
                 raise ValueError("no error file found for batch {batch.id}...")
         else:
             if getattr(batch, "output_file_id", None):
-                out_path = path / f"{batch.id}_output.jsonl"
+                out_name = f"{batch.id}_output"
                 output_file_id=batch.output_file_id
             else:
                 raise ValueError("no output file found for batch {batch.id}...")
 
+        #outputs are kept compressed (see jsonl_io.py); the ones downloaded before stay plain
+        out_path = find_jsonl(path / f"{out_name}.jsonl")
         contents=[]   
         full_contents="" 
         #download if and only if necessary
-        if not out_path.exists():  # avoid re-downloading
+        if not out_path:  # avoid re-downloading
+            out_path = path / f"{out_name}{WRITE_SUFFIX}"
             try:
                 print (f"downloading {out_path} ...")
                 full_contents = client.files.content(output_file_id).text
-                out_path.write_text(full_contents, encoding="utf-8")
+                with open_jsonl(out_path, "w") as f:
+                    f.write(full_contents)
             except Exception as e:
                 print(f"[warn] failed to download output for {batch.id}: {e}")
                 contents = [] 
         else:
             print (f"{out_path} already downloaded; reading the file and returning contents ...")
-            full_contents = out_path.read_text(encoding="utf-8")
+            with open_jsonl(out_path, "r") as f:
+                full_contents = f.read()
         
         contents =  full_contents.strip().splitlines()
         if is_error:
             return contents
 
-        for content in contents:
-            content = json.loads(content)
-            samples_out_path = path / f"sample_{out_path.stem}_{content['custom_id']}.jsonl"
-            print (f"saving {samples_out_path} ...")
-            try:
-                content = content['response']['body']['choices'][0]['message']['content']
-                print(content[0:100])
-                content = json.loads(content.strip())
-            except Exception as ex:
-                print(f"failed loading content {ex} ... ")
-                continue
-            print(f"success!")
-            with open(samples_out_path, 'a') as fp:
-                try:
-                    json.dump(content, fp)
-                    fp.write('\n')
-                except Exception as ex:
-                    print(f"failed saving content {ex} to {samples_out_path} ... ")
-                    continue
+        #the samples of the whole batch go to one store (see sample_store.py)
+        store = SampleStore(get_store_path(path, batch.id))
+        try:
+            store_contents(batch, contents, store, index, ledger)
+        finally:
+            store.close()
+        if catalog:
+            catalog.refresh()
 
         return contents
     except Exception as ex:
         print(f"Error downloading {batch.id}. Skipping: {ex}")
         return None
 
+def store_contents(batch, contents:List[str], store:SampleStore, index:RequestIndex=None, ledger:UsageLedger=None):
+    """
+    Decodes (or salvages) the samples of every output line and adds them to the batch's store.
+    Requests that are already in the store are skipped, so processing a batch again does not duplicate samples.
+    """
+    for content in contents:
+        content = json.loads(content)
+        custom_id = content['custom_id']
+        if store.has(custom_id):
+            print(f"{custom_id} already stored; skipping ...")
+            continue
+        print (f"saving {custom_id} to {store.store_path} ...")
+        body = None
+        prompt_version = None
+        samples = []
+        type = parse_custom_id(custom_id)["type"]
+        devices, device_format = None, None
+        #samples of the prefix layout refer to the runtime system prompt and the device structure of the request
+        restore = lambda sample: restore_references(type, sample, "".join(devices) if devices else None, device_format or "flat") if type else sample
+        try:
+            body = content['response']['body']
+            truncated = body['choices'][0].get('finish_reason') == "length"
+            devices, layout, device_format = get_request_devices(index, batch.id, custom_id) if index else (None, None, None)
+            if layout:
+                #the request was rendered from the current prompts, in this layout and device format
+                prompt_version = get_prompt_version(parse_custom_id(custom_id)["type"], layout, device_format)
+            #truncated and unsalvageable outputs are never stored and come back on every run; learn from them once
+            seen = ledger.has(batch.id, custom_id) if ledger else False
+            if devices and not seen:
+                record_completion(parse_custom_id(custom_id)["type"], len(devices), (body.get('usage') or {}).get('completion_tokens', 0), truncated)
+            if truncated:
+                #the reply was cut off at the token limit; the retry operation splits the chunk
+                print(f"reply truncated at the token limit; {custom_id} will be split on retry ...")
+                if index:
+                    index.add_truncated(batch.id, custom_id)
+                continue
+            content = body['choices'][0]['message']['content']
+            print(content[0:100])
+            samples = [restore(json.loads(content.strip()))]
+        except json.JSONDecodeError as ex:
+            #most decode failures are formatting problems; try to recover before giving up on the request
+            samples, fixups = salvage_text(content, restore)
+            if not samples:
+                print(f"failed loading content {ex} ... ")
+                continue
+            print(f"salvaged {len(samples)} samples ({', '.join(fixups) or 'split'}) ...")
+        except Exception as ex:
+            print(f"failed loading content {ex} ... ")
+            continue
+        finally:
+            if ledger and body:
+                ledger.record(batch.id, custom_id, body, len(samples), prompt_version)
+        print(f"success!")
+        try:
+            store.add(custom_id, samples)
+        except Exception as ex:
+            print(f"failed saving content {ex} to {store.store_path} ... ")
+            continue
 
 
-def download_results(client:OpenAI, path:Path):
+def download_results(client:OpenAI, path:Path, requests_path:Path=None):
     outputs_all: List[str] = []
     errors_all: List[str]  = []
+    catalog = SampleCatalog(path)
+    index = RequestIndex(requests_path) if requests_path else None
+    ledger = UsageLedger(path)
     try:
+        if index:
+            index.refresh()
+        else:
+            print("no requests path given; truncated replies are not recorded for retry and chunk costs are not learned ...")
         for batch in list_batches(client, False):
             if batch.status == "cancelled":
                 print(f"{batch.id} is cancelled; ignoring ...")
                 continue
-            if batch.status == "completed":
-                contents = download_result(client, batch, path, False)
+            #expired batches still deliver the requests that completed in time
+            if batch.status in ("completed", "expired"):
+                contents = download_result(client, batch, path, False, catalog, index, ledger)
                 if contents:
                     outputs_all.extend(contents)
                 errors = download_result(client, batch, path, True)
@@ -182,20 +270,120 @@ def download_results(client:OpenAI, path:Path):
                     errors_all.extend(errors)
             else:
                 print(f"{batch.id} is not complete (status == {batch.status})... ignoring")
+        #incremental runs: the chunks whose samples arrived replace the ones they were generated for
+        committed, removed = commit_node_states(catalog)
+        if committed or removed:
+            print(f"{committed} pending chunks committed, {removed} sample files retired")
     except Exception as ex:
         print(f"failed downloading results {str(ex)}")
         return None, None
+    finally:
+        catalog.close()
+        ledger.close()
+        if index:
+            index.close()
     return outputs_all, errors_all
 
 
 
+def get_failed_requests(client:OpenAI, path:Path, index:RequestIndex, catalog:SampleCatalog) -> dict:
+    """
+    Returns {custom_id: [batch ids]} of the requests that produced no sample file: error lines, outputs that
+    could not be decoded, requests left over by expired batches and every request of failed batches.
+    Batches whose results have not been downloaded yet and requests already resubmitted are skipped.
+    """
+    failed = {}
+    for batch in list_batches(client, False, include_fails=True):
+        if batch.status in ("completed", "expired"):
+            if not find_jsonl(path / f"{batch.id}_output.jsonl") and not find_jsonl(path / f"{batch.id}_error.jsonl"):
+                print(f"{batch.id} has not been processed yet; run --operation=process first ...")
+                continue
+        elif batch.status != "failed":
+            continue
+        sampled = {row["custom_id"] for row in catalog.select(batch_id=batch.id)}
+        for custom_id in index.custom_ids(batch.id):
+            if custom_id not in sampled and not index.is_retried(batch.id, custom_id):
+                failed.setdefault(custom_id, []).append(batch.id)
+    return failed
+
+def split_request(index:RequestIndex, request:dict, batch_id:str, custom_id:str) -> List[dict]:
+    """
+    Splits a request whose reply was truncated into two requests holding half of its devices each
+    (custom ids get an a/b suffix on the chunk). Returns None if there is only one device.
+    """
+    devices, layout, device_format = get_request_devices(index, batch_id, custom_id)
+    if not devices or len(devices) < 2 or split_request_id(custom_id, "a") == custom_id:
+        return None
+    type = parse_custom_id(custom_id)["type"]
+    half = (len(devices) + 1) // 2
+    parts = []
+    for part, part_devices in zip("ab", (devices[:half], devices[half:])):
+        part_request = json.loads(json.dumps(request))
+        part_request["custom_id"] = split_request_id(custom_id, part)
+        part_request["body"]["messages"] = render_messages(type, "".join(part_devices), layout, device_format)
+        parts.append(part_request)
+    return parts
+
+def retry_failed(client:OpenAI, path:Path, requests_path:Path, dry_run:bool=False) -> int:
+    """
+    Resubmits the original request lines of the failed requests (see get_failed_requests) as new batches.
+    The request lines are read from the request files through the request index; requests whose reply was
+    truncated are split in two (see split_request).
+    Returns the number of requests resubmitted.
+    """
+    import create_samples_batch
+    index = RequestIndex(requests_path)
+    catalog = SampleCatalog(path)
+    try:
+        index.refresh()
+        catalog.refresh()
+        failed = get_failed_requests(client, path, index, catalog)
+        requests = []
+        sources = []
+        for custom_id, batch_ids in failed.items():
+            row = index.lookup(custom_id, batch_ids[-1])
+            if not row:
+                print(f"no request found for {custom_id}; skipping ...")
+                continue
+            request = index.read_request(row)
+            request_sources = [(batch_id, custom_id) for batch_id in batch_ids]
+            if index.is_truncated(batch_ids[-1], custom_id):
+                split = split_request(index, request, batch_ids[-1], custom_id)
+                if not split:
+                    print(f"{custom_id} was truncated and cannot be split any further; skipping ...")
+                    continue
+                #the parts share the sources so that the truncated request is marked as retried once all are submitted
+                requests.extend(split)
+                sources.extend([request_sources] * len(split))
+                continue
+            requests.append(request)
+            sources.append(request_sources)
+        print(f"{len(failed)} failed requests found; {len(requests)} requests to resubmit.")
+        if dry_run or not requests:
+            return 0
+        submitted, _ = create_samples_batch.submit_requests(client, requests, requests_path, index.next_batch_num())
+        #submit_requests shards in order; record the batch each request went to
+        shard_size = create_samples_batch.BATCH_MAX_LINES_PER_REQUEST
+        retries = []
+        for i, (request_file, retry_batch_id) in enumerate(submitted):
+            print(f"Resubmitted {request_file} as {retry_batch_id}")
+            for request_sources in sources[i*shard_size:(i+1)*shard_size]:
+                retries.extend((batch_id, custom_id, retry_batch_id) for batch_id, custom_id in request_sources)
+        index.add_retries(retries)
+        return min(len(requests), len(submitted) * shard_size)
+    finally:
+        catalog.close()
+        index.close()
+
+
 # Example usage
 if __name__ == "__main__":
     argparse = __import__('argparse')
     parser = argparse.ArgumentParser(description="Process batch completions (cancel, wait, list).")
     parser.add_argument("--output_path", type=str, help="Path to the output directory where the samples are stored. If none given, it will be printed to stdout.")
     parser.add_argument("--types", type=str, help="Type of training: properties, commands, routines, general.")
-    parser.add_argument("--operation", type=str, help="Operation to perform on the batches: cancel, list, process, archive")
+    parser.add_argument("--operation", type=str, help="Operation to perform on the batches: cancel, list, process, retry, archive")
+    parser.add_argument("--dry_run", default="false", type=str, help="retry: only report the failed requests.")
 
     args = parser.parse_args()
 
@@ -231,7 +419,12 @@ if __name__ == "__main__":
         if operation == "cancel":
             cancel_batches(client)
         elif operation == "process":
-            download_results(client, OUTPUT_DIR)
+            _, errors = download_results(client, output_path, BATCHED_REQUESTS_DIR)
+            if errors:
+                print(f"{len(errors)} requests failed; run --operation=retry to resubmit them.")
+        elif operation == "retry":
+            retried = retry_failed(client, output_path, BATCHED_REQUESTS_DIR, args.dry_run.lower() == "true")
+            print(f"✅ {retried} requests resubmitted.")
         elif operation == "archive":
             archive_batches(client, ARCHIVED_FILE)
 
@@ -0,0 +1,181 @@
+#lays the generation requests out so that the provider can cache the prompt. the inline layout (the original
+#one) renders everything into a single system message: the type instructions, with the runtime system prompt
+#(preamble) spliced into their example and the device structure right after it, so the part that varies
+#sits in the middle and the shared prefix differs per type. the prefix layout puts what never changes first:
+#    system: the runtime system prompt       byte-identical for every request of every type
+#    system: the type instructions           byte-identical for every request of a type
+#    user:   DEVICE STRUCTURE:\n<devices>    the only part that varies
+#the instructions refer to the other two messages instead of embedding them, and the samples are asked to hold
+#the references <RUNTIME SYSTEM PROMPT> and <DEVICE STRUCTURE> literally, which saves their output tokens too;
+#restore_references puts the texts back once the samples are decoded. usage_ledger.py reports the cached share
+#of the prompt tokens per prompt version, i.e. per type and layout.
+#independently of the layout, the device structure can be sent flat (as NuCore formats it) or compact (see
+#compact_structure.py); the samples copy it, so DEVICE_FORMAT also decides the format the model is trained on.
+
+import hashlib, json
+from typing import Dict, List, Tuple
+from sample_generation import load_prompt_parts, render_system_prompt, extract_device_text
+from compact_structure import compact, expand, is_compact
+
+
+PROMPT_LAYOUT = "prefix"    # prefix or inline
+LAYOUTS = ("prefix", "inline")
+DEVICE_FORMAT = "flat"      # flat or compact
+DEVICE_FORMATS = ("flat", "compact")
+
+RUNTIME_REF = "<RUNTIME SYSTEM PROMPT>"
+DEVICES_REF = "<DEVICE STRUCTURE>"
+RUNTIME_HEADER = f"{RUNTIME_REF}:\n"
+DEVICES_HEADER = "DEVICE STRUCTURE:\n"
+
+#(template, runtime system prompt) per type, loaded once
+_prompt_parts: Dict[str, Tuple[str, str]] = {}
+
+
+def get_prompt_parts(type: str) -> Tuple[str, str]:
+    if type not in _prompt_parts:
+        _prompt_parts[type] = load_prompt_parts(type)
+    return _prompt_parts[type]
+
+def get_train_prompt(type: str) -> str:
+    """
+    The training prompt of the inline layout (see sample_generation.load_train_prompt).
+    """
+    template, runtime = get_prompt_parts(type)
+    return template.replace("{{TEMPLATE_PROMPTS_RUNTIME}}", runtime)
+
+def has_devices(type: str) -> bool:
+    return "{{DEVICE_STRUCTURE}}" in get_prompt_parts(type)[0]
+
+def get_static_messages(type: str, layout: str = PROMPT_LAYOUT) -> List[dict]:
+    """
+    The leading messages that are the same for every request of a type: none in the inline layout.
+    """
+    if layout == "inline":
+        return []
+    template, runtime = get_prompt_parts(type)
+    instructions = template.replace("{{TEMPLATE_PROMPTS_RUNTIME}}", RUNTIME_REF).replace("{{DEVICE_STRUCTURE}}", DEVICES_REF)
+    note = f"\n\n{RUNTIME_REF} stands for the text of the first system message"
+    if has_devices(type):
+        note += f" and {DEVICES_REF} for the device structure in the user message"
+    note += ". Write these references literally, exactly as shown, where the samples hold those texts; they are substituted after generation.\n"
+    return [
+        {"role": "system", "content": RUNTIME_HEADER + runtime},
+        {"role": "system", "content": instructions.rstrip() + note},
+    ]
+
+def render_messages(type: str, full_text: str, layout: str = PROMPT_LAYOUT, device_format: str = DEVICE_FORMAT) -> List[dict]:
+    """
+    The messages of a generation request for the (flat) device structure full_text.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"Unknown prompt layout {layout}; use one of {', '.join(LAYOUTS)}")
+    if device_format not in DEVICE_FORMATS:
+        raise ValueError(f"Unknown device format {device_format}; use one of {', '.join(DEVICE_FORMATS)}")
+    if device_format == "compact":
+        full_text = compact(full_text)
+    if layout == "inline":
+        return [{"role": "system", "content": render_system_prompt(get_train_prompt(type), full_text)}]
+    messages = get_static_messages(type, layout)
+    if has_devices(type):
+        messages.append({"role": "user", "content": DEVICES_HEADER + full_text})
+    return messages
+
+def restore_references(type: str, sample: dict, full_text: str = None, device_format: str = DEVICE_FORMAT) -> dict:
+    """
+    Substitutes the runtime system prompt and the device structure (the flat full_text of the request, formatted
+    as it was sent) for their references in the messages of a sample generated in the prefix layout.
+    """
+    messages = sample.get("messages") if isinstance(sample, dict) else None
+    if not isinstance(messages, list):
+        return sample
+    runtime = get_prompt_parts(type)[1].replace("\\n", "\n")
+    device_text = (compact(full_text) if device_format == "compact" else full_text) if full_text else None
+    for message in messages:
+        content = message.get("content") if isinstance(message, dict) else None
+        if not isinstance(content, str):
+            continue
+        content = content.replace(RUNTIME_REF, runtime)
+        if device_text is not None:
+            content = content.replace(DEVICES_REF, device_text)
+        message["content"] = content
+    return sample
+
+def match_request(type: str, messages: List[dict]) -> Tuple[str, str, str]:
+    """
+    Returns (layout, flat device structure, device format) of the messages of a request, or (None, None, None)
+    if the request was not rendered from the current prompts of the type (e.g. they changed since).
+    """
+    layout, device_text = _match_layout(type, messages)
+    if layout is None:
+        return None, None, None
+    return layout, expand(device_text), "compact" if is_compact(device_text) else "flat"
+
+def _match_layout(type: str, messages: List[dict]) -> Tuple[str, str]:
+    static = get_static_messages(type, "prefix")
+    if messages[:len(static)] == static:
+        rest = messages[len(static):]
+        if not rest:
+            return "prefix", ""
+        content = rest[0].get("content") or ""
+        if len(rest) == 1 and content.startswith(DEVICES_HEADER):
+            return "prefix", content[len(DEVICES_HEADER):]
+        return None, None
+    if len(messages) == 1:
+        content = messages[0].get("content") or ""
+        if not has_devices(type):
+            return ("inline", "") if content == get_train_prompt(type) else (None, None)
+        device_text = extract_device_text(get_train_prompt(type), content)
+        if device_text is not None:
+            return "inline", device_text
+    return None, None
+
+def get_prompt_version(type: str, layout: str = PROMPT_LAYOUT, device_format: str = DEVICE_FORMAT) -> str:
+    """
+    Identifies the prompts of a type in a layout and device format by the hash of their text, e.g. to compare their usage.
+    """
+    template, runtime = get_prompt_parts(type)
+    #flat versions hash as they did before there was a compact format
+    parts = [layout, template, runtime] + ([device_format] if device_format != "flat" else [])
+    return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()[:12]
+
+def get_prefix_tokens(type: str, layout: str = PROMPT_LAYOUT) -> int:
+    """
+    The estimated number of tokens before the first byte that varies between requests of a type.
+    """
+    from util import estimate_tokens
+    if layout == "inline":
+        return estimate_tokens(get_train_prompt(type).partition("{{DEVICE_STRUCTURE}}")[0])
+    return sum(estimate_tokens(message["content"]) for message in get_static_messages(type, layout))
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    from pathlib import Path
+    from util import get_data_directory
+    parser = argparse.ArgumentParser(description="Show the static prompt prefix per type and layout, and the prompt cache hit rate measured per prompt version.")
+    parser.add_argument("--types", default="properties,commands,routines", type=str, help="Comma separated types.")
+    parser.add_argument("--samples_path", default="batched-samples", type=str, help="Directory with the usage ledger (see usage_ledger.py). Relative paths are resolved against the datasets directory.")
+    args = parser.parse_args()
+
+    samples_path = Path(args.samples_path)
+    if not samples_path.is_absolute():
+        samples_path = Path(get_data_directory("datasets", args.samples_path))
+
+    versions = {}
+    for type in [t.strip() for t in args.types.split(",")]:
+        for layout in LAYOUTS:
+            for device_format in DEVICE_FORMATS:
+                version = get_prompt_version(type, layout, device_format)
+                versions[version] = (type, f"{layout}, {device_format}")
+            print(f"{type} ({layout}): version {get_prompt_version(type, layout, 'flat')} flat, {get_prompt_version(type, layout, 'compact')} compact, ~{get_prefix_tokens(type, layout)} static prefix tokens")
+
+    from usage_ledger import UsageLedger, LEDGER_FILE
+    if (samples_path / LEDGER_FILE).exists():
+        ledger = UsageLedger(samples_path)
+        try:
+            for group in ledger.report("prompt_version"):
+                type, layout = versions.get(group["prompt_version"], ("-", "unknown or older prompts"))
+                print(f"{group['prompt_version']} {type} ({layout}): {group['requests']} requests, {group['cache_hit_rate']:.0%} of the prompt tokens cached")
+        finally:
+            ledger.close()
@@ -0,0 +1,304 @@
+#Client side rate limiting for synchronous chat completions.
+#Enforces requests-per-minute and tokens-per-minute budgets per API key, retries throttled or
+#failed requests with jittered exponential backoff (honoring Retry-After) and adapts the number of
+#concurrent requests AIMD style (additive increase, multiplicative decrease) based on throttling.
+
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Tuple
+import openai
+from util import estimate_tokens
+
+
+# === CONFIGURATION ===
+DEFAULT_RPM = 500                   # requests per minute per API key
+DEFAULT_TPM = 200_000               # tokens per minute per API key
+DEFAULT_MAX_CONCURRENCY = 16        # ceiling for the AIMD concurrency window
+DEFAULT_COMPLETION_TOKENS = 4_000   # assumed completion size when max_tokens is not given
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0                  # seconds
+BACKOFF_MAX = 60.0                  # seconds
+AIMD_INCREASE = 1.0                 # window grows by this much per window's worth of successes
+AIMD_DECREASE = 0.5                 # window is multiplied by this on throttling
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    A continuously refilled bucket holding at most `per_minute` units.
+    acquire() blocks until the requested amount is available.
+    """
+    def __init__(self, per_minute:int):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount:float):
+        #a single request larger than the whole budget would never fit; let it through on a full bucket
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                wait = (amount - self.available) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, amount:float):
+        """
+        Credit (negative amount) or debit (positive amount) the bucket once the actual usage is known.
+        The balance is allowed to go negative so that overspending delays the next requests.
+        """
+        with self.lock:
+            self._refill()
+            self.available = min(self.capacity, self.available - amount)
+
+
+class AIMDConcurrencyLimiter:
+    """
+    Limits the number of in-flight requests to an adaptive window.
+    Every success grows the window by AIMD_INCREASE/window (i.e. about AIMD_INCREASE per round trip),
+    every throttling signal multiplies it by AIMD_DECREASE. Throttles reported by requests that were
+    already in flight before the last decrease are ignored so a burst of 429s only halves the window once.
+    """
+    def __init__(self, initial:int=4, minimum:int=1, maximum:int=DEFAULT_MAX_CONCURRENCY):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.window = float(min(max(initial, minimum), self.maximum))
+        self.in_flight = 0
+        self.generation = 0
+        self.condition = threading.Condition()
+
+    @property
+    def limit(self)->int:
+        return max(self.minimum, int(self.window))
+
+    def acquire(self)->int:
+        """
+        Blocks until a slot is free and returns the window generation the request started in.
+        """
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+            return self.generation
+
+    def release(self, generation:int, throttled:bool):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                if generation == self.generation:
+                    self.window = max(float(self.minimum), self.window * AIMD_DECREASE)
+                    self.generation += 1
+                    print(f"throttled: concurrency window decreased to {self.limit}")
+            else:
+                self.window = min(float(self.maximum), self.window + AIMD_INCREASE / self.window)
+            self.condition.notify_all()
+
+
+class KeyBudget:
+    """
+    All rate limiting state shared by every client that uses the same API key.
+    """
+    def __init__(self, rpm:int, tpm:int, max_concurrency:int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.concurrency = AIMDConcurrencyLimiter(initial=min(4, max_concurrency), maximum=max_concurrency)
+
+
+_budgets: Dict[Tuple[str, str], KeyBudget] = {}
+_budgets_lock = threading.Lock()
+
+def get_key_budget(api_key:str, base_url:str, rpm:int, tpm:int, max_concurrency:int)->KeyBudget:
+    """
+    Returns the budget for an API key, creating it on first use.
+    """
+    with _budgets_lock:
+        key = (api_key, base_url)
+        if key not in _budgets:
+            _budgets[key] = KeyBudget(rpm, tpm, max_concurrency)
+        return _budgets[key]
+
+
+def get_status_code(ex:Exception)->int:
+    status = getattr(ex, "status_code", None)
+    if status is None:
+        response = getattr(ex, "response", None)
+        status = getattr(response, "status_code", None)
+    return status
+
+
+def is_throttled(ex:Exception)->bool:
+    """
+    429s and timeouts are treated as signs that we are pushing the provider too hard.
+    """
+    return isinstance(ex, (openai.RateLimitError, openai.APITimeoutError)) or get_status_code(ex) == 429
+
+
+def is_retryable(ex:Exception)->bool:
+    if is_throttled(ex) or isinstance(ex, openai.APIConnectionError):
+        return True
+    return get_status_code(ex) in RETRYABLE_STATUS_CODES
+
+
+def get_retry_after(ex:Exception)->float:
+    """
+    Returns the delay requested by the server (retry-after-ms or Retry-After in seconds or HTTP date), or None.
+    """
+    response = getattr(ex, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        value = headers.get("retry-after-ms")
+        if value:
+            return max(0.0, float(value) / 1000.0)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def get_backoff(attempt:int)->float:
+    """
+    Full jitter exponential backoff.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def estimate_request_tokens(kwargs:dict)->int:
+    prompt = sum(estimate_tokens(str(message.get("content", ""))) for message in kwargs.get("messages", []))
+    completion = kwargs.get("max_completion_tokens") or kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    return prompt + completion
+
+
+class RateLimitedClient:
+    """
+    Wraps an OpenAI (or OpenAI compatible) client so that chat completions respect the
+    per key budgets, retry on throttling/transient errors and adapt concurrency.
+    The wrapper is thread safe; share one instance between worker threads.
+    """
+    def __init__(self, client:openai.OpenAI, rpm:int=DEFAULT_RPM, tpm:int=DEFAULT_TPM,
+                 max_concurrency:int=DEFAULT_MAX_CONCURRENCY, max_retries:int=MAX_RETRIES):
+        #we do our own retries; the SDK's would hide the throttling signals from us
+        self.client = client.with_options(max_retries=0)
+        self.max_retries = max_retries
+        self.budget = get_key_budget(client.api_key, str(client.base_url), rpm, tpm, max_concurrency)
+        #last x-ratelimit-* values reported by the provider, if any
+        self.remaining_requests = None
+        self.remaining_tokens = None
+        self.limit_requests = None
+        self.limit_tokens = None
+
+    @property
+    def concurrency(self)->int:
+        return self.budget.concurrency.limit
+
+    @property
+    def headroom(self)->float:
+        """
+        Fraction (0..1) of the rate limit still available: the provider's x-ratelimit-remaining-* headers
+        when they were reported, otherwise our own buckets.
+        """
+        fractions = [max(0.0, self.budget.requests.available) / self.budget.requests.capacity,
+                     max(0.0, self.budget.tokens.available) / self.budget.tokens.capacity]
+        if self.remaining_requests is not None and self.limit_requests:
+            fractions.append(self.remaining_requests / self.limit_requests)
+        if self.remaining_tokens is not None and self.limit_tokens:
+            fractions.append(self.remaining_tokens / self.limit_tokens)
+        return max(0.0, min(1.0, min(fractions)))
+
+    def _record_headers(self, headers):
+        def get_int(name):
+            try:
+                value = headers.get(name)
+                return int(value) if value is not None else None
+            except (TypeError, ValueError):
+                return None
+        self.remaining_requests = get_int("x-ratelimit-remaining-requests")
+        self.remaining_tokens = get_int("x-ratelimit-remaining-tokens")
+        self.limit_requests = get_int("x-ratelimit-limit-requests") or self.limit_requests
+        self.limit_tokens = get_int("x-ratelimit-limit-tokens") or self.limit_tokens
+
+    def _create(self, kwargs:dict, estimate:int, on_send=None):
+        """
+        Sends the request, retrying throttled/transient failures. on_send, if given, is called every time the
+        request was admitted and is about to be sent (e.g. to time it without the waits for the budgets).
+        Returns (response, generation); the caller must release the concurrency slot.
+        """
+        attempt = 0
+        while True:
+            generation = self.budget.concurrency.acquire()
+            self.budget.requests.acquire(1)
+            self.budget.tokens.acquire(estimate)
+            if on_send:
+                on_send()
+            try:
+                raw = self.client.chat.completions.with_raw_response.create(**kwargs)
+                self._record_headers(raw.headers)
+                return raw.parse(), generation
+            except Exception as ex:
+                throttled = is_throttled(ex)
+                self.budget.concurrency.release(generation, throttled)
+                if not is_retryable(ex) or attempt >= self.max_retries:
+                    raise
+                delay = get_retry_after(ex)
+                if delay is None:
+                    delay = get_backoff(attempt)
+                attempt += 1
+                print(f"[retry {attempt}/{self.max_retries}] {type(ex).__name__}: waiting {delay:.1f}s ...")
+                time.sleep(delay)
+
+    def _settle(self, usage, estimate:int):
+        total_tokens = getattr(usage, "total_tokens", None)
+        if total_tokens:
+            self.budget.tokens.adjust(total_tokens - estimate)
+
+    def create_chat_completion(self, **kwargs):
+        """
+        Same arguments as client.chat.completions.create().
+        Raises the last error once the retries are exhausted or if the error is not retryable.
+        """
+        estimate = estimate_request_tokens(kwargs)
+        response, generation = self._create(kwargs, estimate)
+        self.budget.concurrency.release(generation, False)
+        self._settle(getattr(response, "usage", None), estimate)
+        return response
+
+    def create_chat_completion_stream(self, on_send=None, **kwargs):
+        """
+        Streams a chat completion and yields its chunks. Only opening the stream is retried; an error in the
+        middle of the stream is raised to the caller, who keeps whatever was received so far.
+        The concurrency slot is held until the stream is exhausted or closed. on_send: see _create.
+        """
+        estimate = estimate_request_tokens(kwargs)
+        kwargs["stream"] = True
+        kwargs.setdefault("stream_options", {"include_usage": True})
+        stream, generation = self._create(kwargs, estimate, on_send)
+        throttled = False
+        try:
+            for chunk in stream:
+                usage = getattr(chunk, "usage", None)
+                if usage:
+                    self._settle(usage, estimate)
+                yield chunk
+        except Exception as ex:
+            throttled = is_throttled(ex)
+            raise
+        finally:
+            self.budget.concurrency.release(generation, throttled)
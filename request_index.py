@@ -0,0 +1,194 @@
+#indexes the submitted batch request files (batched-requests/batch_<n>_<batch id>.jsonl) by custom id so that
+#the original request line of any custom id can be read back with a single seek, e.g. to resubmit the
+#requests of a batch that failed or returned errors, without rebuilding them from customer_data and
+#without reading whole request files. the index is a small sqlite database next to the request files
+#and only new or changed request files are (re)indexed.
+
+import json, os, re, sqlite3
+from pathlib import Path
+from typing import Iterable, List
+from util import get_data_directory
+
+
+INDEX_FILE = ".request_index.sqlite"
+
+#batch_<n>_<batch id>.jsonl, named by create_samples_batch.make_and_save_batch once the batch is created
+REQUEST_FILE_RE = re.compile(r"^batch_(?P<batch_num>[0-9]+)_(?P<batch_id>batch_[0-9A-Za-z]+)\.jsonl$")
+#json.dumps writes custom_id first; anything else falls back to parsing the line
+CUSTOM_ID_RE = re.compile(rb'^\{"custom_id": "([^"\\]+)"')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    batch_num INTEGER,
+    batch_id TEXT,
+    size INTEGER,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS requests (
+    custom_id TEXT,
+    batch_id TEXT,
+    file TEXT,
+    offset INTEGER,
+    length INTEGER,
+    PRIMARY KEY (batch_id, custom_id)
+);
+CREATE INDEX IF NOT EXISTS requests_custom_id ON requests(custom_id);
+CREATE TABLE IF NOT EXISTS truncated (
+    batch_id TEXT,
+    custom_id TEXT,
+    PRIMARY KEY (batch_id, custom_id)
+);
+CREATE TABLE IF NOT EXISTS retries (
+    batch_id TEXT,
+    custom_id TEXT,
+    retry_batch_id TEXT,
+    PRIMARY KEY (batch_id, custom_id)
+);
+"""
+
+def get_custom_id(line: bytes) -> str:
+    match = CUSTOM_ID_RE.match(line)
+    if match:
+        return match.group(1).decode("utf-8")
+    return json.loads(line)["custom_id"]
+
+
+class RequestIndex:
+    """
+    custom id -> (request file, byte offset, length) for every submitted batch request.
+    """
+    def __init__(self, requests_path: Path, index_path: Path = None):
+        self.requests_path = Path(requests_path)
+        self.index_path = Path(index_path) if index_path else self.requests_path / INDEX_FILE
+        self.db = sqlite3.connect(self.index_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add_file(self, path: Path) -> int:
+        """
+        Indexes (or re-indexes) one request file. Returns the number of requests indexed, or None if the
+        file is not a submitted request file.
+        """
+        path = Path(path)
+        match = REQUEST_FILE_RE.match(path.name)
+        if not match:
+            return None
+        batch_id = match.group("batch_id")
+        rows = []
+        offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        rows.append((get_custom_id(line), batch_id, path.name, offset, len(line)))
+                    except Exception as e:
+                        print(f"Error indexing line at {offset} of {path.name}: {e}")
+                offset += len(line)
+        stat = path.stat()
+        with self.db:
+            self.db.execute("DELETE FROM requests WHERE file = ?", (path.name,))
+            self.db.executemany("INSERT OR REPLACE INTO requests (custom_id, batch_id, file, offset, length) VALUES (?,?,?,?,?)", rows)
+            self.db.execute("INSERT OR REPLACE INTO files (name, batch_num, batch_id, size, mtime) VALUES (?,?,?,?,?)",
+                            (path.name, int(match.group("batch_num")), batch_id, stat.st_size, stat.st_mtime))
+        return len(rows)
+
+    def refresh(self):
+        """
+        Indexes the new or changed request files and forgets the removed ones.
+        Returns (files indexed, files removed).
+        """
+        known = {row["name"]: (row["size"], row["mtime"]) for row in self.db.execute("SELECT name, size, mtime FROM files")}
+        indexed = 0
+        with os.scandir(self.requests_path) as entries:
+            for entry in entries:
+                if not entry.is_file() or not REQUEST_FILE_RE.match(entry.name):
+                    continue
+                stat = entry.stat()
+                if known.pop(entry.name, None) == (stat.st_size, stat.st_mtime):
+                    continue
+                self.add_file(Path(entry.path))
+                indexed += 1
+        with self.db:
+            for name in known:
+                self.db.execute("DELETE FROM requests WHERE file = ?", (name,))
+                self.db.execute("DELETE FROM files WHERE name = ?", (name,))
+        return indexed, len(known)
+
+    def custom_ids(self, batch_id: str) -> List[str]:
+        return [row["custom_id"] for row in self.db.execute("SELECT custom_id FROM requests WHERE batch_id = ?", (batch_id,))]
+
+    def lookup(self, custom_id: str, batch_id: str = None) -> sqlite3.Row:
+        """
+        Returns the index row of a request: the one of the given batch, or the most recently submitted one.
+        """
+        if batch_id:
+            return self.db.execute("SELECT * FROM requests WHERE batch_id = ? AND custom_id = ?", (batch_id, custom_id)).fetchone()
+        return self.db.execute("SELECT requests.* FROM requests JOIN files ON requests.file = files.name WHERE custom_id = ? ORDER BY files.mtime DESC",
+                               (custom_id,)).fetchone()
+
+    def read_request(self, row: sqlite3.Row) -> dict:
+        """
+        Reads the original request line of an index row.
+        """
+        with open(self.requests_path / row["file"], "rb") as f:
+            f.seek(row["offset"])
+            return json.loads(f.read(row["length"]))
+
+    def next_batch_num(self) -> int:
+        row = self.db.execute("SELECT MAX(batch_num) AS batch_num FROM files").fetchone()
+        return (row["batch_num"] or 0) + 1
+
+    def is_retried(self, batch_id: str, custom_id: str) -> bool:
+        return self.db.execute("SELECT 1 FROM retries WHERE batch_id = ? AND custom_id = ?", (batch_id, custom_id)).fetchone() is not None
+
+    def add_retries(self, retries: Iterable[tuple]):
+        """
+        Records (batch id, custom id, retry batch id) so that the same failure is not resubmitted twice.
+        """
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO retries (batch_id, custom_id, retry_batch_id) VALUES (?,?,?)", list(retries))
+
+    def add_truncated(self, batch_id: str, custom_id: str):
+        """
+        Records a request whose reply was cut off at the token limit (finish_reason=length); it is split
+        instead of resubmitted as is.
+        """
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO truncated (batch_id, custom_id) VALUES (?,?)", (batch_id, custom_id))
+
+    def is_truncated(self, batch_id: str, custom_id: str) -> bool:
+        return self.db.execute("SELECT 1 FROM truncated WHERE batch_id = ? AND custom_id = ?", (batch_id, custom_id)).fetchone() is not None
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Index batch request files by custom id (refresh, show).")
+    parser.add_argument("--input_path", default="batched-requests", type=str, help="Directory that holds the request files. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--operation", default="refresh", type=str, help="refresh: index new/changed files, show: print the request of --custom_id")
+    parser.add_argument("--custom_id", type=str, help="show: the custom id to look up.")
+    parser.add_argument("--batch", type=str, help="show: the batch the request was submitted in (defaults to the latest).")
+    args = parser.parse_args()
+
+    input_path = Path(args.input_path)
+    if not input_path.is_absolute():
+        input_path = Path(get_data_directory("datasets", args.input_path))
+    if not input_path.exists() or not input_path.is_dir():
+        raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+
+    index = RequestIndex(input_path)
+    try:
+        indexed, removed = index.refresh()
+        print(f"Request index refreshed: {indexed} files indexed, {removed} removed.")
+        if args.operation.strip() == "show":
+            row = index.lookup(args.custom_id.strip(), args.batch)
+            if not row:
+                print(f"{args.custom_id} not found.")
+            else:
+                print(f"{row['file']} @ {row['offset']} ({row['length']} bytes)")
+                print(json.dumps(index.read_request(row), indent=2)[:2000])
+    finally:
+        index.close()
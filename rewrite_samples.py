@@ -0,0 +1,152 @@
+#rewrites text in sample files using a rules file in a single pass per file.
+#replaces the chain of sed calls in datasets/replace_texts_in_samples.sh: all patterns are combined into one
+#regular expression, files are processed in parallel, files without matches are never rewritten and
+#changed files are replaced atomically. compressed files (.jsonl.gz, .jsonl.zst, see jsonl_io.py) are
+#rewritten in their own format.
+
+import json, os, re, tempfile, shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Tuple
+from util import get_data_directory
+from jsonl_io import open_jsonl, glob_jsonl, strip_suffix
+
+
+DEFAULT_RULES_FILE = "replace_rules.json"
+
+def load_rules(rules_path: Path) -> List[dict]:
+    """
+    Load the replacement rules. The rules file is a JSON list of objects:
+        {"old": "<text or pattern>", "new": "<replacement>", "regex": false}
+    "old" is taken literally unless "regex" is true.
+    When several rules match at the same position, the first one in the file wins,
+    so list longer patterns before their prefixes (e.g. '=! (is not)' before '=!').
+    """
+    with rules_path.open('r', encoding='utf-8') as f:
+        rules = json.load(f)
+    if not isinstance(rules, list) or not rules:
+        raise ValueError(f"Rules file {rules_path} must contain a non empty list of rules.")
+    for rule in rules:
+        if not isinstance(rule, dict) or not rule.get('old') or 'new' not in rule:
+            raise ValueError(f"Invalid rule in {rules_path}: {rule}")
+    return rules
+
+def compile_rules(rules: List[dict]):
+    """
+    Combine all the rules into one regular expression with a named group per rule.
+    Returns the combined expression and a function that computes the replacement for a match.
+    """
+    alternatives = []
+    replacements = {}
+    for i, rule in enumerate(rules):
+        name = f"r{i}"
+        if rule.get('regex', False):
+            alternatives.append(f"(?P<{name}>{rule['old']})")
+            #expand backreferences relative to the rule's own pattern
+            rule_re = re.compile(rule['old'])
+            replacements[name] = lambda text, rule_re=rule_re, new=rule['new']: rule_re.sub(new, text, count=1)
+        else:
+            alternatives.append(f"(?P<{name}>{re.escape(rule['old'])})")
+            replacements[name] = lambda text, new=rule['new']: new
+    combined = re.compile("|".join(alternatives))
+
+    def replace(match):
+        return replacements[match.lastgroup](match.group())
+
+    return combined, replace
+
+_combined = None
+_replace = None
+_validate_json = False
+
+def _init_worker(rules: List[dict], validate_json: bool):
+    global _combined, _replace, _validate_json
+    _combined, _replace = compile_rules(rules)
+    _validate_json = validate_json
+
+def rewrite_file(file_path: Path, dry_run: bool = False) -> Tuple[str, int, str]:
+    """
+    Apply the rules to one file.
+    Returns (file name, number of replacements, error or None). The file is left untouched
+    when nothing matches or, with JSON validation on, when a rewritten line is no longer valid JSON.
+    """
+    try:
+        with open_jsonl(file_path, 'r', newline='') as f:
+            lines = f.readlines()
+        total = 0
+        for i, line in enumerate(lines):
+            new_line, count = _combined.subn(_replace, line)
+            if count == 0:
+                continue
+            if _validate_json and new_line.strip():
+                try:
+                    json.loads(new_line)
+                except json.JSONDecodeError as e:
+                    return file_path.name, 0, f"line {i+1} is not valid JSON after rewriting: {e}"
+            lines[i] = new_line
+            total += count
+
+        if total == 0 or dry_run:
+            return file_path.name, total, None
+
+        fd, tmp_path = tempfile.mkstemp(dir=file_path.parent, prefix=f".{file_path.name}.", suffix=".tmp")
+        os.close(fd)
+        try:
+            with open_jsonl(tmp_path, 'w', suffix=file_path.name, newline='') as f:
+                f.writelines(lines)
+            shutil.copymode(file_path, tmp_path)
+            os.replace(tmp_path, file_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return file_path.name, total, None
+    except Exception as e:
+        return file_path.name, 0, str(e)
+
+def rewrite_files(files: List[Path], rules: List[dict], validate_json: bool = False, dry_run: bool = False, workers: int = None):
+    """
+    Rewrite all files in parallel. Returns (files changed, replacements, failed files).
+    """
+    changed = 0
+    replacements = 0
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rules, validate_json)) as executor:
+        for name, count, error in executor.map(rewrite_file, files, [dry_run]*len(files), chunksize=16):
+            if error:
+                print(f"Error rewriting {name}: {error}")
+                failed.append(name)
+                continue
+            if count:
+                print(f"{name}: {count} replacement(s){' (dry run)' if dry_run else ''}")
+                changed += 1
+                replacements += count
+    return changed, replacements, failed
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Rewrite text in sample files using a rules file (single pass per file).")
+    parser.add_argument("--input_path", default="batched-samples", type=str, help="Directory that holds the files. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--pattern", default="*", type=str, help="Glob pattern of the files to rewrite, without the .jsonl suffix (plain and compressed files match).")
+    parser.add_argument("--rules", default=None, type=str, help=f"Path to the rules file. Defaults to datasets/{DEFAULT_RULES_FILE}.")
+    parser.add_argument("--validate_json", default="false", type=str, help="Refuse to rewrite a file if a rewritten line is no longer valid JSON.")
+    parser.add_argument("--dry_run", default="false", type=str, help="Only report what would change.")
+    parser.add_argument("--workers", default=None, type=int, help="Number of worker processes. Defaults to the number of CPUs.")
+    args = parser.parse_args()
+
+    input_path = Path(args.input_path)
+    if not input_path.is_absolute():
+        input_path = Path(get_data_directory("datasets", args.input_path))
+    if not input_path.exists() or not input_path.is_dir():
+        raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+
+    rules_path = Path(args.rules) if args.rules else Path(get_data_directory("datasets", DEFAULT_RULES_FILE))
+    rules = load_rules(rules_path)
+
+    files = glob_jsonl(input_path, strip_suffix(args.pattern))
+    print(f"Rewriting {len(files)} file(s) in {input_path} using {len(rules)} rule(s) from {rules_path} ...")
+    changed, replacements, failed = rewrite_files(files, rules,
+                                                  validate_json=args.validate_json.lower() == "true",
+                                                  dry_run=args.dry_run.lower() == "true",
+                                                  workers=args.workers)
+    print(f"✅ {replacements} replacement(s) in {changed} file(s); {len(failed)} file(s) failed.")
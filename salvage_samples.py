@@ -0,0 +1,410 @@
+#Salvages samples from model outputs that failed to decode, instead of paying for new requests.
+#Most failures are only escaping/formatting problems: Markdown fences, invalid escapes such as \( ,
+#extra or missing ]} at the end, several objects on one line, or unescaped quotes inside strings.
+#A set of tolerant fix-ups is applied in order until the text decodes; the decoded samples are kept only
+#if they pass check_sample_structure, after the references of the prefix layout were restored (see
+#prompt_layout.restore_references).
+#Used inline by create_samples.py and process_batch_completion.py, and from the command line over existing
+#.error files and batch outputs, reporting the salvage rate and what still needs to be re-requested.
+
+import ast, json, re
+from pathlib import Path
+from typing import List, Tuple
+from util import get_data_directory
+from check_samples import check_sample_structure
+from sample_catalog import parse_sample_name, parse_custom_id
+from device_structure import extract_device_structure
+from jsonl_io import open_jsonl, find_jsonl, glob_jsonl, strip_suffix
+
+
+MAX_QUOTE_FIXES = 50      # unescaped quotes fixed per fragment before giving up
+ERROR_SEPARATOR = "\n*****\n"
+#starts the error message of outputs that were cut off (a stream that broke off, a reply at the token limit);
+#what they hold is incomplete by definition and is never salvaged
+TRUNCATED_MARKER = "TRUNCATED:"
+VALID_ESCAPES = set('"\\/bfnrtu')
+
+_decoder = json.JSONDecoder()
+
+
+def decode_all(text: str) -> list:
+    """
+    Decodes one or more concatenated JSON values. Raises json.JSONDecodeError if anything is left over.
+    """
+    values = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        value, pos = _decoder.raw_decode(text, pos)
+        values.append(value)
+        while pos < len(text) and text[pos] in " \t\r\n,":
+            pos += 1
+    if not values:
+        raise json.JSONDecodeError("Expecting value", text, 0)
+    return values
+
+def strip_fences(text: str) -> str:
+    """
+    Removes Markdown code fences (```json ... ```).
+    """
+    return re.sub(r"^\s*```[a-zA-Z]*\s*$", "", text, flags=re.M)
+
+def fix_invalid_escapes(text: str) -> str:
+    """
+    Escapes backslashes that do not start a valid JSON escape, e.g. {"\(": 1} -> {"\\(": 1}.
+    """
+    return re.sub(r"\\(.)", lambda m: m.group(0) if m.group(1) in VALID_ESCAPES else "\\\\" + m.group(1), text, flags=re.S)
+
+def fix_message_boundaries(text: str) -> str:
+    """
+    Repairs the boundaries between the messages of a sample: a messages list closed too early
+    ("...\"}]},{\"role\":...") or a message missing its opening brace ("...\"},\"role\":...").
+    Only unescaped "role" keys match, so JSON inside the contents is not touched.
+    """
+    text = re.sub(r'\}\s*\]\s*\}\s*,\s*\{\s*"role"', '},{"role"', text)
+    return re.sub(r'\}\s*,\s*"role"', '},{"role"', text)
+
+def repair_brackets(text: str) -> str:
+    """
+    Balances brackets outside of strings: drops closers that have nothing to close (the extra ]} at the end),
+    closes an open array before a } that ends its object and appends the closers that are missing.
+    Text that was cut off is left as it is: closers are only appended after a complete string, object or array,
+    never to an unterminated string or after a number that may have lost digits.
+    """
+    out = []
+    stack = []
+    in_string = False
+    escaped = False
+    for c in text:
+        if in_string:
+            out.append(c)
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+            continue
+        if c == '"':
+            in_string = True
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+        elif c in "}]":
+            if c not in stack:
+                continue
+            while stack[-1] != c:
+                out.append(stack.pop())
+            stack.pop()
+        out.append(c)
+    if stack:
+        tail = "".join(out).rstrip()
+        if in_string or not tail.endswith(('"', "}", "]")):
+            return text
+    out.extend(reversed(stack))
+    return "".join(out)
+
+def escape_inner_quotes(text: str) -> str:
+    """
+    Escapes quotes that end a string too early (e.g. "content": "say "hi" now"): each time decoding fails
+    right after a string, the quote that closed it is escaped and decoding is tried again.
+    """
+    for _ in range(MAX_QUOTE_FIXES):
+        try:
+            decode_all(text)
+            return text
+        except json.JSONDecodeError as e:
+            if not e.msg.startswith("Expecting ',' delimiter") and not e.msg.startswith("Expecting ':' delimiter") and not e.msg.startswith("Extra data"):
+                return text
+            quote = text.rfind('"', 0, e.pos)
+            if quote <= 0:
+                return text
+            text = text[:quote] + "\\" + text[quote:]
+    return text
+
+#applied cumulatively, in this order
+FIXUPS = [
+    ("fences", strip_fences),
+    ("invalid_escapes", fix_invalid_escapes),
+    ("message_boundaries", fix_message_boundaries),
+    ("brackets", repair_brackets),
+    ("unescaped_quotes", escape_inner_quotes),
+]
+
+def attach_messages(values: list) -> list:
+    """
+    Appends bare messages ({"role": ..., "content": ...}) to the sample decoded right before them;
+    they are what is left over when the model closed a sample too early.
+    """
+    attached = []
+    for value in values:
+        if isinstance(value, dict) and "role" in value and "messages" not in value and attached and isinstance(attached[-1], dict) and isinstance(attached[-1].get("messages"), list):
+            attached[-1]["messages"].append(value)
+        else:
+            attached.append(value)
+    return attached
+
+def expand_samples(value) -> List[dict]:
+    """
+    Turns a decoded value into chat samples: lists are flattened and a conversation with several
+    user/assistant pairs is split into one system/user/assistant sample per pair.
+    """
+    if isinstance(value, list):
+        return [sample for item in value for sample in expand_samples(item)]
+    if not isinstance(value, dict) or not isinstance(value.get("messages"), list):
+        return []
+    messages = value["messages"]
+    if len(messages) <= 3 or not isinstance(messages[0], dict) or messages[0].get("role") != "system":
+        return [value]
+    samples = []
+    for i in range(1, len(messages) - 1, 2):
+        samples.append({"messages": [messages[0], messages[i], messages[i+1]]})
+    return samples
+
+def salvage_text(text: str, restore=None) -> Tuple[List[dict], List[str]]:
+    """
+    Tries the fix-ups in order until the text decodes.
+
+    Args:
+        text (str): the undecodable model output (one line or several).
+        restore: applied to every decoded sample before it is checked (e.g. restore_references for the prefix layout).
+
+    Returns:
+        (samples that pass check_sample_structure, names of the fix-ups that were needed).
+        No samples means the text could not be salvaged.
+    """
+    used = []
+    for name, fixup in [("none", None)] + FIXUPS:
+        if fixup:
+            fixed = fixup(text)
+            if fixed == text:
+                continue
+            text = fixed
+            used.append(name)
+        try:
+            values = attach_messages(decode_all(text))
+        except json.JSONDecodeError:
+            continue
+        samples = expand_samples(values)
+        if restore:
+            samples = [restore(sample) for sample in samples]
+        return [sample for sample in samples if check_sample_structure(sample)], used
+    return [], used
+
+def salvage_lines(lines: List[str], restore=None) -> Tuple[List[dict], List[str]]:
+    """
+    Salvages undecodable lines. Each line is tried on its own and then together with the lines around it,
+    since a sample pretty-printed over several lines never decodes line by line.
+    Returns (samples, lines that could not be salvaged).
+    """
+    samples = []
+    failed = []
+    for line in lines:
+        salvaged, _ = salvage_text(line, restore)
+        if salvaged:
+            samples.extend(salvaged)
+        else:
+            failed.append(line)
+    if len(failed) > 1:
+        salvaged, _ = salvage_text("\n".join(failed), restore)
+        if salvaged:
+            return samples + salvaged, []
+    return samples, failed
+
+
+class SalvageReport:
+    def __init__(self):
+        self.fragments = 0
+        self.salvaged = 0
+        self.samples = 0
+        self.fixups = {}
+        self.unrecoverable = []
+        self.truncated = []
+
+    def add(self, source: str, samples: List[dict], used: List[str]):
+        self.fragments += 1
+        if not samples:
+            self.unrecoverable.append(source)
+            return
+        self.salvaged += 1
+        self.samples += len(samples)
+        for name in used or ["none"]:
+            self.fixups[name] = self.fixups.get(name, 0) + 1
+
+    def add_truncated(self, source: str):
+        self.truncated.append(source)
+        self.unrecoverable.append(source)
+
+    def print(self):
+        rate = self.salvaged / self.fragments if self.fragments else 0.0
+        print(f"Salvaged {self.salvaged} of {self.fragments} failed outputs ({rate:.1%}), {self.samples} samples recovered.")
+        for name, count in sorted(self.fixups.items(), key=lambda x: -x[1]):
+            print(f"  {name}: {count}")
+        if self.truncated:
+            print(f"{len(self.truncated)} outputs were cut off and are not salvaged; truncated batch requests are split by process_batch_completion.py --operation=retry.")
+        if self.unrecoverable:
+            print(f"{len(self.unrecoverable)} outputs could not be recovered and need to be requested again.")
+
+
+def get_restore(type: str, device_text: str = None, device_format: str = "flat"):
+    """
+    The restore callback of salvage_text for the samples of a request of a type, or None if the type is unknown.
+    """
+    from prompt_layout import restore_references
+    if not type:
+        return None
+    return lambda sample: restore_references(type, sample, device_text, device_format)
+
+def get_sibling_device_text(sample_file: Path) -> str:
+    """
+    The device structure of a request as its saved samples hold it, or None if none of them could be read.
+    """
+    sample_file = find_jsonl(sample_file)
+    if not sample_file:
+        return None
+    try:
+        with open_jsonl(sample_file, "r") as f:
+            for line in f:
+                try:
+                    structure = extract_device_structure(json.loads(line)["messages"][1]["content"])
+                except Exception:
+                    continue
+                if structure.strip() and "<DEVICE STRUCTURE>" not in structure:
+                    #the user message is DEVICE STRUCTURE:\n<devices>\n\nUSER QUERY: ...
+                    structure = structure[1:] if structure.startswith("\n") else structure
+                    return structure[:-2] if structure.endswith("\n\n") else structure
+    except Exception as e:
+        print(f"Error reading {sample_file.name}: {e}")
+    return None
+
+def get_request_restore(index, batch_id: str, custom_id: str):
+    """
+    The restore callback of salvage_text for a batch request, with its device structure if the request index has it.
+    """
+    from prompt_layout import match_request
+    type = parse_custom_id(custom_id)["type"]
+    row = index.lookup(custom_id, batch_id) if index and type else None
+    if row:
+        try:
+            layout, device_text, device_format = match_request(type, index.read_request(row)["body"]["messages"])
+            if layout:
+                return get_restore(type, device_text, device_format)
+        except Exception as e:
+            print(f"failed reading the request of {custom_id}: {e}")
+    return get_restore(type)
+
+def read_error_file(error_file: Path) -> List[Tuple[str, str]]:
+    """
+    Returns the (error message, failed output) pairs recorded in an .error file (error message, separator,
+    output; possibly repeated). Outputs saved as bytes literals (b'...') by the legacy scripts are decoded.
+    """
+    sections = error_file.read_text(encoding="utf-8").split(ERROR_SEPARATOR)
+    fragments = []
+    for i, section in enumerate(sections[1:]):
+        #the first message starts the file, the others end the previous output
+        message = sections[i].rsplit("\n", 1)[-1]
+        #the next error message, if any, follows the output on its last line
+        fragment = section.rsplit("\n", 1)[0] if section.count("\n") and section is not sections[-1] else section
+        if fragment.startswith(("b'", 'b"')):
+            try:
+                fragment = ast.literal_eval(fragment).decode("utf-8")
+            except Exception:
+                pass
+        fragments.append((message, fragment))
+    return fragments
+
+def salvage_error_files(path: Path, report: SalvageReport, dry_run: bool = False):
+    """
+    Salvages the outputs of every .error file in path. Recovered samples are appended to the sibling .jsonl
+    file; an .error file whose outputs were all recovered is renamed to .error.salvaged.
+    Outputs recorded as truncated (partial stream buffers) are not salvaged; they have to be requested again.
+    The device structure of the references is taken from the samples saved for the same request, if any.
+    """
+    for error_file in sorted(path.glob("*.error")):
+        samples = []
+        recovered = True
+        sample_file = error_file.with_suffix(".jsonl")
+        restore = get_restore((parse_sample_name(sample_file.name) or {}).get("type"), get_sibling_device_text(sample_file))
+        for message, fragment in read_error_file(error_file):
+            if message.startswith(TRUNCATED_MARKER):
+                report.add_truncated(error_file.name)
+                recovered = False
+                continue
+            salvaged, used = salvage_text(fragment, restore)
+            report.add(error_file.name, salvaged, used)
+            samples.extend(salvaged)
+            recovered = recovered and bool(salvaged)
+        if not samples or dry_run:
+            continue
+        with open_jsonl(find_jsonl(error_file.with_suffix(".jsonl")) or error_file.with_suffix(".jsonl"), "a") as f:
+            for sample in samples:
+                f.write(json.dumps(sample) + "\n")
+        print(f"✅ {len(samples)} samples salvaged from {error_file.name}")
+        if recovered:
+            error_file.rename(error_file.with_name(error_file.name + ".salvaged"))
+
+def salvage_batch_outputs(path: Path, report: SalvageReport, dry_run: bool = False, requests_path: Path = None):
+    """
+    Salvages the completions in downloaded batch outputs (<batch id>_output.jsonl) that are not in the
+    batch's store (or in a per request sample file) yet. Completions cut off at the token limit are left to
+    process_batch_completion.py --operation=retry, which requests their chunks again in halves.
+    With the batched requests in requests_path, the device structure of every request is restored into its samples.
+    """
+    from sample_generation import sample_file_name
+    from sample_store import SampleStore, get_store_path
+    from request_index import RequestIndex
+    index = RequestIndex(requests_path) if requests_path and Path(requests_path).is_dir() else None
+    try:
+        if index:
+            index.refresh()
+        for output_file in glob_jsonl(path, "batch_*_output"):
+            batch_id = strip_suffix(output_file.name)[:-len("_output")]
+            store = SampleStore(get_store_path(path, batch_id))
+            try:
+                with open_jsonl(output_file, "r") as f:
+                    for line in f:
+                        try:
+                            content = json.loads(line)
+                            custom_id = content['custom_id']
+                            choice = content['response']['body']['choices'][0]
+                            text = choice['message']['content']
+                        except Exception:
+                            continue
+                        if store.has(custom_id) or find_jsonl(path / sample_file_name(batch_id, custom_id)):
+                            continue
+                        if choice.get('finish_reason') == "length":
+                            report.add_truncated(custom_id)
+                            continue
+                        salvaged, used = salvage_text(text, get_request_restore(index, batch_id, custom_id))
+                        report.add(custom_id, salvaged, used)
+                        if salvaged and not dry_run:
+                            store.add(custom_id, salvaged)
+            finally:
+                store.close()
+    finally:
+        if index:
+            index.close()
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Salvage samples from outputs that failed to decode.")
+    parser.add_argument("--input_path", default="batched-samples", type=str, help="Directory with .error files and/or batch outputs. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--dry_run", default="false", type=str, help="Only report what could be salvaged.")
+    parser.add_argument("--unrecoverable_file", type=str, help="Write the outputs that could not be salvaged (files or custom ids) to this file.")
+    args = parser.parse_args()
+
+    input_path = Path(args.input_path)
+    if not input_path.is_absolute():
+        input_path = Path(get_data_directory("datasets", args.input_path))
+    if not input_path.exists() or not input_path.is_dir():
+        raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+
+    dry_run = args.dry_run.lower() == "true"
+    report = SalvageReport()
+    salvage_error_files(input_path, report, dry_run)
+    salvage_batch_outputs(input_path, report, dry_run, Path(get_data_directory("datasets", "batched-requests")))
+    report.print()
+    if args.unrecoverable_file:
+        with open(args.unrecoverable_file, "w") as f:
+            for source in report.unrecoverable:
+                f.write(source + "\n")
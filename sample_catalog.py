@@ -0,0 +1,306 @@
+#keeps an indexed catalog of the sample files in a directory so that selection, pruning and counting
+#do not have to list and pattern match the directory for every node (see datasets/remove_batches.sh).
+#file names are parsed once into (node uuid, chunk, type, batch id) and stored in a small sqlite database
+#that lives next to the samples. the catalog is refreshed incrementally: only new, changed or removed
+#files are touched. requests kept in per batch stores (see sample_store.py) are cataloged as
+#store_<batch id>.jsonl#<custom id>, so the same selections work for both layouts.
+
+import os, re, sqlite3
+from pathlib import Path
+from typing import List, Iterable
+from util import get_data_directory
+from sample_store import SampleStore, iter_stores
+from jsonl_io import open_jsonl
+
+
+CATALOG_FILE = ".catalog.sqlite"
+
+#custom ids are of the form nodes-<uuid>_finetune_<chunk>_<type>
+CUSTOM_ID_RE = re.compile(r"^nodes-(?P<node_uuid>[0-9A-Za-z]+)_finetune_(?P<chunk>[0-9A-Za-z]+)_(?P<type>[A-Za-z]+)$")
+#batch output: sample_<batch id>_output_<custom id>.jsonl, possibly compressed (.jsonl.gz, .jsonl.zst; see jsonl_io.py)
+BATCH_SAMPLE_RE = re.compile(r"^sample_(?P<batch_id>batch_[0-9A-Za-z]+)_output_(?P<custom_id>.+)\.jsonl(\.gz|\.zst)?$")
+#legacy: nodes-<uuid>_finetune_<chunk>_<type>.jsonl
+LEGACY_SAMPLE_RE = re.compile(r"^(?P<custom_id>nodes-.+)\.jsonl(\.gz|\.zst)?$")
+#an entry of a store: store_<batch id>.jsonl#<custom id>
+STORE_ENTRY_RE = re.compile(r"^(?P<store>store_(?P<batch_id>batch_[0-9A-Za-z]+)\.jsonl)#(?P<custom_id>.+)$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    name TEXT PRIMARY KEY,
+    custom_id TEXT,
+    node_uuid TEXT,
+    chunk TEXT,
+    type TEXT,
+    batch_id TEXT,
+    size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS samples_node_type ON samples(node_uuid, type);
+CREATE INDEX IF NOT EXISTS samples_type ON samples(type);
+CREATE INDEX IF NOT EXISTS samples_batch ON samples(batch_id);
+"""
+
+def is_chunk_part(chunk: str, row_chunk: str) -> bool:
+    """
+    True if row_chunk is the chunk itself or a part of it after splitting (3 -> 3a, 3ab; see
+    sample_generation.split_request_id).
+    """
+    return bool(row_chunk) and row_chunk.startswith(chunk) and all(c in "ab" for c in row_chunk[len(chunk):])
+
+def parse_custom_id(custom_id: str) -> dict:
+    """
+    Parses a request custom id into node_uuid, chunk and type.
+    Unknown forms (e.g. nucore_generic_1234) only get a type if one can be guessed.
+    """
+    match = CUSTOM_ID_RE.match(custom_id)
+    if match:
+        return match.groupdict()
+    return {"node_uuid": None, "chunk": None, "type": custom_id.split("_")[0] if custom_id.startswith("nucore_") else None}
+
+def parse_sample_name(name: str) -> dict:
+    """
+    Parses a sample file name into its catalog fields.
+
+    Args:
+        name (str): the file name (not the path).
+
+    Returns:
+        dict: custom_id, node_uuid, chunk, type and batch_id, or None if the name is not a sample file.
+    """
+    match = BATCH_SAMPLE_RE.match(name) or STORE_ENTRY_RE.match(name)
+    if match:
+        batch_id = match.group("batch_id")
+        custom_id = match.group("custom_id")
+    else:
+        match = LEGACY_SAMPLE_RE.match(name)
+        if not match:
+            return None
+        batch_id = None
+        custom_id = match.group("custom_id")
+    fields = parse_custom_id(custom_id)
+    fields["custom_id"] = custom_id
+    fields["batch_id"] = batch_id
+    return fields
+
+
+class SampleCatalog:
+    """
+    An indexed table of the sample files in one directory.
+    """
+    def __init__(self, samples_path: Path, catalog_path: Path = None):
+        self.samples_path = Path(samples_path)
+        self.catalog_path = Path(catalog_path) if catalog_path else self.samples_path / CATALOG_FILE
+        self.db = sqlite3.connect(self.catalog_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _upsert(self, name: str, fields: dict, size: int, mtime: float):
+        self.db.execute(
+            "INSERT OR REPLACE INTO samples (name, custom_id, node_uuid, chunk, type, batch_id, size, mtime) VALUES (?,?,?,?,?,?,?,?)",
+            (name, fields["custom_id"], fields["node_uuid"], fields["chunk"], fields["type"], fields["batch_id"], size, mtime))
+
+    def add(self, path: Path) -> bool:
+        """
+        Adds (or updates) a single file as it arrives. Returns False if the file is not a sample file.
+        """
+        path = Path(path)
+        fields = parse_sample_name(path.name)
+        if not fields:
+            return False
+        stat = path.stat()
+        with self.db:
+            self._upsert(path.name, fields, stat.st_size, stat.st_mtime)
+        return True
+
+    def refresh(self):
+        """
+        Synchronizes the catalog with the directory. Only new, changed or removed files are written.
+        Returns (added or updated, removed).
+        """
+        known = {row["name"]: (row["size"], row["mtime"]) for row in self.db.execute("SELECT name, size, mtime FROM samples")}
+        updated = 0
+        with self.db:
+            with os.scandir(self.samples_path) as entries:
+                for entry in entries:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    previous = known.pop(entry.name, None)
+                    if previous == (stat.st_size, stat.st_mtime):
+                        continue
+                    fields = parse_sample_name(entry.name)
+                    if not fields:
+                        continue
+                    self._upsert(entry.name, fields, stat.st_size, stat.st_mtime)
+                    updated += 1
+            for store_path in iter_stores(self.samples_path):
+                updated += self._refresh_store(store_path, known)
+            #whatever is left is gone from the directory
+            self.db.executemany("DELETE FROM samples WHERE name = ?", [(name,) for name in known])
+        return updated, len(known)
+
+    def _refresh_store(self, store_path: Path, known: dict) -> int:
+        """
+        Catalogs the entries of a store that are not retired; their names are removed from known.
+        """
+        store = SampleStore(store_path)
+        mtime = store.index_path.stat().st_mtime if store.index_path.exists() else 0.0
+        updated = 0
+        for custom_id, entry in store.iter_entries():
+            name = f"{store_path.name}#{custom_id}"
+            if known.pop(name, None) == (entry["length"], mtime):
+                continue
+            self._upsert(name, parse_sample_name(name), entry["length"], mtime)
+            updated += 1
+        return updated
+
+    def read_lines(self, row: sqlite3.Row) -> List[str]:
+        """
+        Returns the JSONL lines of a catalog row, from its own file or from its store.
+        """
+        match = STORE_ENTRY_RE.match(row["name"])
+        if match:
+            return SampleStore(self.samples_path / match.group("store")).read_lines(match.group("custom_id"))
+        with open_jsonl(self.samples_path / row["name"], "r") as f:
+            return f.read().splitlines()
+
+    def _where(self, node_uuids: Iterable[str] = None, types: Iterable[str] = None, batch_id: str = None, exclude_batch: str = None):
+        clauses = []
+        params = []
+        if node_uuids is not None:
+            node_uuids = list(node_uuids)
+            clauses.append(f"node_uuid IN ({','.join('?' * len(node_uuids))})")
+            params.extend(node_uuids)
+        if types is not None:
+            types = list(types)
+            clauses.append(f"type IN ({','.join('?' * len(types))})")
+            params.extend(types)
+        if batch_id:
+            clauses.append("instr(batch_id, ?) > 0")
+            params.append(batch_id)
+        if exclude_batch:
+            clauses.append("(batch_id IS NULL OR instr(batch_id, ?) = 0)")
+            params.append(exclude_batch)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def select(self, node_uuids: Iterable[str] = None, types: Iterable[str] = None, batch_id: str = None, exclude_batch: str = None) -> List[sqlite3.Row]:
+        """
+        Returns the catalog rows matching all the given filters. batch ids match as substrings like grep did.
+        """
+        where, params = self._where(node_uuids, types, batch_id, exclude_batch)
+        return self.db.execute(f"SELECT * FROM samples{where} ORDER BY node_uuid, type, chunk", params).fetchall()
+
+    def counts_per_node(self, types: Iterable[str] = None, batch_id: str = None) -> List[sqlite3.Row]:
+        """
+        Returns (node_uuid, type, files) rows.
+        """
+        where, params = self._where(None, types, batch_id, None)
+        return self.db.execute(f"SELECT node_uuid, type, COUNT(*) AS files FROM samples{where} GROUP BY node_uuid, type ORDER BY node_uuid, type", params).fetchall()
+
+    def prune(self, keep_batch: str, types: Iterable[str] = None, node_uuids: Iterable[str] = None, dry_run: bool = False) -> int:
+        """
+        Removes every sample file of the given types/nodes that does not belong to keep_batch.
+        Returns the number of files removed.
+        """
+        return self.remove(self.select(node_uuids=node_uuids, types=types, exclude_batch=keep_batch), dry_run)
+
+    def retire_chunks(self, node_uuid: str, chunks: Iterable[str], types: Iterable[str] = None, dry_run: bool = False) -> int:
+        """
+        Removes the sample files of chunks that no longer exist (see sample_generation.diff_node), including
+        the parts they were split into. Returns the number of files removed.
+        """
+        chunks = set(chunks)
+        if not chunks:
+            return 0
+        return self.remove([row for row in self.select(node_uuids=[node_uuid], types=types)
+                            if any(is_chunk_part(chunk, row["chunk"]) for chunk in chunks)], dry_run)
+
+    def has_chunk(self, node_uuid: str, chunk: str, type: str) -> bool:
+        """
+        True if there are samples of the chunk (or of its parts) of a node.
+        """
+        return any(row["size"] and is_chunk_part(chunk, row["chunk"]) for row in self.select(node_uuids=[node_uuid], types=[type]))
+
+    def remove(self, rows: List[sqlite3.Row], dry_run: bool = False) -> int:
+        """
+        Removes the files of the given catalog rows. Returns the number of files removed.
+        """
+        removed = 0
+        stores = {}
+        with self.db:
+            for row in rows:
+                print(f"removing {row['name']}{' (dry run)' if dry_run else ''}")
+                if dry_run:
+                    continue
+                try:
+                    match = STORE_ENTRY_RE.match(row["name"])
+                    if match:
+                        #entries of a store are retired rather than removed
+                        store_name = match.group("store")
+                        if store_name not in stores:
+                            stores[store_name] = SampleStore(self.samples_path / store_name)
+                        stores[store_name].retire([match.group("custom_id")])
+                    else:
+                        (self.samples_path / row["name"]).unlink(missing_ok=True)
+                except Exception as e:
+                    print(f"Error removing {row['name']}: {e}")
+                    continue
+                self.db.execute("DELETE FROM samples WHERE name = ?", (row["name"],))
+                removed += 1
+            for store in stores.values():
+                store.close()
+        return removed
+
+
+def get_node_uuids(nodes_path: Path) -> List[str]:
+    """
+    Returns the uuids of the customer nodes (nodes-<uuid>.xml).
+    """
+    return [node_file.stem.split("-", 1)[1] for node_file in Path(nodes_path).glob("nodes-*.xml")]
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Indexed catalog of sample files (refresh, list, counts, prune).")
+    parser.add_argument("--input_path", default="batched-samples", type=str, help="Directory that holds the samples. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--operation", default="counts", type=str, help="Operation to perform: refresh, list, counts, prune")
+    parser.add_argument("--types", type=str, help="Comma separated sample types to restrict to: properties, commands, routines.")
+    parser.add_argument("--batch", type=str, help="Only list/count samples of this batch.")
+    parser.add_argument("--keep_batch", type=str, help="prune: the batch NOT to be removed.")
+    parser.add_argument("--nodes_path", type=str, help="Restrict to the nodes found in this directory (e.g. customer_data/nodes).")
+    parser.add_argument("--dry_run", default="false", type=str, help="prune: only print what would be removed.")
+    args = parser.parse_args()
+
+    input_path = Path(args.input_path)
+    if not input_path.is_absolute():
+        input_path = Path(get_data_directory("datasets", args.input_path))
+    if not input_path.exists() or not input_path.is_dir():
+        raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+
+    types = [t.strip() for t in args.types.split(",")] if args.types else None
+    node_uuids = get_node_uuids(Path(args.nodes_path)) if args.nodes_path else None
+    operation = args.operation.strip()
+
+    catalog = SampleCatalog(input_path)
+    updated, removed = catalog.refresh()
+    print(f"Catalog refreshed: {updated} new/changed, {removed} removed.")
+    try:
+        if operation == "list":
+            for row in catalog.select(node_uuids=node_uuids, types=types, batch_id=args.batch):
+                print(f"{row['node_uuid']}\t{row['chunk']}\t{row['type']}\t{row['batch_id']}\t{row['name']}")
+        elif operation == "counts":
+            for row in catalog.counts_per_node(types=types, batch_id=args.batch):
+                if node_uuids is None or row['node_uuid'] in node_uuids:
+                    print(f"{row['node_uuid']}\t{row['type']}\t{row['files']}")
+        elif operation == "prune":
+            if not args.keep_batch:
+                raise ValueError("prune needs --keep_batch")
+            removed = catalog.prune(args.keep_batch.strip(), types=types, node_uuids=node_uuids, dry_run=args.dry_run.lower() == "true")
+            print(f"✅ {removed} files removed.")
+        elif operation != "refresh":
+            print(f"Unknown operation {operation}")
+    finally:
+        catalog.close()
@@ -0,0 +1,367 @@
+#Shared pieces of sample generation: loading the training prompts, walking customer_data nodes into
+#device structure chunks and naming requests/samples. Used by create_samples.py (synchronous),
+#create_samples_batch.py (Batch API) and generate_samples.py (chooses between the two).
+#Chunks are numbered by position (iter_node_chunks) or, for incremental runs, identified by a hash of the
+#device blocks they hold (diff_node) so that adding a device to a node does not rename every following chunk.
+#The number of devices per chunk adapts to the output cost per device learned from previous completions
+#(get_chunk_size), and a chunk whose reply was cut off at the token limit is split (split_request_id).
+
+import hashlib, json, os, re, threading, time
+from pathlib import Path
+from nucore import NuCore
+from util import get_data_directory, write_json_atomic
+from typing import Literal, Iterator, List, Tuple
+
+
+PROMPTS_DIR = Path(get_data_directory("prompts", None))
+if not PROMPTS_DIR.exists():
+    raise FileNotFoundError(f"Prompt directory {PROMPTS_DIR} does not exist. Please use git clone to get everything." )
+
+CHUNK_SIZE = 3    # number of device documents per request (at most; see get_chunk_size)
+CHUNK_COSTS_FILE = "chunk_costs.json"    # under datasets: learned output tokens per device and token limits
+COST_SMOOTHING = 0.1                     # weight of the newest observation in the tokens per device average
+LIMIT_SAFETY = 0.8                       # plan chunks to use at most this share of the observed token limit
+NODE_STATE_DIR = "node-state"    # under datasets: the chunks of every node as of the last incremental run
+
+
+def load_prompt_parts(type: Literal["properties", "commands", "routines", "nucore"]) -> Tuple[str, str]:
+    """
+    Returns (training prompt template, runtime system prompt) for a type. The runtime system prompt (preamble)
+    has its newlines escaped since it is meant to be spliced into the JSON example of the template.
+    """
+    try:
+        with open(os.path.join(PROMPTS_DIR, f"{type}.prompt.train"), "r") as f:
+            train_prompt = f.read()
+    except:
+        raise ValueError(f"Failed to load training prompt for type {type}.")
+
+    try:
+        with open(os.path.join(PROMPTS_DIR, f"system.prompt.preamble"), "r") as f:
+            run_prompt = f.read().replace("\n", "\\n")
+    except:
+        raise ValueError(f"Failed to load run prompt for type {type}.")
+    return train_prompt, run_prompt
+
+def load_train_prompt(type: Literal["properties", "commands", "routines", "nucore"]) -> str:
+    """
+    Returns the training prompt for a type with the runtime system prompt (preamble) spliced in.
+    {{DEVICE_STRUCTURE}} is left in place; see render_system_prompt.
+    """
+    train_prompt, run_prompt = load_prompt_parts(type)
+    ##Now, replace {{NUCORE_BASICS}} in SYSTEM_PROMPT with RUNTIME_SYSTEM_PROMPT
+    return train_prompt.replace("{{TEMPLATE_PROMPTS_RUNTIME}}", f"{run_prompt}")
+
+def render_system_prompt(train_prompt: str, full_text: str) -> str:
+    # replace <device_info> in the system prompt with the actual device info
+    return train_prompt.replace("{{DEVICE_STRUCTURE}}", full_text)
+
+def make_request_id(node_stem: str, chunk: int, type: str) -> str:
+    """
+    The custom id of a request, e.g. nodes-000db9533594_finetune_3_commands
+    """
+    return f"{node_stem}_finetune_{chunk}_{type}"
+
+def sample_file_name(batch_id: str, custom_id: str) -> str:
+    """
+    The name of the file holding the samples generated for one request. Batch results and synchronous
+    results share this layout (synchronous runs use a batch_sync<timestamp> batch id).
+    """
+    return f"sample_{batch_id}_output_{custom_id}.jsonl"
+
+def split_request_id(custom_id: str, part: str) -> str:
+    """
+    The id of a part of a split chunk: the part letter is appended to the chunk,
+    e.g. nodes-000db9533594_finetune_3_commands -> nodes-000db9533594_finetune_3a_commands
+    """
+    return re.sub(r"_finetune_([0-9A-Za-z]+)_([A-Za-z]+)$", lambda m: f"_finetune_{m.group(1)}{part}_{m.group(2)}", custom_id)
+
+def extract_device_text(train_prompt: str, system_content: str) -> str:
+    """
+    The inverse of render_system_prompt: returns the device structure a system prompt was rendered with,
+    or None if the system prompt was not rendered from this training prompt (e.g. the prompt changed since).
+    """
+    parts = train_prompt.split("{{DEVICE_STRUCTURE}}")
+    if len(parts) < 2 or not system_content.startswith(parts[0]):
+        return None
+    #every occurrence of the marker holds the same text
+    length, rest = divmod(len(system_content) - sum(len(part) for part in parts), len(parts) - 1)
+    if length < 0 or rest:
+        return None
+    device_text = system_content[len(parts[0]):len(parts[0])+length]
+    return device_text if render_system_prompt(train_prompt, device_text) == system_content else None
+
+def get_nodes_and_profiles_dirs(input_path: Path) -> Tuple[Path, Path]:
+    # the input directory holds profiles and nodes directories
+    nodes_dir = input_path / "nodes"
+    profiles_dir = input_path / "profiles"
+    if not nodes_dir.exists() or not nodes_dir.is_dir():
+        raise ValueError(f"Nodes directory {nodes_dir} does not exist or is not a directory.")
+    if not profiles_dir.exists() or not profiles_dir.is_dir():
+        raise ValueError(f"Profiles directory {profiles_dir} does not exist or is not a directory.")
+    return nodes_dir, profiles_dir
+
+def load_node_documents(node_file: Path, profiles_dir: Path) -> List[str]:
+    """
+    Formats the devices of one node with NuCore. Returns the device documents or None on failure.
+    """
+    profile_file = profiles_dir / (f"{node_file.stem}.json").replace("nodes-", "profile-")
+    print(f"Processing node: {node_file.name} with profile: {profile_file.name}")
+    if not profile_file.exists():
+        print(f"Warning: Profile file {profile_file} does not exist for node {node_file}. Skipping.")
+        return None
+    nuCore = NuCore(collection_path="/tmp/nucore.finetuner", collection_name="finetuner", backend_url="http://localhost:8000", backend_username="admin", backend_password="admin"
+    )
+    try:
+        nuCore.load(include_rag_docs=False, profile_path=profile_file, nodes_path=node_file)
+    except Exception as e:
+        print(f"Error loading NuCore with profile {profile_file} and node {node_file}. Skipping: {e}")
+        return None
+    try:
+        rag = nuCore.format_nodes()
+    except Exception as e:
+        print(f"Error formatting nodes for profile {profile_file} and node {node_file}. Skipping: {e}")
+        return None
+    if not rag:
+        print(f"Warning: No RAG documents found for node {node_file}. Skipping.")
+        return None
+    rag_docs = rag["documents"]
+    if not rag_docs:
+        print(f"Warning: No documents found in RAG for node {node_file}. Skipping.")
+        return None
+    return rag_docs
+
+def iter_node_documents(input_path: Path, nodes: List[str] = None) -> Iterator[Tuple[Path, List[str]]]:
+    """
+    Walks the nodes in input_path/nodes and yields (node_file, device documents) for every node NuCore could format.
+
+    Args:
+        input_path (Path): the directory that holds the nodes and profiles directories.
+        nodes (List[str]): optional node stems or uuids to restrict to (e.g. only the changed nodes).
+    """
+    nodes_dir, profiles_dir = get_nodes_and_profiles_dirs(input_path)
+    for node_file in sorted(nodes_dir.glob("*.xml")):
+        if nodes and node_file.stem not in nodes and node_file.stem.split("-", 1)[-1] not in nodes:
+            continue
+        rag_docs = load_node_documents(node_file, profiles_dir)
+        if rag_docs:
+            yield node_file, rag_docs
+
+def chunk_documents(rag_docs: List[str], chunk_size: int = CHUNK_SIZE) -> List[str]:
+    return ["".join(rag_docs[i:i+chunk_size]) for i in range(0, len(rag_docs), chunk_size)]
+
+def iter_node_chunks(input_path: Path, nodes: List[str] = None, chunk_size: int = CHUNK_SIZE) -> Iterator[Tuple[Path, int, str]]:
+    """
+    Yields (node_file, chunk number, device structure text) for every group of chunk_size devices of
+    every node (see iter_node_documents). Chunks are numbered from 1.
+    """
+    for node_file, rag_docs in iter_node_documents(input_path, nodes):
+        for i, full_text in enumerate(chunk_documents(rag_docs, chunk_size)):
+            yield node_file, i + 1, full_text
+
+def get_device_hash(document: str) -> str:
+    return hashlib.sha1(document.strip().encode("utf-8")).hexdigest()[:12]
+
+def get_chunk_id(device_hashes: List[str]) -> str:
+    """
+    A chunk is identified by the devices it holds, not by its position in the node.
+    """
+    return hashlib.sha1("".join(sorted(device_hashes)).encode("utf-8")).hexdigest()[:12]
+
+def diff_node(rag_docs: List[str], previous: dict, chunk_size: int = CHUNK_SIZE) -> Tuple[List[Tuple[str, str]], List[str], dict]:
+    """
+    Compares the device documents of a node with the chunks of the previous run.
+    Chunks whose devices are all unchanged are kept. Chunks holding a changed or removed device are retired,
+    and their remaining devices are chunked again together with the added and changed ones.
+
+    Args:
+        rag_docs (List[str]): the device documents as formatted now.
+        previous (dict): the node state saved by the previous run ({"chunks": {chunk id: [device hashes]}}).
+
+    Returns:
+        (new chunks as (chunk id, device structure text), retired chunk ids, the node state to save)
+    """
+    documents = {}
+    for document in rag_docs:
+        documents.setdefault(get_device_hash(document), document)
+    previous_chunks = previous.get("chunks", {}) if previous else {}
+    chunks = {chunk_id: hashes for chunk_id, hashes in previous_chunks.items() if all(h in documents for h in hashes)}
+    retired = [chunk_id for chunk_id in previous_chunks if chunk_id not in chunks]
+    chunked = {h for hashes in chunks.values() for h in hashes}
+    pending = [h for h in documents if h not in chunked]
+    new_chunks = []
+    for i in range(0, len(pending), chunk_size):
+        hashes = pending[i:i+chunk_size]
+        chunk_id = get_chunk_id(hashes)
+        chunks[chunk_id] = hashes
+        new_chunks.append((chunk_id, "".join(documents[h] for h in hashes)))
+    return new_chunks, retired, {"chunks": chunks}
+
+def get_node_state_path(type: str, node_stem: str) -> Path:
+    return Path(get_data_directory("datasets", NODE_STATE_DIR)) / type / f"{node_stem}.json"
+
+def load_node_state(type: str, node_stem: str) -> dict:
+    try:
+        with open(get_node_state_path(type, node_stem), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Error loading the state of {node_stem} ({type}); treating every device as new: {e}")
+        return {}
+
+def save_node_state(type: str, node_stem: str, state: dict):
+    path = get_node_state_path(type, node_stem)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_json_atomic(path, state)
+
+def get_pending_state(previous: dict, state: dict, requested: List[str]) -> dict:
+    """
+    The node state to save once the new chunks of diff_node were requested. Only the chunks that were not
+    requested (e.g. already covered) are committed right away; the requested ones stay pending until their
+    samples exist, and the chunks they replace are kept as retired until then (see commit_node_state).
+
+    Returns:
+        {"chunks": {chunk id: [device hashes]}, "pending": {chunk id: {"devices": [device hashes], "requested": time}},
+         "retired": {chunk id: [device hashes]}}
+    """
+    previous = previous or {}
+    previous_chunks = previous.get("chunks", {})
+    previous_pending = previous.get("pending", {})
+    retired = dict(previous.get("retired", {}))
+    retired.update({chunk_id: hashes for chunk_id, hashes in previous_chunks.items() if chunk_id not in state["chunks"]})
+    chunks = {}
+    pending = {}
+    now = time.time()
+    for chunk_id, hashes in state["chunks"].items():
+        if chunk_id in requested:
+            pending[chunk_id] = {"devices": hashes, "requested": now}
+        elif chunk_id in previous_pending and chunk_id not in previous_chunks:
+            pending[chunk_id] = previous_pending[chunk_id]
+        else:
+            chunks[chunk_id] = hashes
+    #pending chunks whose devices changed again: their samples may still arrive
+    retired.update({chunk_id: entry["devices"] for chunk_id, entry in previous_pending.items() if chunk_id not in state["chunks"]})
+    retired = {chunk_id: hashes for chunk_id, hashes in retired.items() if chunk_id not in state["chunks"]}
+    return {"chunks": chunks, "pending": pending, "retired": retired}
+
+def commit_node_state(type: str, node_stem: str, catalog) -> Tuple[int, int]:
+    """
+    Commits the pending chunks of a node whose samples exist in the catalog (SampleCatalog, refreshed), then
+    retires the samples of the retired chunks none of whose devices still wait for a pending chunk.
+    Returns (chunks committed, sample files removed).
+    """
+    state = load_node_state(type, node_stem)
+    pending = state.get("pending", {})
+    retired = state.get("retired", {})
+    if not pending and not retired:
+        return 0, 0
+    node_uuid = node_stem.split("-", 1)[-1]
+    committed = [chunk_id for chunk_id in pending if catalog.has_chunk(node_uuid, chunk_id, type)]
+    for chunk_id in committed:
+        state.setdefault("chunks", {})[chunk_id] = pending.pop(chunk_id)["devices"]
+    waiting = {h for entry in pending.values() for h in entry["devices"]}
+    done = [chunk_id for chunk_id, hashes in retired.items() if not waiting.intersection(hashes)]
+    removed = catalog.retire_chunks(node_uuid, done, types=[type]) if done else 0
+    for chunk_id in done:
+        del retired[chunk_id]
+    if committed or done:
+        save_node_state(type, node_stem, state)
+    return len(committed), removed
+
+def commit_node_states(catalog, types: List[str] = None) -> Tuple[int, int]:
+    """
+    commit_node_state for every node with pending or retired chunks. Returns (chunks committed, sample files removed).
+    """
+    state_path = Path(get_data_directory("datasets", NODE_STATE_DIR))
+    committed = removed = 0
+    for type_path in sorted(state_path.iterdir()) if state_path.is_dir() else []:
+        if not type_path.is_dir() or (types and type_path.name not in types):
+            continue
+        for path in sorted(type_path.glob("*.json")):
+            try:
+                node_committed, node_removed = commit_node_state(type_path.name, path.stem, catalog)
+            except Exception as e:
+                print(f"Error committing the state of {path.stem} ({type_path.name}): {e}")
+                continue
+            if node_removed:
+                print(f"{path.stem}: {node_removed} {type_path.name} sample files of changed/removed devices retired")
+            committed += node_committed
+            removed += node_removed
+    return committed, removed
+
+_chunk_costs_lock = threading.Lock()
+
+def load_chunk_costs() -> dict:
+    """
+    {type: {"tokens_per_device": average output tokens per device, "limit": lowest completion tokens of a truncated reply}}
+    """
+    try:
+        with open(Path(get_data_directory("datasets", CHUNK_COSTS_FILE)), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"Error loading chunk costs; using the default chunk size: {e}")
+        return {}
+
+def record_completion(type: str, devices: int, completion_tokens: int, truncated: bool):
+    """
+    Learns from a completion: the output tokens per device (from complete replies) and the token limit
+    (from replies cut off with finish_reason=length).
+    """
+    if not devices or not completion_tokens:
+        return
+    with _chunk_costs_lock:
+        costs = load_chunk_costs()
+        cost = costs.setdefault(type, {})
+        if truncated:
+            cost["limit"] = min(cost.get("limit", completion_tokens), completion_tokens)
+            cost["truncated"] = cost.get("truncated", 0) + 1
+        else:
+            observed = completion_tokens / devices
+            previous = cost.get("tokens_per_device")
+            cost["tokens_per_device"] = observed if previous is None else (1 - COST_SMOOTHING) * previous + COST_SMOOTHING * observed
+            cost["completions"] = cost.get("completions", 0) + 1
+        write_json_atomic(Path(get_data_directory("datasets", CHUNK_COSTS_FILE)), costs)
+
+def get_chunk_size(type: str) -> int:
+    """
+    The number of devices per request for a type: CHUNK_SIZE, unless the learned output per device would not
+    fit in the observed token limit, in which case as many devices as fit (at least 1).
+    """
+    cost = load_chunk_costs().get(type, {})
+    if not cost.get("limit") or not cost.get("tokens_per_device"):
+        return CHUNK_SIZE
+    return max(1, min(CHUNK_SIZE, int(cost["limit"] * LIMIT_SAFETY / cost["tokens_per_device"])))
+
+class JsonlStreamExtractor:
+    """
+    Turns a stream of text deltas into JSONL entries: feed() returns the entries whose line was completed
+    by the new text, as (parsed object, None) or (None, (error, line)) when the line is not valid JSON.
+    """
+    def __init__(self):
+        self.buffer = ""
+
+    def _parse(self, line: str):
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            return json.loads(line), None
+        except json.JSONDecodeError as e:
+            return None, (e, line)
+
+    def feed(self, text: str) -> List[tuple]:
+        if not text:
+            return []
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        return [entry for entry in map(self._parse, lines) if entry]
+
+    def flush(self) -> List[tuple]:
+        """
+        Parses whatever is left once the stream is complete (the last line has no newline).
+        """
+        line, self.buffer = self.buffer, ""
+        entry = self._parse(line)
+        return [entry] if entry else []
@@ -0,0 +1,212 @@
+#stores the samples of a whole batch in one file (store_<batch id>.jsonl) instead of one small file per
+#request. a sidecar index (store_<batch id>.idx.json) maps every custom id to the region of the store that
+#holds its samples (offset, length, number of samples) together with its type, node and chunk.
+#the store itself is plain JSONL; entries are only ever appended, and retired entries (e.g. invalid or of
+#removed devices) are flagged in the index and skipped by the readers.
+#a per custom id file (sample_<batch id>_output_<custom id>.jsonl) can still be written on demand (view).
+
+import json, os, re
+from pathlib import Path
+from typing import Iterator, List, Tuple
+from util import get_data_directory, write_json_atomic
+from jsonl_io import open_jsonl
+
+
+STORE_RE = re.compile(r"^store_(?P<batch_id>batch_[0-9A-Za-z]+)\.jsonl$")
+LEGACY_BATCH_ID = "batch_legacy"    # pack: samples that were not produced by a batch
+
+
+def get_store_path(path: Path, batch_id: str) -> Path:
+    return Path(path) / f"store_{batch_id}.jsonl"
+
+def get_index_path(store_path: Path) -> Path:
+    return store_path.with_suffix(".idx.json")
+
+
+class SampleStore:
+    """
+    The samples of one batch and their index. Call close() to persist the index after adding samples.
+    """
+    def __init__(self, store_path: Path):
+        self.store_path = Path(store_path)
+        self.index_path = get_index_path(self.store_path)
+        match = STORE_RE.match(self.store_path.name)
+        self.batch_id = match.group("batch_id") if match else None
+        self.entries = {}
+        self.dirty = False
+        if self.index_path.exists():
+            with self.index_path.open("r", encoding="utf-8") as f:
+                self.entries = json.load(f).get("entries", {})
+
+    def has(self, custom_id: str) -> bool:
+        """
+        True if the custom id was stored, even if it was retired since; its samples are not added again.
+        """
+        return custom_id in self.entries
+
+    def add(self, custom_id: str, samples: List[dict]):
+        """
+        Appends the samples of one request.
+        """
+        from sample_catalog import parse_custom_id
+        data = "".join(json.dumps(sample) + "\n" for sample in samples).encode("utf-8")
+        with open(self.store_path, "ab") as f:
+            offset = f.tell()
+            f.write(data)
+        fields = parse_custom_id(custom_id)
+        self.entries[custom_id] = {"offset": offset, "length": len(data), "count": len(samples),
+                                   "type": fields["type"], "node_uuid": fields["node_uuid"], "chunk": fields["chunk"]}
+        self.dirty = True
+
+    def retire(self, custom_ids) -> int:
+        """
+        Flags entries so that the readers skip them. Returns the number of entries retired.
+        """
+        retired = 0
+        for custom_id in custom_ids:
+            entry = self.entries.get(custom_id)
+            if entry and not entry.get("retired"):
+                entry["retired"] = True
+                retired += 1
+        self.dirty = self.dirty or retired > 0
+        return retired
+
+    def close(self):
+        if self.dirty:
+            write_json_atomic(self.index_path, {"batch_id": self.batch_id, "entries": self.entries})
+            self.dirty = False
+
+    def iter_entries(self, types=None) -> Iterator[Tuple[str, dict]]:
+        """
+        Yields (custom id, entry) of the entries that are not retired, in store order.
+        """
+        for custom_id, entry in sorted(self.entries.items(), key=lambda item: item[1]["offset"]):
+            if entry.get("retired") or (types is not None and entry["type"] not in types):
+                continue
+            yield custom_id, entry
+
+    def read_lines(self, custom_id: str) -> List[str]:
+        entry = self.entries[custom_id]
+        with open(self.store_path, "rb") as f:
+            f.seek(entry["offset"])
+            return f.read(entry["length"]).decode("utf-8").splitlines()
+
+    def read(self, custom_id: str) -> List[dict]:
+        return [json.loads(line) for line in self.read_lines(custom_id) if line.strip()]
+
+    def iter_lines(self, types=None) -> Iterator[Tuple[str, str]]:
+        """
+        Yields (custom id, JSONL line) for every sample of the entries that are not retired.
+        The store is read sequentially, in one pass.
+        """
+        with open(self.store_path, "rb") as f:
+            for custom_id, entry in self.iter_entries(types):
+                f.seek(entry["offset"])
+                for line in f.read(entry["length"]).decode("utf-8").splitlines():
+                    if line.strip():
+                        yield custom_id, line
+
+    def write_view(self, custom_id: str, output_path: Path) -> Path:
+        """
+        Writes the samples of one custom id to its own file, named like the per request files.
+        """
+        from sample_generation import sample_file_name
+        view_path = Path(output_path) / sample_file_name(self.batch_id, custom_id)
+        with open(view_path, "w", encoding="utf-8") as f:
+            for line in self.read_lines(custom_id):
+                f.write(line + "\n")
+        return view_path
+
+
+def iter_stores(path: Path) -> Iterator[Path]:
+    """
+    Yields the store files in a directory.
+    """
+    for store_path in sorted(Path(path).glob("store_batch_*.jsonl")):
+        if STORE_RE.match(store_path.name):
+            yield store_path
+
+def pack(path: Path, dry_run: bool = False) -> int:
+    """
+    Moves the per request sample files of a directory into the stores of their batches (samples without a
+    batch go to store_batch_legacy.jsonl) and removes them. Returns the number of files packed.
+    """
+    from sample_catalog import SampleCatalog
+    catalog = SampleCatalog(path)
+    stores = {}
+    packed = 0
+    try:
+        catalog.refresh()
+        for row in catalog.select():
+            if "#" in row["name"]:
+                continue
+            batch_id = row["batch_id"] or LEGACY_BATCH_ID
+            if batch_id not in stores:
+                stores[batch_id] = SampleStore(get_store_path(path, batch_id))
+            store = stores[batch_id]
+            if store.has(row["custom_id"]):
+                print(f"{row['custom_id']} is already in {store.store_path.name}; skipping {row['name']}")
+                continue
+            print(f"packing {row['name']} into {store.store_path.name}{' (dry run)' if dry_run else ''}")
+            if dry_run:
+                continue
+            samples = []
+            with open_jsonl(Path(path) / row["name"], "r") as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            samples.append(json.loads(line))
+                        except json.JSONDecodeError as e:
+                            print(f"Error decoding JSON in {row['name']}: {e}")
+            store.add(row["custom_id"], samples)
+            #the index must be saved before the file it replaces is removed
+            store.close()
+            os.remove(Path(path) / row["name"])
+            packed += 1
+        catalog.refresh()
+    finally:
+        for store in stores.values():
+            store.close()
+        catalog.close()
+    return packed
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Per batch sample stores (list, view, pack).")
+    parser.add_argument("--input_path", default="batched-samples", type=str, help="Directory that holds the stores. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--operation", default="list", type=str, help="list: entries per store, view: write the samples of --custom_id to their own file, pack: move per request files into stores")
+    parser.add_argument("--custom_id", type=str, help="view: the custom id.")
+    parser.add_argument("--output_path", type=str, help="view: where to write the file; prints the samples if none given.")
+    parser.add_argument("--dry_run", default="false", type=str, help="pack: only print what would be packed.")
+    args = parser.parse_args()
+
+    input_path = Path(args.input_path)
+    if not input_path.is_absolute():
+        input_path = Path(get_data_directory("datasets", args.input_path))
+    if not input_path.exists() or not input_path.is_dir():
+        raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+
+    operation = args.operation.strip()
+    if operation == "list":
+        for store_path in iter_stores(input_path):
+            store = SampleStore(store_path)
+            entries = list(store.iter_entries())
+            print(f"{store_path.name}: {len(entries)} requests, {sum(entry['count'] for _, entry in entries)} samples, {len(store.entries) - len(entries)} retired")
+    elif operation == "view":
+        if not args.custom_id:
+            raise ValueError("view needs --custom_id")
+        for store_path in iter_stores(input_path):
+            store = SampleStore(store_path)
+            if not store.has(args.custom_id):
+                continue
+            if args.output_path:
+                print(f"✅ {store.write_view(args.custom_id, Path(args.output_path))}")
+            else:
+                for line in store.read_lines(args.custom_id):
+                    print(line)
+    elif operation == "pack":
+        packed = pack(input_path, args.dry_run.lower() == "true")
+        print(f"✅ {packed} files packed.")
+    else:
+        print(f"Unknown operation {operation}")
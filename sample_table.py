@@ -0,0 +1,274 @@
+#a columnar table of every sample (batched-samples, the combined datasets and the legacy datasets) for analytics
+#that would otherwise json.loads every line of every file: samples per type and node, lengths, token estimates,
+#clarifications and so on. ingesting reads every sample once and extracts one row of fields per sample; queries
+#then run vectorized over the columns (numpy) in well under a second.
+#aggregates are skipped so that no sample is counted twice within a source: ALL_, packed and selected files of
+#the combined datasets repeat the <TYPE>_combined.jsonl ones, and the *_combined* files of a legacy directory
+#repeat its per node files. the sources are different stages of the same samples; tell them apart by source.
+#the table is saved as parquet when pyarrow is installed (optional, pip install pyarrow), as a compressed numpy
+#archive otherwise; both load into the same numpy columns.
+
+import json
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+import numpy as np
+from util import get_data_directory, estimate_tokens
+from sample_catalog import SampleCatalog, parse_sample_name
+from jsonl_io import glob_jsonl, iter_lines, strip_suffix
+from compact_structure import is_compact
+from select_samples import get_type
+from augment_samples import AUGMENT_BATCH_PREFIX
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+TABLE_FILE = "sample_table.parquet" if pyarrow else "sample_table.npz"    # under datasets
+STRING_COLUMNS = ("source", "name", "type", "node", "batch_id")
+INT_COLUMNS = ("messages", "turns", "devices", "system_chars", "structure_chars", "query_chars", "assistant_chars", "tokens")
+BOOL_COLUMNS = ("valid", "clarify", "packed", "compact", "augmented")
+COLUMNS = STRING_COLUMNS + INT_COLUMNS + BOOL_COLUMNS
+
+
+def get_fields(line: str) -> dict:
+    """
+    The numeric and flag fields of one JSONL line; lines that are not chat samples only get valid=False.
+    """
+    fields = dict.fromkeys(INT_COLUMNS, 0)
+    fields.update(dict.fromkeys(BOOL_COLUMNS, False))
+    try:
+        messages = json.loads(line)["messages"]
+        roles = [message["role"] for message in messages]
+        contents = [content if isinstance(content, str) else json.dumps(content) for content in (message.get("content") or "" for message in messages)]
+    except Exception:
+        return fields
+    fields["valid"] = len(roles) >= 3 and len(roles) % 2 == 1 and roles[0] == "system" and all(
+        role == ("user" if i % 2 else "assistant") for i, role in enumerate(roles[1:], 1))
+    user = contents[1] if len(contents) > 1 else ""
+    structure_end = user.find("USER QUERY:")
+    structure = user[:structure_end] if structure_end >= 0 else user
+    assistant = "".join(content for role, content in zip(roles, contents) if role == "assistant")
+    fields["messages"] = len(messages)
+    fields["turns"] = roles.count("assistant")
+    fields["devices"] = structure.count("***Device***")
+    fields["system_chars"] = len(contents[0])
+    fields["structure_chars"] = len(structure)
+    fields["query_chars"] = sum(len(content) for role, content in zip(roles[1:], contents[1:]) if role == "user") - len(structure)
+    fields["assistant_chars"] = len(assistant)
+    fields["tokens"] = sum(estimate_tokens(content) for content in contents)
+    fields["clarify"] = "clarify" in assistant.lower()
+    fields["packed"] = fields["turns"] > 1
+    fields["compact"] = is_compact(structure)
+    return fields
+
+def iter_catalog(samples_path: Path, source: str) -> Iterator[dict]:
+    """
+    Rows of the samples of a batched-samples directory (files and stores) with their catalog fields.
+    """
+    catalog = SampleCatalog(samples_path)
+    try:
+        catalog.refresh()
+        for row in catalog.select():
+            try:
+                lines = catalog.read_lines(row)
+            except Exception as e:
+                print(f"Error reading {row['name']}: {e}")
+                continue
+            batch_id = row["batch_id"] or ""
+            for line in lines:
+                if line.strip():
+                    fields = get_fields(line)
+                    fields.update(source=source, name=row["name"], type=row["type"] or "", node=row["node_uuid"] or "",
+                                  batch_id=batch_id, augmented=batch_id.startswith(AUGMENT_BATCH_PREFIX))
+                    yield fields
+    finally:
+        catalog.close()
+
+def iter_files(paths: Iterable[Path], source: str, default_type: str = None) -> Iterator[dict]:
+    """
+    Rows of the samples of JSONL files; type and node come from the file name where it has them.
+    """
+    for path in paths:
+        parsed = parse_sample_name(path.name) or {}
+        type = parsed.get("type") or default_type or get_type(Path(strip_suffix(path.name)))
+        try:
+            for line in iter_lines(path):
+                fields = get_fields(line)
+                fields.update(source=source, name=path.name, type=type, node=parsed.get("node_uuid") or "", batch_id=parsed.get("batch_id") or "")
+                yield fields
+        except Exception as e:
+            print(f"Error reading {path.name}: {e}")
+
+def get_combined_files(path: Path) -> List[Path]:
+    """
+    The <TYPE>_combined.jsonl files of the combined datasets, without ALL_, packed and selected files.
+    """
+    return [file for file in glob_jsonl(path, "*_combined") if get_type(Path(strip_suffix(file.name))) != "all"]
+
+def get_legacy_files(directory: Path) -> List[Path]:
+    """
+    The files of a legacy directory; its *_combined* files only if there are no per node files.
+    """
+    files = glob_jsonl(directory, "*")
+    per_node = [file for file in files if "_combined" not in file.name]
+    return per_node or files
+
+def iter_sources(sources: Dict[str, Path]) -> Iterator[dict]:
+    for source, path in sources.items():
+        if not path.is_dir():
+            print(f"Skipping {source}: {path} is not a directory")
+            continue
+        if source == "batched":
+            yield from iter_catalog(path, source)
+        elif source == "legacy":
+            #samples, concepts, devices and dsls; the latter are typed by their directory
+            for directory in sorted(p for p in path.iterdir() if p.is_dir()):
+                yield from iter_files(get_legacy_files(directory), source, None if directory.name == "samples" else directory.name)
+        else:
+            yield from iter_files(get_combined_files(path), source)
+
+def build(rows: Iterable[dict]) -> Dict[str, np.ndarray]:
+    """
+    The columns of the rows as numpy arrays.
+    """
+    columns = {column: [] for column in COLUMNS}
+    for row in rows:
+        for column in COLUMNS:
+            columns[column].append(row[column])
+    table = {column: np.array(columns[column], dtype=str) for column in STRING_COLUMNS}
+    table.update({column: np.array(columns[column], dtype=np.int64) for column in INT_COLUMNS})
+    table.update({column: np.array(columns[column], dtype=bool) for column in BOOL_COLUMNS})
+    return table
+
+def save(table: Dict[str, np.ndarray], table_path: Path):
+    tmp_file = table_path.with_name(table_path.name + ".tmp")
+    if table_path.suffix == ".parquet":
+        pyarrow.parquet.write_table(pyarrow.table({column: table[column] for column in COLUMNS}), tmp_file)
+    else:
+        with tmp_file.open("wb") as f:
+            np.savez_compressed(f, **table)
+    tmp_file.replace(table_path)
+
+def load(table_path: Path) -> Dict[str, np.ndarray]:
+    if table_path.suffix == ".parquet":
+        if pyarrow is None:
+            raise ImportError(f"{table_path.name} is parquet; pip install pyarrow to read it.")
+        data = pyarrow.parquet.read_table(table_path)
+        table = {column: data.column(column).to_numpy(zero_copy_only=False) for column in COLUMNS}
+        table.update({column: table[column].astype(str) for column in STRING_COLUMNS})
+        return table
+    with np.load(table_path) as data:
+        return {column: data[column] for column in COLUMNS}
+
+def get_column(table: Dict[str, np.ndarray], column: str) -> np.ndarray:
+    if column not in table:
+        raise ValueError(f"Unknown column {column}; use one of {', '.join(COLUMNS)}")
+    return table[column]
+
+def parse_value(column: str, value: str):
+    """
+    The value of a condition as the type of its column; flags take true/false (or 1/0).
+    """
+    if column in BOOL_COLUMNS:
+        if value.lower() in ("true", "1"):
+            return True
+        if value.lower() in ("false", "0"):
+            return False
+        raise ValueError(f"{column} is a flag; use {column}, !{column}, {column}=true or {column}=false")
+    if column in INT_COLUMNS:
+        return int(value)
+    return value
+
+def filter_rows(table: Dict[str, np.ndarray], where: List[str]) -> np.ndarray:
+    """
+    A mask of the rows matching every condition: column=value, column!=value, a flag or !flag.
+    """
+    mask = np.ones(len(table["source"]), dtype=bool)
+    for condition in where:
+        if "!=" in condition:
+            column, value = (part.strip() for part in condition.split("!=", 1))
+            mask &= get_column(table, column) != parse_value(column, value)
+        elif "=" in condition:
+            column, value = (part.strip() for part in condition.split("=", 1))
+            mask &= get_column(table, column) == parse_value(column, value)
+        elif condition.startswith("!"):
+            mask &= ~get_column(table, condition[1:].strip()).astype(bool)
+        else:
+            mask &= get_column(table, condition.strip()).astype(bool)
+    return mask
+
+def query(table: Dict[str, np.ndarray], group_by: List[str], metrics: List[str], where: List[str] = None) -> Tuple[List[str], List[tuple]]:
+    """
+    Aggregates the rows matching where per group_by columns. Metrics are count, or sum:, mean:, max: of a numeric
+    column, or share: of a flag. Returns (header, rows) with the largest groups first.
+    """
+    mask = filter_rows(table, where or [])
+    selected = {column: values[mask] for column, values in table.items()}
+    count = int(mask.sum())
+    if group_by:
+        #one integer code per group from the codes of its columns
+        uniques, codes = zip(*(np.unique(selected[column], return_inverse=True) for column in group_by))
+        keys, groups = np.unique(np.stack(codes, axis=1) if count else np.empty((0, len(group_by)), dtype=np.int64), axis=0, return_inverse=True)
+        groups = groups.reshape(-1)
+        labels = [tuple(str(uniques[i][key[i]]) for i in range(len(group_by))) for key in keys]
+    else:
+        groups = np.zeros(count, dtype=np.int64)
+        labels = [()]
+    sizes = np.bincount(groups, minlength=len(labels))
+    results = []
+    for metric in metrics:
+        name, _, column = metric.partition(":")
+        if name == "count":
+            results.append(sizes)
+        elif name == "sum":
+            results.append(np.rint(np.bincount(groups, weights=selected[column].astype(np.float64), minlength=len(labels))).astype(np.int64))
+        elif name in ("mean", "share"):
+            results.append(np.bincount(groups, weights=selected[column].astype(np.float64), minlength=len(labels)) / np.maximum(sizes, 1))
+        elif name == "max":
+            values = np.zeros(len(labels), dtype=np.int64)
+            np.maximum.at(values, groups, selected[column])
+            results.append(values)
+        else:
+            raise ValueError(f"Unknown metric {metric}")
+    order = np.argsort(-sizes, kind="stable")
+    rows = [labels[i] + tuple(result[i].item() for result in results) for i in order if sizes[i] or not group_by]
+    return list(group_by) + list(metrics), rows
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Ingest all samples into a columnar table and run vectorized queries over it.")
+    parser.add_argument("--operation", default="query", type=str, help="ingest: (re)build the table, query: aggregate it")
+    parser.add_argument("--table_path", type=str, help=f"The table; defaults to datasets/{TABLE_FILE} (.parquet with pyarrow, .npz otherwise).")
+    parser.add_argument("--sources", default="batched,combined,legacy", type=str, help="ingest: batched (datasets/batched-samples), combined (datasets/samples), legacy (legacy/datasets).")
+    parser.add_argument("--group_by", default="source,type", type=str, help=f"query: comma separated columns of {', '.join(STRING_COLUMNS + BOOL_COLUMNS)}")
+    parser.add_argument("--metrics", default="count,mean:assistant_chars,sum:tokens,share:clarify", type=str, help="query: count, sum:<column>, mean:<column>, max:<column>, share:<flag>")
+    parser.add_argument("--where", type=str, help="query: comma separated conditions, e.g. type=routines,valid,!augmented")
+    args = parser.parse_args()
+
+    table_path = Path(args.table_path) if args.table_path else Path(get_data_directory("datasets", TABLE_FILE))
+    operation = args.operation.strip()
+    if operation == "ingest":
+        locations = {
+            "batched": Path(get_data_directory("datasets", "batched-samples")),
+            "combined": Path(get_data_directory("datasets", "samples")),
+            "legacy": Path(get_data_directory("legacy", "datasets")),
+        }
+        sources = {source.strip(): locations[source.strip()] for source in args.sources.split(",")}
+        table = build(iter_sources(sources))
+        save(table, table_path)
+        print(f"✅ {len(table['source'])} samples saved to {table_path}")
+    elif operation == "query":
+        table = load(table_path)
+        group_by = [c.strip() for c in args.group_by.split(",") if c.strip()]
+        metrics = [m.strip() for m in args.metrics.split(",") if m.strip()]
+        where = [w.strip() for w in args.where.split(",")] if args.where else []
+        header, rows = query(table, group_by, metrics, where)
+        print("\t".join(header))
+        for row in rows:
+            print("\t".join(f"{value:.2f}" if isinstance(value, float) else str(value) for value in row))
+    else:
+        print(f"Unknown operation {operation}")
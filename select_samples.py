@@ -0,0 +1,175 @@
+#selects, for a training token budget, the subset of the combined samples that covers the most of what they
+#exercise: every (sample type, device type, kind, id) a response references, kind being command, property,
+#control or uom (see coverage_planner.get_references), where the device type is the device's definition without
+#its name and id (device_structure.get_signature) so that the same switch model in two homes counts once.
+#a feature is worth covering up to REDUNDANCY times; the value of a set of samples is then submodular and the
+#greedy choice by gain per token is near optimal. it is evaluated lazily (a max-heap of upper bounds: gains only
+#shrink, so a sample is re-evaluated only when it reaches the top), which keeps millions of candidates tractable.
+#only the features, token count and file offset of each sample are kept in memory; the selected samples are
+#copied from the input files by offset, in their original order.
+
+import hashlib, heapq, json, os
+from pathlib import Path
+from typing import Dict, List, Tuple
+from util import get_data_directory
+from device_structure import parse_device_structure, extract_device_structure, get_signature
+from coverage_planner import get_references
+from pack_conversations import count_tokens
+
+
+REDUNDANCY = 3              # copies of a feature that still add value
+NO_REFERENCES = "none"      # feature kind of samples whose responses reference nothing (clarifications, answers)
+
+
+def get_type(input_file: Path) -> str:
+    """
+    The sample type of a combined file (COMMANDS_combined.jsonl -> commands), or "all".
+    """
+    prefix = input_file.name.split("_", 1)[0].lower()
+    return prefix if prefix in ("commands", "properties", "routines") else "all"
+
+
+class FeatureIndex:
+    """
+    Interns the features of the samples as integers and caches the device types of every structure.
+    """
+    def __init__(self):
+        self.ids: Dict[tuple, int] = {}
+        self.device_types: Dict[str, Dict[str, str]] = {}
+
+    def get_device_types(self, structure: str) -> Dict[str, str]:
+        key = hashlib.sha1(structure.encode("utf-8")).hexdigest()
+        if key not in self.device_types:
+            try:
+                self.device_types[key] = {device.id: hashlib.sha1(get_signature(device).encode("utf-8")).hexdigest()[:16]
+                                          for device in parse_device_structure(structure)}
+            except Exception as e:
+                print(f"Error parsing a device structure: {e}")
+                self.device_types[key] = {}
+        return self.device_types[key]
+
+    def get_features(self, sample: dict, type: str) -> Tuple[int, ...]:
+        messages = sample["messages"]
+        device_types = self.get_device_types(extract_device_structure(messages[1]["content"]))
+        features = set()
+        for message in messages[2::2]:
+            for kind, device_id, id in get_references(message.get("content") or ""):
+                features.add((type, device_types.get(device_id, device_id), kind, id))
+        if not features:
+            features.add((type, "", NO_REFERENCES, ""))
+        return tuple(sorted(self.ids.setdefault(feature, len(self.ids)) for feature in features))
+
+
+def load_candidates(input_files: List[Path], index: FeatureIndex) -> List[tuple]:
+    """
+    Reads the samples of the files once. Returns (file number, offset, tokens, features) per sample.
+    """
+    candidates = []
+    for file_number, input_file in enumerate(input_files):
+        type = get_type(input_file)
+        with open(input_file, "rb") as f:
+            offset = 0
+            for line in f:
+                start, offset = offset, offset + len(line)
+                if not line.strip():
+                    continue
+                try:
+                    sample = json.loads(line)
+                    candidates.append((file_number, start, count_tokens(sample["messages"]), index.get_features(sample, type)))
+                except Exception as e:
+                    print(f"Skipping a sample of {input_file.name} at {start}: {e}")
+    return candidates
+
+def select(candidates: List[tuple], budget: int, redundancy: int = REDUNDANCY) -> List[int]:
+    """
+    Lazy greedy selection of the candidates with the most coverage gain per token within the token budget.
+    Returns the indexes of the selected candidates.
+    """
+    counts = {}
+
+    def gain(features) -> int:
+        return sum(1 for feature in features if counts.get(feature, 0) < redundancy)
+
+    #(-gain per token, index, gain the bound was computed with)
+    heap = [(-len(features) / max(tokens, 1), i, len(features)) for i, (_, _, tokens, features) in enumerate(candidates)]
+    heapq.heapify(heap)
+    selected = []
+    spent = 0
+    while heap:
+        _, i, bound = heapq.heappop(heap)
+        _, _, tokens, features = candidates[i]
+        if spent + tokens > budget:
+            #the budget only shrinks; this one will never fit
+            continue
+        current = gain(features)
+        if current == 0:
+            continue
+        if current < bound and heap and -heap[0][0] > current / max(tokens, 1):
+            heapq.heappush(heap, (-current / max(tokens, 1), i, current))
+            continue
+        selected.append(i)
+        spent += tokens
+        for feature in features:
+            counts[feature] = counts.get(feature, 0) + 1
+    return selected
+
+def write_selection(input_files: List[Path], candidates: List[tuple], selected: List[int], output_file: Path) -> int:
+    """
+    Copies the selected samples, in input order, to output_file. Returns the number written.
+    """
+    tmp_file = output_file.with_suffix(".tmp")
+    handles = [open(input_file, "rb") for input_file in input_files]
+    try:
+        with tmp_file.open("wb") as out:
+            for i in sorted(selected, key=lambda i: candidates[i][:2]):
+                f = handles[candidates[i][0]]
+                f.seek(candidates[i][1])
+                out.write(f.readline().rstrip(b"\r\n") + b"\n")
+    finally:
+        for f in handles:
+            f.close()
+    os.replace(tmp_file, output_file)
+    return len(selected)
+
+def coverage(candidates: List[tuple], indexes, redundancy: int = REDUNDANCY) -> Tuple[int, float]:
+    """
+    (distinct features, share of the feature copies up to redundancy) of the given candidates.
+    """
+    counts = {}
+    for i in indexes:
+        for feature in candidates[i][3]:
+            counts[feature] = counts.get(feature, 0) + 1
+    return len(counts), sum(min(count, redundancy) for count in counts.values())
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Select the combined samples that cover the most devices, commands, properties and uoms within a training token budget.")
+    parser.add_argument("--input_files", default="COMMANDS_combined.jsonl,PROPERTIES_combined.jsonl,ROUTINES_combined.jsonl", type=str, help="Comma separated combined files. Relative paths are resolved against datasets/samples.")
+    parser.add_argument("--output_file", default="SELECTED_combined.jsonl", type=str, help="The selection. Relative paths are resolved against datasets/samples.")
+    parser.add_argument("--budget", required=True, type=int, help="Training tokens (estimated) of the selection.")
+    parser.add_argument("--redundancy", default=REDUNDANCY, type=int, help="Copies of a feature that still add value.")
+    args = parser.parse_args()
+
+    samples_path = Path(get_data_directory("datasets", "samples"))
+    input_files = []
+    for name in args.input_files.split(","):
+        input_file = Path(name.strip())
+        input_file = input_file if input_file.is_absolute() else samples_path / input_file
+        if not input_file.exists():
+            raise ValueError(f"Input file {input_file} does not exist.")
+        input_files.append(input_file)
+    output_file = Path(args.output_file)
+    output_file = output_file if output_file.is_absolute() else samples_path / output_file
+
+    index = FeatureIndex()
+    candidates = load_candidates(input_files, index)
+    selected = select(candidates, args.budget, args.redundancy)
+    count = write_selection(input_files, candidates, selected, output_file)
+
+    total_tokens = sum(candidate[2] for candidate in candidates)
+    selected_tokens = sum(candidates[i][2] for i in selected)
+    all_features, all_copies = coverage(candidates, range(len(candidates)), args.redundancy)
+    features, copies = coverage(candidates, selected, args.redundancy)
+    print(f"✅ {count} of {len(candidates)} samples saved to {output_file}: ~{selected_tokens} of ~{total_tokens} tokens, "
+          f"{features} of {all_features} features covered ({copies / max(all_copies, 1):.0%} up to {args.redundancy} copies)")
@@ -0,0 +1,243 @@
+#records what every batch request cost: the usage of its completion (response.body.usage in the batch
+#outputs), i.e. prompt, cached prompt and completion tokens, per custom id together with its type, node,
+#chunk, model and the version of the training prompt it was rendered from. the ledger is a small sqlite
+#database next to the samples. reports aggregate it per type, node, prompt version, model or batch:
+#tokens per sample, prompt cache hit rate and cost per usable sample, usable samples being the ones left
+#in the catalog once check_samples.py has moved or retired the invalid ones.
+
+import json, sqlite3, time
+from pathlib import Path
+from typing import Dict, List, Tuple
+from util import get_data_directory
+from sample_catalog import SampleCatalog, STORE_ENTRY_RE, parse_custom_id
+from sample_store import SampleStore
+from jsonl_io import open_jsonl, glob_jsonl, strip_suffix
+
+
+LEDGER_FILE = ".usage_ledger.sqlite"
+
+#USD per 1M tokens: (input, cached input, output). model names are matched by prefix, the longest first
+PRICES = {
+    "gpt-5-nano": (0.05, 0.005, 0.40),
+    "gpt-5-mini": (0.25, 0.025, 2.00),
+    "gpt-5": (1.25, 0.125, 10.00),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+}
+BATCH_DISCOUNT = 0.5    # batch requests are billed at half the price; synchronous runs (batch_sync<ts>) are not
+GROUPS = ("type", "node_uuid", "prompt_version", "model", "batch_id")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    batch_id TEXT,
+    custom_id TEXT,
+    node_uuid TEXT,
+    chunk TEXT,
+    type TEXT,
+    model TEXT,
+    prompt_version TEXT,
+    prompt_tokens INTEGER,
+    cached_tokens INTEGER,
+    completion_tokens INTEGER,
+    finish_reason TEXT,
+    samples INTEGER,
+    recorded REAL,
+    PRIMARY KEY (batch_id, custom_id)
+);
+CREATE INDEX IF NOT EXISTS usage_type ON usage(type);
+"""
+
+_unpriced_models = set()
+
+def get_price(model: str) -> Tuple[float, float, float]:
+    """
+    (input, cached input, output) USD per 1M tokens of a model, or None with a warning (once per model) if it has no price.
+    """
+    for name in sorted(PRICES, key=len, reverse=True):
+        if model and model.startswith(name):
+            return PRICES[name]
+    if model not in _unpriced_models:
+        _unpriced_models.add(model)
+        print(f"WARNING: no price for model {model}; its cost is not counted. Add it to usage_ledger.PRICES.")
+    return None
+
+def get_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int, batch: bool = True) -> float:
+    """
+    The cost of a completion in USD, or None if the model has no known price.
+    """
+    price = get_price(model)
+    if price is None:
+        return None
+    input, cached, output = price
+    cost = ((prompt_tokens - cached_tokens) * input + cached_tokens * cached + completion_tokens * output) / 1_000_000
+    return cost * BATCH_DISCOUNT if batch else cost
+
+def count_samples(text: str) -> int:
+    """
+    The number of samples process_batch_completion gets out of a completion: 1 if it decodes, else whatever is salvaged.
+    """
+    try:
+        json.loads(text.strip())
+        return 1
+    except json.JSONDecodeError:
+        from salvage_samples import salvage_text
+        return len(salvage_text(text)[0])
+
+def count_usable(catalog: SampleCatalog) -> Dict[Tuple[str, str], int]:
+    """
+    (batch id, custom id) -> the number of samples in the catalog. Store entries are counted from the store index.
+    """
+    usable = {}
+    stores = {}
+    for row in catalog.select():
+        try:
+            match = STORE_ENTRY_RE.match(row["name"])
+            if match:
+                if match.group("store") not in stores:
+                    stores[match.group("store")] = SampleStore(catalog.samples_path / match.group("store"))
+                count = stores[match.group("store")].entries[row["custom_id"]]["count"]
+            else:
+                count = sum(1 for line in catalog.read_lines(row) if line.strip())
+        except Exception as e:
+            print(f"Error counting the samples of {row['name']}: {e}")
+            continue
+        key = (row["batch_id"], row["custom_id"])
+        usable[key] = usable.get(key, 0) + count
+    return usable
+
+
+class UsageLedger:
+    """
+    (batch id, custom id) -> the token usage of its completion and the number of samples it produced.
+    """
+    def __init__(self, samples_path: Path, ledger_path: Path = None):
+        self.samples_path = Path(samples_path)
+        self.ledger_path = Path(ledger_path) if ledger_path else self.samples_path / LEDGER_FILE
+        self.db = sqlite3.connect(self.ledger_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def has(self, batch_id: str, custom_id: str) -> bool:
+        return self.db.execute("SELECT 1 FROM usage WHERE batch_id = ? AND custom_id = ?", (batch_id, custom_id)).fetchone() is not None
+
+    def record(self, batch_id: str, custom_id: str, body: dict, samples: int, prompt_version: str = None):
+        """
+        Records the usage of one completion (the response body of a batch output line).
+        """
+        usage = body.get("usage") or {}
+        choices = body.get("choices") or [{}]
+        fields = parse_custom_id(custom_id)
+        get_price(body.get("model"))
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO usage (batch_id, custom_id, node_uuid, chunk, type, model, prompt_version, prompt_tokens, cached_tokens, completion_tokens, finish_reason, samples, recorded) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                (batch_id, custom_id, fields["node_uuid"], fields["chunk"], fields["type"], body.get("model"), prompt_version,
+                 usage.get("prompt_tokens", 0), (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+                 usage.get("completion_tokens", 0), choices[0].get("finish_reason"), samples, time.time()))
+
+    def record_output_file(self, output_file: Path) -> int:
+        """
+        Records the completions of a downloaded batch output (<batch id>_output.jsonl[.gz|.zst]) that are not in the ledger yet,
+        e.g. the outputs processed before the ledger existed. Their prompt version is unknown.
+        Returns the number of completions recorded.
+        """
+        batch_id = strip_suffix(output_file.name)[:-len("_output")]
+        recorded = 0
+        with open_jsonl(output_file, "r") as f:
+            for line in f:
+                try:
+                    content = json.loads(line)
+                    body = content["response"]["body"]
+                except Exception:
+                    continue
+                if self.has(batch_id, content["custom_id"]):
+                    continue
+                choice = (body.get("choices") or [{}])[0]
+                truncated = choice.get("finish_reason") == "length"
+                samples = 0 if truncated else count_samples((choice.get("message") or {}).get("content") or "")
+                self.record(batch_id, content["custom_id"], body, samples)
+                recorded += 1
+        return recorded
+
+    def report(self, group_by: str = "type", catalog: SampleCatalog = None) -> List[dict]:
+        """
+        Aggregates the ledger per group_by (one of GROUPS). With a catalog, the samples still in it count as usable.
+        """
+        if group_by not in GROUPS:
+            raise ValueError(f"Unknown group {group_by}; use one of {', '.join(GROUPS)}")
+        usable = count_usable(catalog) if catalog else {}
+        groups = {}
+        for row in self.db.execute("SELECT * FROM usage"):
+            key = row[group_by] or "-"
+            group = groups.setdefault(key, {group_by: key, "requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                                            "samples": 0, "usable": 0, "cost": 0.0, "unpriced": 0})
+            group["requests"] += 1
+            group["prompt_tokens"] += row["prompt_tokens"]
+            group["cached_tokens"] += row["cached_tokens"]
+            group["completion_tokens"] += row["completion_tokens"]
+            group["samples"] += row["samples"] or 0
+            group["usable"] += usable.get((row["batch_id"], row["custom_id"]), 0)
+            cost = get_cost(row["model"], row["prompt_tokens"], row["cached_tokens"], row["completion_tokens"], not row["batch_id"].startswith("batch_sync"))
+            if cost is None:
+                group["unpriced"] += 1
+            else:
+                group["cost"] += cost
+        for group in groups.values():
+            tokens = group["prompt_tokens"] + group["completion_tokens"]
+            group["tokens_per_sample"] = tokens / group["samples"] if group["samples"] else None
+            group["cache_hit_rate"] = group["cached_tokens"] / group["prompt_tokens"] if group["prompt_tokens"] else 0.0
+            group["cost_per_usable_sample"] = group["cost"] / group["usable"] if group["usable"] else None
+        return sorted(groups.values(), key=lambda group: group["cost"], reverse=True)
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Token usage and cost of the batch requests (record, report).")
+    parser.add_argument("--input_path", default="batched-samples", type=str, help="Directory with the samples and downloaded batch outputs. Relative paths are resolved against the datasets directory.")
+    parser.add_argument("--operation", default="report", type=str, help="record: add downloaded batch outputs that are not in the ledger, report: aggregate the ledger")
+    parser.add_argument("--group_by", default="type", type=str, help=f"report: one of {', '.join(GROUPS)}")
+    parser.add_argument("--output_file", type=str, help="report: also write the report as JSON to this file.")
+    args = parser.parse_args()
+
+    input_path = Path(args.input_path)
+    if not input_path.is_absolute():
+        input_path = Path(get_data_directory("datasets", args.input_path))
+    if not input_path.exists() or not input_path.is_dir():
+        raise ValueError(f"Input path {input_path} does not exist or is not a directory.")
+
+    ledger = UsageLedger(input_path)
+    try:
+        operation = args.operation.strip()
+        if operation == "record":
+            recorded = 0
+            for output_file in glob_jsonl(input_path, "batch_*_output"):
+                recorded += ledger.record_output_file(output_file)
+            print(f"✅ {recorded} completions recorded.")
+        elif operation == "report":
+            catalog = SampleCatalog(input_path)
+            try:
+                catalog.refresh()
+                report = ledger.report(args.group_by.strip(), catalog)
+            finally:
+                catalog.close()
+            for group in report:
+                tokens_per_sample = f"{group['tokens_per_sample']:.0f}" if group['tokens_per_sample'] is not None else "-"
+                cost_per_usable = f"${group['cost_per_usable_sample']:.4f}" if group['cost_per_usable_sample'] is not None else "-"
+                unpriced = f", {group['unpriced']} unpriced" if group['unpriced'] else ""
+                print(f"{group[args.group_by.strip()]}: {group['requests']} requests, {tokens_per_sample} tokens/sample, "
+                      f"{group['cache_hit_rate']:.0%} prompt cache hits, ${group['cost']:.2f}, {cost_per_usable}/usable sample "
+                      f"({group['usable']} of {group['samples']} samples usable){unpriced}")
+            if args.output_file:
+                with open(args.output_file, "w") as f:
+                    json.dump(report, f, indent=2)
+                print(f"✅ report saved to {args.output_file}")
+        else:
+            print(f"Unknown operation {operation}")
+    finally:
+        ledger.close()
@@ -1,6 +1,6 @@
 from importlib.resources import files
 from pathlib import Path
-import os
+import hashlib, json, os, tempfile
 
 def get_data_directory(parent:str, subdir:str) -> str:
     """
@@ -24,3 +24,50 @@ def get_secrets_dir()-> str:
         str: The path to the secrets directory.
     """
     return get_data_directory("secrets", None)
+
+def estimate_tokens(text:str) -> int:
+    """
+    Returns a rough estimate of the number of tokens in a text (~4 characters per token).
+    
+    Args:
+        text (str): The text to estimate.
+        
+    Returns:
+        int: The estimated number of tokens.
+    """
+    return (len(text) + 3) // 4 if text else 0
+
+def get_file_hash(path:Path) -> str:
+    """
+    Returns the sha256 of a file's content, reading it in blocks.
+    
+    Args:
+        path (Path): The file to hash.
+        
+    Returns:
+        str: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_json_atomic(path:Path, data) -> None:
+    """
+    Writes data as JSON to a temporary file next to path and renames it over path,
+    so readers never see a partially written file.
+    
+    Args:
+        path (Path): The destination file.
+        data: Anything json.dump can serialize.
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,249 @@
+#a lease based work queue so that any number of generator processes, on one host or on several hosts sharing
+#the datasets directory, can work through the same node/type/chunk units without duplicating work.
+#the queue is a sqlite database; claiming units happens in a write transaction (BEGIN IMMEDIATE), so two
+#workers never lease the same unit. a leased unit belongs to its worker until the lease expires; workers
+#heartbeat to extend the leases they hold, so the units of a crashed worker are simply claimed again by
+#others once their lease runs out. units that keep failing are parked as failed after MAX_ATTEMPTS.
+#the default rollback journal is kept on purpose: WAL does not work across hosts on network filesystems.
+
+import os, socket, sqlite3, threading, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List
+from util import get_data_directory
+
+
+QUEUE_FILE = ".work_queue.sqlite"    # under datasets by default
+LEASE_SECONDS = 600                  # a unit is reclaimed this long after its worker's last heartbeat
+HEARTBEAT_SECONDS = LEASE_SECONDS / 3
+MAX_ATTEMPTS = 3
+DB_TIMEOUT = 60                      # seconds to wait for the database lock held by another worker
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    unit_id TEXT PRIMARY KEY,
+    type TEXT,
+    node_stem TEXT,
+    chunk TEXT,
+    full_text TEXT,
+    status TEXT DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER DEFAULT 0,
+    samples INTEGER,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS units_status ON units(status, lease_expires);
+"""
+
+def get_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    Units of work (one generation request each: custom id, type, node, chunk and device structure) with leases.
+    """
+    def __init__(self, queue_path: Path = None, lease_seconds: float = LEASE_SECONDS):
+        self.queue_path = Path(queue_path) if queue_path else Path(get_data_directory("datasets", QUEUE_FILE))
+        self.lease_seconds = lease_seconds
+        #transactions are explicit (BEGIN IMMEDIATE) so that a claim is atomic across processes
+        self.db = sqlite3.connect(self.queue_path, timeout=DB_TIMEOUT, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _transaction(self, statements):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            result = statements()
+            self.db.execute("COMMIT")
+            return result
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def enqueue(self, units: Iterable[tuple]) -> int:
+        """
+        Adds (unit id, type, node stem, chunk, device structure) units. Units already in the queue, in whatever
+        state, are left alone. Returns the number of units added.
+        """
+        units = [tuple(unit) + (time.time(),) for unit in units]
+        def add():
+            before = self.db.total_changes
+            self.db.executemany("INSERT OR IGNORE INTO units (unit_id, type, node_stem, chunk, full_text, updated) VALUES (?,?,?,?,?,?)", units)
+            return self.db.total_changes - before
+        return self._transaction(add)
+
+    def claim(self, worker_id: str, types: Iterable[str] = None, limit: int = 1) -> List[sqlite3.Row]:
+        """
+        Leases up to limit units to the worker: pending ones first, then the ones whose lease expired.
+        """
+        types = list(types) if types else None
+        def lease():
+            now = time.time()
+            #units whose worker died too often are not handed out again
+            self.db.execute("UPDATE units SET status = 'failed', error = 'lease expired', updated = ? WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                            (now, now, MAX_ATTEMPTS))
+            where = "(status = 'pending' OR (status = 'leased' AND lease_expires < ?))"
+            params = [now]
+            if types:
+                where += f" AND type IN ({','.join('?' * len(types))})"
+                params.extend(types)
+            rows = self.db.execute(f"SELECT unit_id FROM units WHERE {where} ORDER BY status DESC, attempts, rowid LIMIT ?", params + [limit]).fetchall()
+            ids = [row["unit_id"] for row in rows]
+            if not ids:
+                return []
+            marks = ",".join("?" * len(ids))
+            self.db.execute(f"UPDATE units SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE unit_id IN ({marks})",
+                            [worker_id, now + self.lease_seconds, now] + ids)
+            return self.db.execute(f"SELECT * FROM units WHERE unit_id IN ({marks})", ids).fetchall()
+        return self._transaction(lease)
+
+    def heartbeat(self, worker_id: str) -> int:
+        """
+        Extends the leases of all the units the worker holds. Returns the number of leases extended.
+        """
+        def extend():
+            now = time.time()
+            return self.db.execute("UPDATE units SET lease_expires = ?, updated = ? WHERE status = 'leased' AND owner = ?",
+                                   (now + self.lease_seconds, now, worker_id)).rowcount
+        return self._transaction(extend)
+
+    def complete(self, worker_id: str, unit_id: str, samples: int) -> bool:
+        """
+        Marks a unit done. Returns False if the worker no longer held the lease (it expired and was reclaimed).
+        """
+        return self._transaction(lambda: self.db.execute(
+            "UPDATE units SET status = 'done', samples = ?, error = NULL, lease_expires = NULL, updated = ? WHERE unit_id = ? AND owner = ? AND status = 'leased'",
+            (samples, time.time(), unit_id, worker_id)).rowcount > 0)
+
+    def release(self, worker_id: str, unit_id: str, error: str = None) -> bool:
+        """
+        Gives a unit back, e.g. after an error: it is pending again, or failed once it used up MAX_ATTEMPTS.
+        """
+        return self._transaction(lambda: self.db.execute(
+            "UPDATE units SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, owner = NULL, lease_expires = NULL, error = ?, updated = ? "
+            "WHERE unit_id = ? AND owner = ? AND status = 'leased'",
+            (MAX_ATTEMPTS, error, time.time(), unit_id, worker_id)).rowcount > 0)
+
+    def reset(self, statuses: Iterable[str] = ("failed",)) -> int:
+        """
+        Puts the units in the given states back to pending with a fresh attempt count.
+        """
+        statuses = list(statuses)
+        return self._transaction(lambda: self.db.execute(
+            f"UPDATE units SET status = 'pending', owner = NULL, lease_expires = NULL, attempts = 0, updated = ? WHERE status IN ({','.join('?' * len(statuses))})",
+            [time.time()] + statuses).rowcount)
+
+    def counts(self) -> List[sqlite3.Row]:
+        """
+        Returns (type, status, units, samples) rows.
+        """
+        return self.db.execute("SELECT type, status, COUNT(*) AS units, SUM(samples) AS samples FROM units GROUP BY type, status ORDER BY type, status").fetchall()
+
+
+def keep_alive(queue_path: Path, worker_id: str, stop: threading.Event, lease_seconds: float = LEASE_SECONDS):
+    """
+    Heartbeats the worker's leases until stop is set. Runs in its own thread with its own connection.
+    """
+    queue = WorkQueue(queue_path, lease_seconds)
+    try:
+        while not stop.wait(HEARTBEAT_SECONDS):
+            try:
+                queue.heartbeat(worker_id)
+            except Exception as e:
+                print(f"Error extending the leases of {worker_id}: {e}")
+    finally:
+        queue.close()
+
+def run_worker(queue_path: Path, output_path: Path, service: str, types: Iterable[str] = None, batch_size: int = None, worker_id: str = None) -> int:
+    """
+    Claims units and generates their samples synchronously (create_samples.py) until the queue has no more units
+    for this worker. Returns the number of samples saved.
+    """
+    import create_samples
+    from sample_generation import sample_file_name, commit_node_states
+    from sample_catalog import SampleCatalog
+    worker_id = worker_id or get_worker_id()
+    batch_size = batch_size or create_samples.MAX_CONCURRENCY
+    #results use the layout of synchronous runs, one run id per worker
+    run_id = f"batch_sync{datetime.now().strftime('%Y%m%d%H%M%S')}{os.getpid()}"
+    queue = WorkQueue(queue_path)
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=keep_alive, args=(queue.queue_path, worker_id, stop, queue.lease_seconds), daemon=True)
+    heartbeat.start()
+    total = 0
+    try:
+        with ThreadPoolExecutor(max_workers=batch_size) as executor:
+            while True:
+                units = queue.claim(worker_id, types, batch_size)
+                if not units:
+                    break
+                print(f"{worker_id}: claimed {len(units)} units")
+                futures = {}
+                for unit in units:
+                    create_samples.setup_prompts(unit["type"])
+                    output_file = output_path / sample_file_name(run_id, unit["unit_id"])
+                    futures[executor.submit(create_samples.generate_openpipe_entries, unit["full_text"], output_file, service, unit["type"], dump=True)] = unit
+                for future in as_completed(futures):
+                    unit = futures[future]
+                    try:
+                        saved = future.result()
+                    except Exception as e:
+                        saved = None
+                        print(f"Error generating {unit['unit_id']}: {e}")
+                    if not saved:
+                        #failed requests return None; a reply without a usable sample is tried again as well
+                        queue.release(worker_id, unit["unit_id"], "request failed" if saved is None else "no samples")
+                    elif not queue.complete(worker_id, unit["unit_id"], saved):
+                        print(f"{unit['unit_id']}: lease lost before completion; another worker may generate it again")
+                    total += saved or 0
+        if total:
+            #incremental runs: the chunks whose samples were saved replace the ones they were generated for
+            catalog = SampleCatalog(output_path)
+            try:
+                catalog.refresh()
+                committed, removed = commit_node_states(catalog, types)
+                print(f"{worker_id}: {committed} pending chunks committed, {removed} sample files retired")
+            finally:
+                catalog.close()
+    finally:
+        stop.set()
+        heartbeat.join()
+        queue.close()
+    return total
+
+# Example usage
+if __name__ == "__main__":
+    argparse = __import__('argparse')
+    parser = argparse.ArgumentParser(description="Lease based work queue for sample generation (enqueue, work, status, reset).")
+    parser.add_argument("--operation", default="status", type=str, help="work: run a worker, status: units per type and state, reset: make failed units pending again. Units are added with generate_samples.py --mode=queue.")
+    parser.add_argument("--queue_path", type=str, help=f"The queue database; defaults to datasets/{QUEUE_FILE}. All workers must use the same file.")
+    parser.add_argument("--output_path", type=str, help="work: where the samples are written. Defaults to datasets/batched-samples.")
+    parser.add_argument("--types", type=str, help="work: only claim units of these types (properties, commands, routines).")
+    parser.add_argument("--service", default="openai", type=str, help="work: the service to use: xai, openai, pool")
+    parser.add_argument("--batch_size", type=int, help="work: units claimed (and generated concurrently) at a time.")
+    args = parser.parse_args()
+
+    types = [t.strip() for t in args.types.split(",")] if args.types else None
+    operation = args.operation.strip()
+    queue = WorkQueue(args.queue_path)
+    try:
+        if operation == "work":
+            output_path = Path(args.output_path) if args.output_path else Path(get_data_directory("datasets", "batched-samples"))
+            total = run_worker(queue.queue_path, output_path, args.service.strip(), types, args.batch_size)
+            print(f"✅ {total} samples saved to {output_path}")
+        elif operation == "reset":
+            print(f"✅ {queue.reset()} failed units are pending again")
+        elif operation != "status":
+            print(f"Unknown operation {operation}")
+        for row in queue.counts():
+            samples = f", {row['samples']} samples" if row["samples"] else ""
+            print(f"{row['type']} {row['status']}: {row['units']} units{samples}")
+    finally:
+        queue.close()